@@ -0,0 +1,406 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import binascii
+import bisect
+import itertools
+import re
+
+import six
+
+
+# a key is stored as a bitmap once it holds more than 1/DENSE_RATIO of all
+# record ids, i.e. when the bitmap gets smaller than the array of 32-bit ids
+DENSE_RATIO = 32
+ARRAY_TYPECODE = 'I'
+DAY_TYPECODE = 'i'
+# 'Q' is not available in Python 2.7, unsigned long is 64-bit on LP64
+# platforms and 32-bit ones still address 4G record ids
+OFFSET_TYPECODE = 'L'
+
+_BYTE_BITS = [tuple(bit for bit in six.moves.range(8) if byte & (1 << bit))
+              for byte in six.moves.range(256)]
+_NON_ZERO_BYTE = re.compile(b'[^\x00]')
+
+
+def _bits_to_bytes(bits):
+    # little-endian, byte N holds record ids from 8 * N to 8 * N + 7
+    if not bits:
+        return b''
+    digits = '%x' % bits
+    if len(digits) % 2:
+        digits = '0' + digits
+    return binascii.unhexlify(digits)[::-1]
+
+
+if hasattr(int, 'from_bytes'):
+    def _bytes_to_bits(data):
+        return int.from_bytes(data, 'little')
+else:
+    def _bytes_to_bits(data):
+        data = bytearray(data)
+        if not data:
+            return 0
+        data.reverse()
+        return int(binascii.hexlify(bytes(data)), 16)
+
+
+def _ids_to_bits(ids):
+    ids = list(ids)
+    if not ids:
+        return 0
+    buf = bytearray(max(ids) // 8 + 1)
+    for record_id in ids:
+        buf[record_id >> 3] |= 1 << (record_id & 7)
+    buf.reverse()
+    return int(binascii.hexlify(bytes(buf)), 16)
+
+
+if hasattr(int, 'bit_count'):
+    def _count_bits(bits):
+        return bits.bit_count()
+else:
+    def _count_bits(bits):
+        return bin(bits).count('1')
+
+
+def _iter_bits(bits):
+    buf = _bits_to_bytes(bits)
+    for match in _NON_ZERO_BYTE.finditer(buf):
+        n = match.start()
+        base = n << 3
+        for bit in _BYTE_BITS[bytearray(buf[n:n + 1])[0]]:
+            yield base + bit
+
+
+class RecordIdSet(object):
+    """Immutable set of record ids stored as a bitmap in a Python int.
+
+    AND, OR and difference of two sets are single operations on ints and
+    run at C speed. Plain iterables of ids are accepted as the other
+    operand. Ids are iterated in ascending order.
+    """
+
+    __slots__ = ('bits', '_bytes')
+
+    def __init__(self, ids=None, bits=0):
+        if ids is not None:
+            bits = _ids_to_bits(ids)
+        self.bits = bits
+        self._bytes = None
+
+    @staticmethod
+    def _get_bits(other):
+        if isinstance(other, RecordIdSet):
+            return other.bits
+        return _ids_to_bits(other)
+
+    def __and__(self, other):
+        return RecordIdSet(bits=self.bits & self._get_bits(other))
+
+    __rand__ = __and__
+
+    def __or__(self, other):
+        return RecordIdSet(bits=self.bits | self._get_bits(other))
+
+    __ror__ = __or__
+
+    def __sub__(self, other):
+        return RecordIdSet(bits=self.bits & ~self._get_bits(other))
+
+    def __rsub__(self, other):
+        return RecordIdSet(bits=self._get_bits(other) & ~self.bits)
+
+    def __len__(self):
+        return _count_bits(self.bits)
+
+    def __bool__(self):
+        return self.bits != 0
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return _iter_bits(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Make a set from the bitmap returned by to_bytes()."""
+        return cls(bits=_bytes_to_bits(data))
+
+    def to_bytes(self):
+        """Return the bitmap, byte N holds ids from 8 * N to 8 * N + 7."""
+        return _bits_to_bytes(self.bits)
+
+    def __contains__(self, record_id):
+        if self._bytes is None:
+            self._bytes = bytearray(_bits_to_bytes(self.bits))
+        n = record_id >> 3
+        return (0 <= n < len(self._bytes) and
+                bool(self._bytes[n] & (1 << (record_id & 7))))
+
+    def __eq__(self, other):
+        if isinstance(other, RecordIdSet):
+            return self.bits == other.bits
+        if isinstance(other, (set, frozenset)):
+            return set(self) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __repr__(self):
+        return 'RecordIdSet(%s)' % list(self)
+
+
+class BitmapIndex(object):
+    """Index from keys to record ids.
+
+    Ids of sparse keys are kept in sorted arrays and ids of dense keys in
+    bitmaps, whichever takes less memory. Changes are staged by add() and
+    remove() and become visible after commit(), so that bitmaps are
+    rebuilt once per update rather than once per record.
+    """
+
+    def __init__(self):
+        self.containers = {}
+        # key -> {record_id: True if added, False if removed}
+        self.staged = {}
+        self.universe = 0  # the largest record id ever added plus one
+
+    def copy(self):
+        """Return a copy that can be changed while this index is read.
+
+        Containers are never changed in place, so they are shared.
+        """
+        result = BitmapIndex()
+        result.containers = dict(self.containers)
+        result.staged = dict((key, dict(changes)) for key, changes
+                             in six.iteritems(self.staged))
+        result.universe = self.universe
+        return result
+
+    def add(self, key, record_id):
+        self.staged.setdefault(key, {})[record_id] = True
+        if record_id >= self.universe:
+            self.universe = record_id + 1
+
+    def remove(self, key, record_id):
+        self.staged.setdefault(key, {})[record_id] = False
+
+    def commit(self):
+        """Apply staged changes, return keys that have not been seen."""
+        new_keys = [key for key in self.staged if key not in self.containers]
+        for key, changes in six.iteritems(self.staged):
+            added = [i for i, is_added in six.iteritems(changes) if is_added]
+            removed = [i for i, is_added in six.iteritems(changes)
+                       if not is_added]
+            self.containers[key] = self._merge(self.containers.get(key),
+                                               added, removed)
+        self.staged = {}
+        return new_keys
+
+    def _merge(self, container, added, removed):
+        if isinstance(container, six.integer_types):
+            bits = (container & ~_ids_to_bits(removed)) | _ids_to_bits(added)
+            count = _count_bits(bits)
+            # switching back to array needs twice less ids to not flap
+            if count * DENSE_RATIO * 2 >= self.universe:
+                return bits
+            return array.array(ARRAY_TYPECODE, _iter_bits(bits))
+
+        ids = set(container or ())
+        ids.difference_update(removed)
+        ids.update(added)
+        if len(ids) * DENSE_RATIO > self.universe:
+            return _ids_to_bits(ids)
+        return array.array(ARRAY_TYPECODE, sorted(ids))
+
+    def get(self, keys):
+        bits = 0
+        sparse = []
+        for key in keys:
+            container = self.containers.get(key)
+            if isinstance(container, six.integer_types):
+                bits |= container
+            elif container:
+                sparse.append(container)
+        if sparse:
+            bits |= _ids_to_bits(i for container in sparse
+                                 for i in container)
+        return RecordIdSet(bits=bits)
+
+    def __getitem__(self, key):
+        return self.get([key])
+
+    def __contains__(self, key):
+        return key in self.containers
+
+    def __iter__(self):
+        return iter(self.containers)
+
+    def __len__(self):
+        return len(self.containers)
+
+    def keys(self):
+        return self.containers.keys()
+
+    def keys_intersecting(self, record_ids):
+        if not isinstance(record_ids, RecordIdSet):
+            record_ids = RecordIdSet(record_ids)
+        for key, container in six.iteritems(self.containers):
+            if isinstance(container, six.integer_types):
+                if container & record_ids.bits:
+                    yield key
+            elif any(i in record_ids for i in container):
+                yield key
+
+
+class DateIndex(object):
+    """Index from days to record ids ordered by day.
+
+    Record ids of all days are kept in one array sorted by day, with the
+    offset of every day, so that a range of days is a contiguous slice of
+    the array. Changes are staged and committed the same way as in
+    BitmapIndex.
+    """
+
+    def __init__(self):
+        self.days = array.array(DAY_TYPECODE)
+        self.offsets = array.array(OFFSET_TYPECODE, [0])
+        self.ids = array.array(ARRAY_TYPECODE)
+        self.all_bits = 0
+        # day -> {record_id: True if added, False if removed}
+        self.staged = {}
+
+    def copy(self):
+        """Return a copy that can be changed while this index is read.
+
+        Arrays are replaced rather than changed by commit(), so they are
+        shared.
+        """
+        result = DateIndex()
+        result.days, result.offsets, result.ids = (self.days, self.offsets,
+                                                   self.ids)
+        result.all_bits = self.all_bits
+        result.staged = dict((day, dict(changes)) for day, changes
+                             in six.iteritems(self.staged))
+        return result
+
+    def add(self, day, record_id):
+        self.staged.setdefault(day, {})[record_id] = True
+
+    def remove(self, day, record_id):
+        self.staged.setdefault(day, {})[record_id] = False
+
+    def _get_day_ids(self, n):
+        return self.ids[self.offsets[n]:self.offsets[n + 1]]
+
+    def _copy_days(self, begin, end, days, offsets, ids):
+        # unchanged days are copied in bulk, only their offsets are shifted
+        if begin >= end:
+            return
+        shift = len(ids) - self.offsets[begin]
+        days.extend(self.days[begin:end])
+        ids.extend(self.ids[self.offsets[begin]:self.offsets[end]])
+        day_offsets = self.offsets[begin + 1:end + 1]
+        if shift:
+            day_offsets = array.array(OFFSET_TYPECODE,
+                                      (offset + shift
+                                       for offset in day_offsets))
+        offsets.extend(day_offsets)
+
+    def commit(self):
+        if not self.staged:
+            return
+        days = array.array(DAY_TYPECODE)
+        offsets = array.array(OFFSET_TYPECODE, [0])
+        ids = array.array(ARRAY_TYPECODE)
+        added = []
+        removed = []
+
+        # only staged days are merged, new records usually go after the
+        # last day and the rest of the arrays is copied as is
+        n = 0
+        for day in sorted(self.staged):
+            pos = bisect.bisect_left(self.days, day)
+            self._copy_days(n, pos, days, offsets, ids)
+            merged = set()
+            n = pos
+            if pos < len(self.days) and self.days[pos] == day:
+                merged.update(self._get_day_ids(pos))
+                n = pos + 1
+            for record_id, is_added in six.iteritems(self.staged[day]):
+                if is_added:
+                    merged.add(record_id)
+                    added.append(record_id)
+                else:
+                    merged.discard(record_id)
+                    removed.append(record_id)
+            if merged:
+                days.append(day)
+                ids.extend(sorted(merged))
+                offsets.append(len(ids))
+        self._copy_days(n, len(self.days), days, offsets, ids)
+
+        # an id removed from one day may be added to another one
+        self.all_bits = ((self.all_bits & ~_ids_to_bits(removed)) |
+                         _ids_to_bits(added))
+        self.days, self.offsets, self.ids = days, offsets, ids
+        self.staged = {}
+
+    def _get_all_bits(self):
+        return self.all_bits
+
+    def get_range(self, start_day, end_day):
+        """Return ids of records from start_day to end_day inclusive."""
+        lo = bisect.bisect_left(self.days, start_day)
+        hi = bisect.bisect_right(self.days, end_day)
+        begin, end = self.offsets[lo], self.offsets[hi]
+        if (end - begin) * 2 <= len(self.ids):
+            return RecordIdSet(self.ids[begin:end])
+        # wide ranges are cheaper to take as all ids without the rest
+        return (RecordIdSet(bits=self._get_all_bits()) -
+                itertools.chain(self.ids[:begin], self.ids[end:]))
+
+    def get(self, days):
+        bits = 0
+        for day in days:
+            n = bisect.bisect_left(self.days, day)
+            if n < len(self.days) and self.days[n] == day:
+                bits |= _ids_to_bits(self._get_day_ids(n))
+        return RecordIdSet(bits=bits)
+
+    def __getitem__(self, day):
+        return self.get([day])
+
+    def __contains__(self, day):
+        n = bisect.bisect_left(self.days, day)
+        return n < len(self.days) and self.days[n] == day
+
+    def __iter__(self):
+        return iter(self.days)
+
+    def __len__(self):
+        return len(self.days)
+
+    def keys(self):
+        return list(self.days)
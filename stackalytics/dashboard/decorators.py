@@ -13,10 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import cProfile
 import functools
+import hashlib
 import json
 import operator
+import sys
 import time
 
 import flask
@@ -25,15 +28,23 @@ from oslo_log import log as logging
 import six
 from werkzeug import exceptions
 
+from stackalytics.dashboard import bitmap_index
 from stackalytics.dashboard import helpers
 from stackalytics.dashboard import parameters
+from stackalytics.dashboard import rollup
 from stackalytics.dashboard import vault
+from stackalytics.dashboard import warmup
 from stackalytics.processor import utils
 from stackalytics import version as stackalytics_version
 
 
 LOG = logging.getLogger(__name__)
 
+# parameters that select records regardless of their types
+FILTER_CACHE_PARAMETERS = ['release', 'project_type', 'module', 'user_id',
+                           'company', 'blueprint_id', 'start_date',
+                           'end_date']
+
 
 def _check_param_in(params, name, collection, allow_all=False):
     for single in (params.get(name) or []):
@@ -89,24 +100,47 @@ def _prepare_params(kwargs, ignore):
         return params
 
 
-def cached(ignore=None):
+def _get_record_types(params):
+    # record types the response depends on, None if it may depend on any
+    record_types = set()
+    for metric in params.get('metric') or ['all']:
+        if metric not in parameters.METRIC_TO_RECORD_TYPE:
+            return None
+        record_types.update(parameters.METRIC_TO_RECORD_TYPE[metric])
+    return record_types
+
+
+def _get_shared(key, compute):
+    vault_inst = vault.get_vault()
+    shared_cache_inst = vault_inst.get('shared_cache')
+    data_version = vault_inst.get('data_version')
+    if shared_cache_inst and data_version:
+        return shared_cache_inst.get_or_compute(key, data_version, compute)
+    return compute()
+
+
+def cached(ignore=None, ttl=None):
+    """Cache the response by request parameters until vault is updated.
+
+    Responses that depend on time rather than only on records are cached
+    for ttl seconds at most.
+    """
     def decorator(func):
         @functools.wraps(func)
         def prepare_params_decorated_function(*args, **kwargs):
 
             params = _prepare_params(kwargs, ignore)
+            warmup.record_query()
 
             cache_inst = vault.get_vault()['cache']
             key = json.dumps(params)
             value = cache_inst.get(key)
 
             if not value:
-                value = func(*args, **kwargs)
-                cache_inst[key] = value
-                vault.get_vault()['cache_size'] += len(key) + len(value)
+                value = _get_shared(key, lambda: func(*args, **kwargs))
+                cache_inst.set(key, value, _get_record_types(params), ttl)
                 LOG.debug('Cache size: %(size)d, entries: %(len)d',
-                          {'size': vault.get_vault()['cache_size'],
-                           'len': len(cache_inst.keys())})
+                          {'size': cache_inst.size, 'len': len(cache_inst)})
 
             return value
 
@@ -115,6 +149,16 @@ def cached(ignore=None):
     return decorator
 
 
+def _get_record_ids_size(record_ids):
+    # bitmaps take a bit per record id up to the largest one, sets take
+    # their hash table, ints are shared with the storage
+    if record_ids is None:
+        return 0
+    if isinstance(record_ids, bitmap_index.RecordIdSet):
+        return record_ids.bits.bit_length() // 8 + sys.getsizeof(0)
+    return sys.getsizeof(record_ids)
+
+
 def record_filter(ignore=None):
 
     def decorator(f):
@@ -132,11 +176,11 @@ def record_filter(ignore=None):
             start_day = utils.timestamp_to_day(start_date)
             end_day = utils.timestamp_to_day(end_date)
 
-            return memory_storage_inst.get_record_ids_by_days(
-                six.moves.range(start_day, end_day + 1))
+            return memory_storage_inst.get_record_ids_by_day_range(
+                start_day, end_day)
 
         def _filter_records_by_modules(memory_storage_inst, mr):
-            selected = set([])
+            selected = bitmap_index.RecordIdSet()
             for m, r in mr:
                 if r is None:
                     selected |= memory_storage_inst.get_record_ids_by_modules(
@@ -152,20 +196,20 @@ def record_filter(ignore=None):
                 return first & second
             return second
 
-        @functools.wraps(f)
-        def record_filter_decorated_function(*args, **kwargs):
-
-            memory_storage_inst = vault.get_memory_storage()
+        def _filter_records(memory_storage_inst, params):
             record_ids = None
-
-            params = _prepare_params(kwargs, ignore)
+            # the same filter over dimensions of the rollup cube, None if
+            # the filter can not be expressed by the cube
+            rollup_query = rollup.RollupQuery()
 
             release = params['release']
             if release:
                 if 'all' not in release:
+                    releases = [c.lower() for c in release]
                     record_ids = (
                         memory_storage_inst.get_record_ids_by_releases(
-                            c.lower() for c in release))
+                            releases))
+                    rollup_query.releases = set(releases)
 
             project_type = params['project_type']
             mr = None
@@ -182,6 +226,7 @@ def record_filter(ignore=None):
                 record_ids = _intersect(
                     record_ids, _filter_records_by_modules(
                         memory_storage_inst, mr))
+                rollup_query.module_releases = mr
 
             user_id = params['user_id']
             user_id = [u for u in user_id
@@ -190,12 +235,60 @@ def record_filter(ignore=None):
                 record_ids = _intersect(
                     record_ids,
                     memory_storage_inst.get_record_ids_by_user_ids(user_id))
+                rollup_query.user_ids = set(user_id)
 
             company = params['company']
             if company:
                 record_ids = _intersect(
                     record_ids,
                     memory_storage_inst.get_record_ids_by_companies(company))
+                rollup_query.companies = set(
+                    map(memory_storage_inst.get_original_company_name,
+                        company))
+
+            blueprint_id = params['blueprint_id']
+            if blueprint_id:
+                record_ids = _intersect(
+                    record_ids,
+                    memory_storage_inst.get_record_ids_by_blueprint_ids(
+                        blueprint_id))
+                rollup_query = None
+
+            start_date = params['start_date']
+            end_date = params['end_date']
+
+            if start_date or end_date:
+                record_ids = _intersect(
+                    record_ids, _filter_records_by_days(start_date, end_date,
+                                                        memory_storage_inst))
+                rollup_query = None
+
+            return record_ids, rollup_query
+
+        def _get_filtered_records(memory_storage_inst, params):
+            # endpoints and metrics that share the filter share its result
+            key = tuple((name, tuple(params[name] or ()))
+                        for name in FILTER_CACHE_PARAMETERS)
+            filter_cache = vault.get_vault()['filter_cache']
+            value = filter_cache.get(key)
+            if value is None:
+                value = _filter_records(memory_storage_inst, params)
+                filter_cache.set(key, value,
+                                 size=_get_record_ids_size(value[0]))
+            return value
+
+        @functools.wraps(f)
+        def record_filter_decorated_function(*args, **kwargs):
+
+            memory_storage_inst = vault.get_memory_storage()
+
+            params = _prepare_params(kwargs, ignore)
+
+            record_ids, rollup_query = _get_filtered_records(
+                memory_storage_inst, params)
+            if rollup_query is not None:
+                # the cached query is restricted by metric below
+                rollup_query = copy.copy(rollup_query)
 
             metric = params['metric']
             if 'all' not in metric:
@@ -205,6 +298,9 @@ def record_filter(ignore=None):
                             record_ids,
                             memory_storage_inst.get_record_ids_by_types(
                                 parameters.METRIC_TO_RECORD_TYPE[metric]))
+                        if rollup_query is not None:
+                            rollup_query.restrict_record_types(
+                                parameters.METRIC_TO_RECORD_TYPE[metric])
 
             if 'tm_marks' in metric:
                 filtered_ids = []
@@ -215,24 +311,11 @@ def record_filter(ignore=None):
                     if (parent and ('review_number' in parent) and
                             (parent['review_number'] <= review_nth)):
                         filtered_ids.append(record['record_id'])
-                record_ids = filtered_ids
-
-            blueprint_id = params['blueprint_id']
-            if blueprint_id:
-                record_ids = _intersect(
-                    record_ids,
-                    memory_storage_inst.get_record_ids_by_blueprint_ids(
-                        blueprint_id))
-
-            start_date = params['start_date']
-            end_date = params['end_date']
-
-            if start_date or end_date:
-                record_ids = _intersect(
-                    record_ids, _filter_records_by_days(start_date, end_date,
-                                                        memory_storage_inst))
+                record_ids = bitmap_index.RecordIdSet(filtered_ids)
+                rollup_query = None
 
             kwargs['record_ids'] = record_ids
+            kwargs['rollup_query'] = rollup_query
             kwargs['records'] = memory_storage_inst.get_records(record_ids)
 
             return f(*args, **kwargs)
@@ -503,11 +586,38 @@ def profiler_decorator(func):
     return profiler_decorated_function
 
 
-def response():
+def _get_etag():
+    # the response stays the same until the data, the code or the day
+    # change, time-dependent responses count time in days
+    data_version = vault.get_vault().get('data_version')
+    if not data_version:
+        return None
+    tag = '%s:%s:%s:%s' % (
+        data_version, stackalytics_version.version_info.version_string(),
+        utils.timestamp_to_day(utils.date_to_timestamp('now')),
+        flask.request.full_path)
+    return hashlib.md5(tag.encode('utf8')).hexdigest()
+
+
+def response(versioned=True):
+    """Make the response of JSON data with cache headers and ETag.
+
+    A versioned response depends only on the data and the request, so its
+    ETag is known before the response is made and a matching conditional
+    request is answered by 304 without making it. Other responses are
+    tagged by the digest of the body.
+    """
     def decorator(func):
         @functools.wraps(func)
         @profiler_decorator
         def response_decorated_function(*args, **kwargs):
+            etag = _get_etag() if versioned else None
+            if etag and flask.request.if_none_match.contains_weak(etag):
+                resp = flask.current_app.response_class(status=304)
+                resp.set_etag(etag)
+                _set_cache_headers(resp)
+                return resp
+
             callback = flask.app.request.args.get('callback', False)
             data = func(*args, **kwargs)
 
@@ -518,24 +628,31 @@ def response():
                 mimetype = 'application/json'
 
             resp = flask.current_app.response_class(data, mimetype=mimetype)
-            update_time = vault.get_vault()['vault_next_update_time']
-            now = utils.date_to_timestamp('now')
-            if now < update_time:
-                max_age = update_time - now
+            _set_cache_headers(resp)
+            if etag:
+                resp.set_etag(etag)
             else:
-                max_age = 0
-            resp.headers['cache-control'] = 'public, max-age=%d' % (max_age,)
-            resp.headers['expires'] = time.strftime(
-                '%a, %d %b %Y %H:%M:%S GMT',
-                time.gmtime(vault.get_vault()['vault_next_update_time']))
-            resp.headers['access-control-allow-origin'] = '*'
-            return resp
+                resp.add_etag()
+            return resp.make_conditional(flask.request)
 
         return response_decorated_function
 
     return decorator
 
 
+def _set_cache_headers(resp):
+    update_time = vault.get_vault()['vault_next_update_time']
+    now = utils.date_to_timestamp('now')
+    if now < update_time:
+        max_age = update_time - now
+    else:
+        max_age = 0
+    resp.headers['cache-control'] = 'public, max-age=%d' % (max_age,)
+    resp.headers['expires'] = time.strftime(
+        '%a, %d %b %Y %H:%M:%S GMT', time.gmtime(update_time))
+    resp.headers['access-control-allow-origin'] = '*'
+
+
 def query_filter(query_param='query'):
     def decorator(f):
         @functools.wraps(f)
@@ -0,0 +1,144 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Approximate memory used by structures of the dashboard vault.
+
+Sizes are deep: a structure is charged for every object reachable from it
+that has not been charged to a structure reported before it. Strings shared
+by records and indexes are therefore counted once, with records. Pages of
+a mapped snapshot are shared by workers and are not counted.
+"""
+
+import sys
+import types
+
+from oslo_config import cfg
+import six
+
+from stackalytics.dashboard import memory_storage
+from stackalytics.dashboard import vault
+from stackalytics.processor import config
+from stackalytics.processor import runtime_storage
+from stackalytics.processor import utils
+
+
+# objects that belong to the code rather than to the data
+_SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType,
+                  types.BuiltinFunctionType, types.MethodType)
+
+
+def get_size(obj, seen):
+    """Return the size of obj and of objects it refers to not in seen."""
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, _SKIPPED_TYPES):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+
+        if isinstance(o, dict):
+            stack.extend(six.iterkeys(o))
+            stack.extend(six.itervalues(o))
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif hasattr(o, '__dict__'):
+            stack.append(o.__dict__)
+        else:
+            stack.extend(getattr(o, name, None)
+                         for name in getattr(type(o), '__slots__', ()))
+    return size
+
+
+def _get_structures(vault_inst):
+    memory_storage_inst = vault_inst['memory_storage']
+    yield 'records', memory_storage_inst.records
+    yield 'primary_key_index', memory_storage_inst.primary_key_index
+    for name in sorted(memory_storage_inst.indexes):
+        yield 'indexes.%s' % name, memory_storage_inst.indexes[name]
+    for name in ['blueprint_id_index', 'day_index', 'module_release_index',
+                 'company_name_mapping', 'rollup']:
+        value = getattr(memory_storage_inst, name, None)
+        if value is not None:
+            yield name, value
+    for name in ['user_index', 'cache', 'filter_cache']:
+        if name in vault_inst:
+            yield name, vault_inst[name]
+
+
+def get_report(vault_inst):
+    """Return entry counts and sizes of vault structures and intern stats.
+
+    Structures are listed in the order they are charged, see get_size().
+    """
+    seen = set()
+    structures = []
+    for name, value in _get_structures(vault_inst):
+        structures.append({'name': name, 'entries': len(value),
+                           'size': get_size(value, seen)})
+
+    strings = vault.INTERN_STATS['strings']
+    hits = vault.INTERN_STATS['hits']
+    report = {
+        'structures': structures,
+        'total_size': sum(s['size'] for s in structures),
+        'intern': {'strings': strings, 'hits': hits,
+                   'hit_rate': float(hits) / strings if strings else 0.0},
+    }
+    for name in ['cache', 'filter_cache']:
+        if name in vault_inst:
+            report[name] = vault_inst[name].get_stats()
+    return report
+
+
+def format_report(report):
+    lines = ['%-32s %12s %14s' % ('structure', 'entries', 'size, bytes')]
+    for s in report['structures']:
+        lines.append('%-32s %12d %14d' % (s['name'], s['entries'], s['size']))
+    lines.append('%-32s %12s %14d' % ('total', '', report['total_size']))
+    intern = report['intern']
+    lines.append('interned strings: %d, already interned: %d (%.1f%%)' % (
+        intern['strings'], intern['hits'], intern['hit_rate'] * 100))
+    for name in ['cache', 'filter_cache']:
+        if name in report:
+            lines.append('%s: %s' % (name, ', '.join(
+                '%s %s' % item for item in sorted(report[name].items()))))
+    return '\n'.join(lines)
+
+
+def main():
+    utils.init_config_and_logging(config.CONNECTION_OPTS +
+                                  config.DASHBOARD_OPTS)
+
+    # records are loaded the same way as a dashboard worker loads them
+    vault_inst = {'runtime_storage': runtime_storage.get_runtime_storage(
+        cfg.CONF.runtime_storage_uri)}
+    if cfg.CONF.columnar_memory_storage:
+        memory_storage_type = memory_storage.MEMORY_STORAGE_COLUMNAR
+    else:
+        memory_storage_type = memory_storage.MEMORY_STORAGE_CACHED
+    vault_inst['memory_storage'] = memory_storage.get_memory_storage(
+        memory_storage_type, cfg.CONF.rollup_cube)
+    vault_inst['memory_storage'].update(vault.compact_records(
+        vault_inst['runtime_storage'].get_all_records()))
+    vault._reset_cache(vault_inst)
+    vault._init_user_index(vault_inst)
+
+    print(format_report(get_report(vault_inst)))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,12 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+
 import six
 
+from stackalytics.dashboard import bitmap_index
+from stackalytics.dashboard import record_columns
+from stackalytics.dashboard import rollup
 from stackalytics.processor import utils
 
 
 MEMORY_STORAGE_CACHED = 0
+MEMORY_STORAGE_COLUMNAR = 1
 
 
 class MemoryStorage(object):
@@ -27,24 +33,28 @@ class MemoryStorage(object):
 
 
 class CachedMemoryStorage(MemoryStorage):
-    def __init__(self):
+    def __init__(self, rollup_cube=True):
         super(CachedMemoryStorage, self).__init__()
 
         # common indexes
         self.records = {}
         self.primary_key_index = {}
-        self.record_types_index = {}
-        self.module_index = {}
-        self.user_id_index = {}
-        self.company_index = {}
-        self.release_index = {}
-        self.blueprint_id_index = {}
+        self.record_types_index = bitmap_index.BitmapIndex()
+        self.module_index = bitmap_index.BitmapIndex()
+        self.user_id_index = bitmap_index.BitmapIndex()
+        self.company_index = bitmap_index.BitmapIndex()
+        self.release_index = bitmap_index.BitmapIndex()
+        self.blueprint_id_index = bitmap_index.BitmapIndex()
         self.company_name_mapping = {}
-        self.day_index = {}
-        self.module_release_index = {}
+        self.day_index = bitmap_index.DateIndex()
+        self.module_release_index = bitmap_index.BitmapIndex()
+        self.rollup = rollup.RollupCube() if rollup_cube else None
+
+        # what the last update changed, None if not known
+        self.changed_record_types = None
+        self.new_index_keys = {}
 
         self.indexes = {
-            'primary_key': self.primary_key_index,
             'record_type': self.record_types_index,
             'company_name': self.company_index,
             'module': self.module_index,
@@ -52,71 +62,115 @@ class CachedMemoryStorage(MemoryStorage):
             'release': self.release_index,
         }
 
+    def copy(self):
+        """Return a copy that can be updated while this storage is read.
+
+        Records themselves are shared, only the containers are copied.
+        """
+        result = copy.copy(self)
+        result.records = self.records.copy()
+        result.primary_key_index = dict(self.primary_key_index)
+        for name in ['record_types_index', 'module_index', 'user_id_index',
+                     'company_index', 'release_index', 'blueprint_id_index',
+                     'day_index', 'module_release_index']:
+            setattr(result, name, getattr(self, name).copy())
+        if self.rollup is not None:
+            result.rollup = self.rollup.copy()
+        result.company_name_mapping = dict(self.company_name_mapping)
+        result.indexes = {
+            'record_type': result.record_types_index,
+            'company_name': result.company_index,
+            'module': result.module_index,
+            'user_id': result.user_id_index,
+            'release': result.release_index,
+        }
+        return result
+
+    def _commit_indexes(self):
+        self.new_index_keys = dict((name, index.commit())
+                                   for name, index
+                                   in six.iteritems(self.indexes))
+        for index in [self.blueprint_id_index, self.day_index,
+                      self.module_release_index]:
+            index.commit()
+
     def _save_record(self, record):
-        if (record.company_name == '*robots' and
-                record.record_type not in ['patch', 'review']):
-            return
         self.records[record.record_id] = record
+        self.primary_key_index[record.primary_key] = record.record_id
         for key, index in six.iteritems(self.indexes):
-            self._add_to_index(index, record, key)
+            index.add(getattr(record, key), record.record_id)
         for bp_id in (record.blueprint_id or []):
-            if bp_id in self.blueprint_id_index:
-                self.blueprint_id_index[bp_id].add(record.record_id)
-            else:
-                self.blueprint_id_index[bp_id] = set([record.record_id])
+            self.blueprint_id_index.add(bp_id, record.record_id)
 
         record_day = utils.timestamp_to_day(record.date)
-        if record_day in self.day_index:
-            self.day_index[record_day].add(record.record_id)
-        else:
-            self.day_index[record_day] = set([record.record_id])
+        self.day_index.add(record_day, record.record_id)
 
         mr = (record.module, record.release)
-        if mr in self.module_release_index:
-            self.module_release_index[mr].add(record.record_id)
-        else:
-            self.module_release_index[mr] = set([record.record_id])
+        self.module_release_index.add(mr, record.record_id)
+        if self.rollup is not None:
+            self.rollup.add(record)
 
     def update(self, records):
         have_updates = False
+        changed_record_types = set()
 
         for record in records:
             have_updates = True
             record_id = record.record_id
             if record_id in self.records:
                 # remove existing record from indexes
-                self._remove_record_from_index(self.records[record_id])
+                existing = self.records[record_id]
+                changed_record_types.add(existing.record_type)
+                self._remove_record_from_index(existing)
+            if (record.company_name == '*robots' and
+                    record.record_type not in ['patch', 'review']):
+                # the existing record is removed from indexes already
+                if record_id in self.records:
+                    del self.records[record_id]
+                continue
+            changed_record_types.add(record.record_type)
             self._save_record(record)
 
         if have_updates:
-            self.company_name_mapping = dict(
+            self._commit_indexes()
+            if self.rollup is not None:
+                self.rollup.refresh(self._get_last_record_id)
+            # only companies seen for the first time change the mapping
+            self.company_name_mapping.update(
                 (c.lower().replace('&', ''), c)
-                for c in self.company_index.keys())
+                for c in self.new_index_keys['company_name'])
+            self.changed_record_types = changed_record_types
 
         return have_updates
 
     def _remove_record_from_index(self, record):
+        if self.primary_key_index.get(record.primary_key) == record.record_id:
+            del self.primary_key_index[record.primary_key]
         for key, index in six.iteritems(self.indexes):
-            index[getattr(record, key)].remove(record.record_id)
+            index.remove(getattr(record, key), record.record_id)
+        for bp_id in (record.blueprint_id or []):
+            self.blueprint_id_index.remove(bp_id, record.record_id)
 
         record_day = utils.timestamp_to_day(record.date)
-        self.day_index[record_day].remove(record.record_id)
-        self.module_release_index[
-            (record.module, record.release)].remove(record.record_id)
-
-    def _add_to_index(self, record_index, record, key):
-        record_key = getattr(record, key)
-        if record_key in record_index:
-            record_index[record_key].add(record.record_id)
-        else:
-            record_index[record_key] = set([record.record_id])
+        self.day_index.remove(record_day, record.record_id)
+        self.module_release_index.remove(
+            (record.module, record.release), record.record_id)
+        if self.rollup is not None:
+            self.rollup.remove(record)
+
+    def _get_last_record_id(self, dimensions):
+        record_ids = (
+            self.module_release_index[(dimensions['module'],
+                                       dimensions['release'])] &
+            self.record_types_index[dimensions['record_type']] &
+            self.user_id_index[dimensions['user_id']])
+        return max([-1] + [record.record_id
+                           for record in self.get_records(record_ids)
+                           if all(getattr(record, field) == dimensions[field]
+                                  for field in rollup.FIELDS)])
 
     def _get_record_ids_from_index(self, items, index):
-        record_ids = set()
-        for item in items:
-            if item in index:
-                record_ids |= index[item]
-        return record_ids
+        return index.get(items)
 
     def get_record_ids_by_modules(self, modules):
         return self._get_record_ids_from_index(modules, self.module_index)
@@ -140,16 +194,14 @@ class CachedMemoryStorage(MemoryStorage):
     def get_record_ids_by_days(self, days):
         return self._get_record_ids_from_index(days, self.day_index)
 
+    def get_record_ids_by_day_range(self, start_day, end_day):
+        return self.day_index.get_range(start_day, end_day)
+
     def get_record_ids_by_module_release(self, module, release):
-        mr = (module, release)
-        if mr in self.module_release_index:
-            return self.module_release_index[mr]
-        return set()
+        return self.module_release_index[(module, release)]
 
     def get_index_keys_by_record_ids(self, index_name, record_ids):
-        return set(key
-                   for key, value in six.iteritems(self.indexes[index_name])
-                   if value & record_ids)
+        return set(self.indexes[index_name].keys_intersecting(record_ids))
 
     def get_record_ids(self):
         return self.records.keys()
@@ -163,10 +215,9 @@ class CachedMemoryStorage(MemoryStorage):
             yield self.records[i]
 
     def get_record_by_primary_key(self, primary_key):
-        if primary_key in self.primary_key_index:
-            record_id = list(self.primary_key_index[primary_key])
-            if record_id:
-                return self.records[record_id[0]]
+        record_id = self.primary_key_index.get(primary_key)
+        if record_id is not None:
+            return self.records.get(record_id)
         return None
 
     def get_original_company_name(self, company_name):
@@ -186,11 +237,25 @@ class CachedMemoryStorage(MemoryStorage):
         return self.user_id_index.keys()
 
     def get_first_record_day(self):
-        return min(self.day_index.keys())
+        return self.day_index.days[0]
+
+
+class ColumnarMemoryStorage(CachedMemoryStorage):
+    """Memory storage that keeps records in typed columns.
+
+    Records are returned as row views with the same fields as the records
+    passed to update().
+    """
+
+    def __init__(self, rollup_cube=True):
+        super(ColumnarMemoryStorage, self).__init__(rollup_cube)
+        self.records = record_columns.ColumnarRecords()
 
 
-def get_memory_storage(memory_storage_type):
+def get_memory_storage(memory_storage_type, rollup_cube=True):
     if memory_storage_type == MEMORY_STORAGE_CACHED:
-        return CachedMemoryStorage()
+        return CachedMemoryStorage(rollup_cube)
+    elif memory_storage_type == MEMORY_STORAGE_COLUMNAR:
+        return ColumnarMemoryStorage(rollup_cube)
     else:
         raise Exception('Unknown memory storage type %s' % memory_storage_type)
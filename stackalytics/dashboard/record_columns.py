@@ -0,0 +1,248 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import copy
+
+import six
+
+
+# fields with few distinct values are stored as codes into a dictionary
+CODED_FIELDS = ['record_type', 'company_name', 'module', 'user_id',
+                'release', 'author_name', 'type', 'status', 'disagreement']
+# 'q' is not available in Python 2.7, dates that do not fit 32-bit long are
+# kept aside as any other overflow
+INT_FIELDS = [('date', 'l'), ('week', 'i'), ('loc', 'i'), ('value', 'i')]
+OBJECT_FIELDS = ['primary_key', 'blueprint_id']
+
+MISSING_CODE = -1
+
+
+class CodedColumn(object):
+    """Column of values encoded as int codes into a dictionary of values.
+
+    Codes are assigned in the order values are first seen and never
+    change, so that codes can be used as group-by keys.
+    """
+
+    def __init__(self):
+        self.codes = array.array('i')
+        self.values = []
+        self.value_codes = {}
+
+    def copy(self):
+        result = copy.copy(self)
+        result.codes = array.array('i', self.codes)
+        result.values = list(self.values)
+        result.value_codes = dict(self.value_codes)
+        return result
+
+    def resize(self, size):
+        self.codes.extend([MISSING_CODE] * (size - len(self.codes)))
+
+    def encode(self, value):
+        code = self.value_codes.get(value)
+        if code is None:
+            code = self.value_codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def set(self, row, value):
+        self.codes[row] = self.encode(value)
+
+    def get(self, row):
+        return self.values[self.codes[row]]
+
+
+class IntColumn(object):
+    """Column of integers in a typed array.
+
+    None is stored as the smallest value of the type. Values that do not fit
+    the type are kept aside and marked by the next smallest value.
+    """
+
+    def __init__(self, typecode):
+        self.typecode = typecode
+        self.data = array.array(typecode)
+        bits = self.data.itemsize * 8
+        self.null = -2 ** (bits - 1)
+        self.max = 2 ** (bits - 1) - 1
+        self.overflow_mark = self.null + 1
+        self.overflow = {}
+
+    def copy(self):
+        result = copy.copy(self)
+        result.data = array.array(self.typecode, self.data)
+        result.overflow = dict(self.overflow)
+        return result
+
+    def resize(self, size):
+        self.data.extend([self.null] * (size - len(self.data)))
+
+    def set(self, row, value):
+        self.overflow.pop(row, None)
+        if value is None:
+            self.data[row] = self.null
+        elif (type(value) in six.integer_types and
+                self.overflow_mark < value <= self.max):
+            self.data[row] = value
+        else:
+            self.data[row] = self.overflow_mark
+            self.overflow[row] = value
+
+    def get(self, row):
+        value = self.data[row]
+        if value == self.null:
+            return None
+        if value == self.overflow_mark:
+            return self.overflow[row]
+        return value
+
+
+class ObjectColumn(object):
+    def __init__(self):
+        self.data = []
+
+    def copy(self):
+        result = copy.copy(self)
+        result.data = list(self.data)
+        return result
+
+    def resize(self, size):
+        self.data.extend([None] * (size - len(self.data)))
+
+    def set(self, row, value):
+        self.data[row] = value
+
+    def get(self, row):
+        return self.data[row]
+
+
+class RecordRow(object):
+    """Read-only view of a record stored in ColumnarRecords.
+
+    Fields are accessed as attributes, the same way as fields of the
+    CompactRecord tuples produced by the vault.
+    """
+
+    __slots__ = ('_records', 'record_id')
+
+    def __init__(self, records, record_id):
+        self._records = records
+        self.record_id = record_id
+
+    def _asdict(self):
+        result = dict((field, self._records.get_value(field, self.record_id))
+                      for field in self._records.columns)
+        result['record_id'] = self.record_id
+        return result
+
+    def __eq__(self, other):
+        return (isinstance(other, RecordRow) and
+                self._records is other._records and
+                self.record_id == other.record_id)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.record_id)
+
+    def __repr__(self):
+        return 'RecordRow(%s)' % self._asdict()
+
+
+def _make_field_getter(field):
+    def getter(row):
+        return row._records.get_value(field, row.record_id)
+    return getter
+
+
+for _field in CODED_FIELDS + [f for f, t in INT_FIELDS] + OBJECT_FIELDS:
+    setattr(RecordRow, _field, property(_make_field_getter(_field)))
+
+
+class ColumnarRecords(object):
+    """Mapping of record id to record that keeps fields in columns.
+
+    The record id is the row number, record ids are dense so the gaps cost
+    only a few bytes per column. Stored records are returned as RecordRow
+    views.
+    """
+
+    def __init__(self):
+        self.columns = dict((field, CodedColumn()) for field in CODED_FIELDS)
+        self.columns.update((field, IntColumn(typecode))
+                            for field, typecode in INT_FIELDS)
+        self.columns.update((field, ObjectColumn())
+                            for field in OBJECT_FIELDS)
+        self.present = bytearray()
+        self.count = 0
+
+    def copy(self):
+        result = copy.copy(self)
+        result.columns = dict((field, column.copy())
+                              for field, column in six.iteritems(self.columns))
+        result.present = bytearray(self.present)
+        return result
+
+    def _resize(self, size):
+        if size <= len(self.present):
+            return
+        # grow geometrically, so that appends are amortized
+        size = max(size, len(self.present) * 5 // 4)
+        self.present.extend(bytearray(size - len(self.present)))
+        for column in six.itervalues(self.columns):
+            column.resize(size)
+
+    def __setitem__(self, record_id, record):
+        self._resize(record_id + 1)
+        for field, column in six.iteritems(self.columns):
+            column.set(record_id, getattr(record, field))
+        if not self.present[record_id]:
+            self.present[record_id] = 1
+            self.count += 1
+
+    def __delitem__(self, record_id):
+        if record_id not in self:
+            raise KeyError(record_id)
+        self.present[record_id] = 0
+        self.count -= 1
+
+    def __contains__(self, record_id):
+        return (0 <= record_id < len(self.present) and
+                bool(self.present[record_id]))
+
+    def __getitem__(self, record_id):
+        if record_id not in self:
+            raise KeyError(record_id)
+        return RecordRow(self, record_id)
+
+    def get(self, record_id, default=None):
+        if record_id not in self:
+            return default
+        return RecordRow(self, record_id)
+
+    def get_value(self, field, record_id):
+        return self.columns[field].get(record_id)
+
+    def keys(self):
+        return [n for n, present in enumerate(self.present) if present]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.count
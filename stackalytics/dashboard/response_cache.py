@@ -0,0 +1,138 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import copy
+import threading
+import time
+
+import six
+
+
+class CacheEntry(object):
+    __slots__ = ['value', 'size', 'record_types', 'expires']
+
+    def __init__(self, value, size, record_types, expires):
+        self.value = value
+        self.size = size
+        # record types the value depends on, None if it may depend on any
+        self.record_types = record_types
+        self.expires = expires
+
+
+class ResponseCache(object):
+    """LRU cache of responses bounded by total size and number of entries.
+
+    The size of an entry is the length of its key and value unless it is
+    given explicitly. Limits that are 0 or None are not enforced. The cache
+    is shared by request threads and the warm-up thread.
+    """
+
+    def __init__(self, max_size=None, max_entries=None):
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                      'expirations': 0, 'invalidations': 0}
+        self.lock = threading.Lock()
+
+    def copy(self):
+        """Return a copy that can be changed while this cache is used."""
+        with self.lock:
+            result = copy.copy(self)
+            result.entries = collections.OrderedDict(self.entries)
+            result.stats = dict(self.stats)
+        result.lock = threading.Lock()
+        return result
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry.expires and entry.expires < time.time():
+            self.size -= entry.size
+            self.stats['expirations'] += 1
+            entry = None
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        # the entry becomes the most recently used one
+        self.entries[key] = entry
+        self.stats['hits'] += 1
+        return entry.value
+
+    def set(self, key, value, record_types=None, ttl=None, size=None):
+        with self.lock:
+            self._set(key, value, record_types, ttl, size)
+
+    def _set(self, key, value, record_types, ttl, size):
+        self._remove(key)
+        if size is None:
+            size = len(key) + len(value)
+        if self.max_size and size > self.max_size:
+            return
+        expires = time.time() + ttl if ttl else None
+        self.entries[key] = CacheEntry(value, size, record_types, expires)
+        self.size += size
+
+        while ((self.max_size and self.size > self.max_size) or
+               (self.max_entries and len(self.entries) > self.max_entries)):
+            evicted = self.entries.popitem(last=False)[1]
+            self.size -= evicted.size
+            self.stats['evictions'] += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+        return entry
+
+    def invalidate(self, record_types=None):
+        """Remove entries that depend on any of record_types, or all."""
+        with self.lock:
+            self._invalidate(record_types)
+
+    def _invalidate(self, record_types):
+        if record_types is None:
+            removed = len(self.entries)
+            self.entries.clear()
+            self.size = 0
+        else:
+            keys = [key for key, entry in six.iteritems(self.entries)
+                    if entry.record_types is None or
+                    entry.record_types & record_types]
+            for key in keys:
+                self._remove(key)
+            removed = len(keys)
+        self.stats['invalidations'] += removed
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries),
+                        size=self.size, max_entries=self.max_entries,
+                        max_size=self.max_size)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
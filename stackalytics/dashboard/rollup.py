@@ -0,0 +1,189 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rollup of record counts and lines of code by record dimensions.
+
+The cube is maintained by memory storage as records are saved and removed,
+so that stats and timeline can be summed over cells instead of records.
+Queries that filter by anything but the dimensions of the cube, e.g. by
+dates or blueprints, are answered by iteration over records.
+"""
+
+import six
+
+
+# cells are grouped by release and record type, since most of queries
+# select a single record type and either one or all releases
+GROUP_FIELDS = ('release', 'record_type')
+CELL_FIELDS = ('week', 'module', 'company_name', 'user_id', 'author_name')
+FIELDS = GROUP_FIELDS + CELL_FIELDS
+
+COUNT = 0
+LOC = 1
+LAST_RECORD_ID = 2
+
+
+class RollupQuery(object):
+    """Filter over dimensions of the cube, None means any value."""
+
+    def __init__(self):
+        self.releases = None
+        self.record_types = None
+        self.module_releases = None  # set of (module, release or None)
+        self.user_ids = None
+        self.companies = None
+
+    def restrict_record_types(self, record_types):
+        record_types = set(record_types)
+        if self.record_types is not None:
+            record_types &= self.record_types
+        self.record_types = record_types
+
+    def match_group(self, release, record_type):
+        return ((self.releases is None or release in self.releases) and
+                (self.record_types is None or
+                 record_type in self.record_types))
+
+    def match_cell(self, release, key):
+        week, module, company_name, user_id, author_name = key
+        if self.module_releases is not None:
+            if ((module, None) not in self.module_releases and
+                    (module, release) not in self.module_releases):
+                return False
+        return ((self.user_ids is None or user_id in self.user_ids) and
+                (self.companies is None or company_name in self.companies))
+
+
+class RollupCube(object):
+    def __init__(self):
+        # (release, record_type) -> {(week, module, ...): (count, loc, id)}
+        self.groups = {}
+        # groups that are not shared with other copies of the cube
+        self._owned = set()
+        # cells whose last record is removed, {(group_key, cell_key)}
+        self.stale = set()
+
+    def copy(self):
+        """Return a copy that can be changed while this cube is read.
+
+        Groups are copied on the first change, cells are never changed in
+        place.
+        """
+        result = RollupCube()
+        result.groups = dict(self.groups)
+        result.stale = set(self.stale)
+        return result
+
+    def _get_group(self, group_key):
+        group = self.groups.get(group_key)
+        if group_key not in self._owned:
+            group = self.groups[group_key] = dict(group or {})
+            self._owned.add(group_key)
+        return group
+
+    @staticmethod
+    def _get_keys(record):
+        return ((record.release, record.record_type),
+                (record.week, record.module, record.company_name,
+                 record.user_id, record.author_name))
+
+    def add(self, record):
+        group_key, cell_key = self._get_keys(record)
+        group = self._get_group(group_key)
+        count, loc, last_record_id = group.get(cell_key, (0, 0, -1))
+        if record.record_id >= last_record_id:
+            # the last record is known again, e.g. it is updated in place
+            self.stale.discard((group_key, cell_key))
+        group[cell_key] = (count + 1, loc + (record.loc or 0),
+                           max(last_record_id, record.record_id))
+
+    def remove(self, record):
+        group_key, cell_key = self._get_keys(record)
+        if cell_key not in self.groups.get(group_key, {}):
+            return
+        group = self._get_group(group_key)
+        count, loc, last_record_id = group[cell_key]
+        if count > 1:
+            group[cell_key] = (count - 1, loc - (record.loc or 0),
+                               last_record_id)
+            if record.record_id == last_record_id:
+                self.stale.add((group_key, cell_key))
+        else:
+            del group[cell_key]
+            self.stale.discard((group_key, cell_key))
+            if not group:
+                del self.groups[group_key]
+                self._owned.discard(group_key)
+
+    def refresh(self, get_last_record_id):
+        """Recompute the last record of cells whose last record is removed.
+
+        get_last_record_id(dimensions) returns the largest id of records
+        with the given dimensions.
+        """
+        for group_key, cell_key in self.stale:
+            group = self._get_group(group_key)
+            count, loc, last_record_id = group[cell_key]
+            group[cell_key] = (count, loc, get_last_record_id(
+                dict(zip(FIELDS, group_key + cell_key))))
+        self.stale = set()
+
+    def select(self, query):
+        """Yield dict of dimensions and the cell for every matching cell."""
+        for group_key, group in six.iteritems(self.groups):
+            if not query.match_group(*group_key):
+                continue
+            release = group_key[0]
+            for cell_key, cell in six.iteritems(group):
+                if query.match_cell(release, cell_key):
+                    yield dict(zip(FIELDS, group_key + cell_key)), cell
+
+    def aggregate(self, query, param_id, param_title, metric=COUNT):
+        """Sum count or loc by param_id, same as aggregation over records.
+
+        The name of the group is the param_title of its last record.
+        """
+        result = {}
+        last_ids = {}
+        for dimensions, cell in self.select(query):
+            key = dimensions[param_id]
+            row = result.get(key)
+            if row is None:
+                row = result[key] = {'metric': 0, 'id': key}
+                last_ids[key] = -1
+            row['metric'] += cell[metric]
+            if cell[LAST_RECORD_ID] > last_ids[key]:
+                last_ids[key] = cell[LAST_RECORD_ID]
+                row['name'] = dimensions[param_title]
+        return result
+
+    def timeline(self, query, start_week, end_week, release_name):
+        """Return dicts of loc, count and count in release by week."""
+        weeks = six.moves.range(start_week, end_week)
+        week_stat_loc = dict((c, 0) for c in weeks)
+        week_stat_commits = dict((c, 0) for c in weeks)
+        week_stat_commits_hl = dict((c, 0) for c in weeks)
+
+        for dimensions, cell in self.select(query):
+            week = dimensions['week']
+            if start_week <= week < end_week:
+                week_stat_loc[week] += cell[LOC]
+                week_stat_commits[week] += cell[COUNT]
+                if dimensions['release'] == release_name:
+                    week_stat_commits_hl[week] += cell[COUNT]
+        return week_stat_loc, week_stat_commits, week_stat_commits_hl
+
+    def __len__(self):
+        return sum(len(group) for group in six.itervalues(self.groups))
@@ -0,0 +1,79 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Response cache shared by dashboard workers through memcached.
+
+Responses are keyed by request parameters and the version of data the
+worker serves, so that a worker never reads a response computed from other
+data. When several workers miss the same key, one of them computes the
+response while the others wait for it.
+"""
+
+import hashlib
+import time
+
+from oslo_log import log as logging
+
+from stackalytics.processor import runtime_storage
+
+
+LOG = logging.getLogger(__name__)
+
+KEY_PREFIX = 'response:'
+LOCK_SUFFIX = ':lock'
+POLL_INTERVAL = 0.1
+MIN_COMPRESS_LEN = 64 * 1024
+
+
+class SharedCache(object):
+    def __init__(self, uri, ttl, lock_timeout):
+        self.memcached = runtime_storage.make_memcached_client(uri)
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+
+    def _make_key(self, key, version):
+        # memcached keys are limited in length and may not contain spaces
+        return '%s%s:%s' % (KEY_PREFIX, version,
+                            hashlib.md5(key.encode('utf8')).hexdigest())
+
+    def get_or_compute(self, key, version, compute):
+        """Return the shared response or compute and share it."""
+        shared_key = self._make_key(key, version)
+        value = self.memcached.get(shared_key)
+        if value is not None:
+            return value
+
+        lock_key = shared_key + LOCK_SUFFIX
+        if self.memcached.add(lock_key, 1, time=self.lock_timeout):
+            try:
+                value = compute()
+                if not self.memcached.set(shared_key, value, time=self.ttl,
+                                          min_compress_len=MIN_COMPRESS_LEN):
+                    LOG.debug('Response is not shared, key %s', key)
+            finally:
+                self.memcached.delete(lock_key)
+            return value
+
+        # another worker computes the response
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+            value = self.memcached.get(shared_key)
+            if value is not None:
+                return value
+            if self.memcached.get(lock_key) is None:
+                # the worker has failed, or memcached is not available
+                break
+        return compute()
@@ -0,0 +1,536 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Read-only snapshot of memory storage shared by dashboard workers.
+
+One loader process (stackalytics-snapshot) keeps records in columnar memory
+storage and writes them with all indexes into a snapshot file. Dashboard
+workers map the file into memory and read columns and index containers
+directly from the mapping, so the pages are shared by all workers and the
+memory does not grow with the number of workers. Only dictionaries of
+coded values and index keys are unpickled by every worker.
+
+The file is written aside and renamed over the previous one, so that
+workers never see a partial snapshot and switch to the new one atomically.
+
+Python 2.7 can not cast a memoryview to a typed one, there sections are
+copied out of the mapping and are not shared by workers.
+
+Layout: magic, aligned data sections, pickled metadata with offsets of
+the sections, offset of the metadata as a 64-bit integer.
+"""
+
+import array
+import mmap
+import os
+import pickle
+import struct
+
+from oslo_log import log as logging
+import six
+
+from stackalytics.dashboard import bitmap_index
+from stackalytics.dashboard import memory_storage
+from stackalytics.dashboard import record_columns
+
+
+LOG = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'STKSNAP1'
+ALIGNMENT = 8
+TRAILER = struct.Struct('<Q')
+OFFSET_TYPECODE = bitmap_index.OFFSET_TYPECODE
+
+INDEX_ATTRIBUTES = ['record_types_index', 'module_index', 'user_id_index',
+                    'company_index', 'release_index', 'blueprint_id_index',
+                    'module_release_index']
+
+
+if hasattr(array.array, 'tobytes'):
+    def _array_to_bytes(a):
+        return a.tobytes()
+
+    def _array_from_bytes(a, data):
+        a.frombytes(data)
+else:
+    def _array_to_bytes(a):
+        return a.tostring()
+
+    def _array_from_bytes(a, data):
+        a.fromstring(data)
+
+
+class _SectionWriter(object):
+    def __init__(self, fd):
+        self.fd = fd
+        self.offset = 0
+        self._write(SNAPSHOT_MAGIC)
+
+    def _write(self, data):
+        self.fd.write(data)
+        self.offset += len(data)
+
+    def add(self, data):
+        padding = -self.offset % ALIGNMENT
+        if padding:
+            self._write(b'\x00' * padding)
+        offset = self.offset
+        self._write(data)
+        return offset, len(data)
+
+    def add_strings(self, strings):
+        blob = bytearray()
+        offsets = array.array(OFFSET_TYPECODE, [0])
+        for s in strings:
+            blob.extend(s.encode('utf8') if s is not None else b'')
+            offsets.append(len(blob))
+        return {'blob': self.add(bytes(blob)),
+                'offsets': self.add(_array_to_bytes(offsets))}
+
+
+def _write_column(writer, column):
+    if isinstance(column, record_columns.CodedColumn):
+        return {'kind': 'coded', 'values': column.values,
+                'codes': writer.add(_array_to_bytes(column.codes))}
+    if isinstance(column, record_columns.IntColumn):
+        return {'kind': 'int', 'typecode': column.typecode,
+                'overflow': column.overflow,
+                'data': writer.add(_array_to_bytes(column.data))}
+    if all(v is None or isinstance(v, six.text_type) for v in column.data):
+        return dict(writer.add_strings(column.data), kind='string')
+    return {'kind': 'object',
+            'values': dict((row, value) for row, value
+                           in enumerate(column.data) if value is not None)}
+
+
+def _write_index(writer, index):
+    result = {}
+    for key, container in six.iteritems(index.containers):
+        if isinstance(container, six.integer_types):
+            location = writer.add(
+                bitmap_index.RecordIdSet(bits=container).to_bytes())
+            result[key] = ('bitmap',) + location
+        else:
+            result[key] = ('array',) + writer.add(
+                _array_to_bytes(container))
+    return result
+
+
+def _write_date_index(writer, index):
+    return {'days': writer.add(_array_to_bytes(index.days)),
+            'offsets': writer.add(_array_to_bytes(index.offsets)),
+            'ids': writer.add(_array_to_bytes(index.ids)),
+            'all': writer.add(bitmap_index.RecordIdSet(
+                bits=index.all_bits).to_bytes())}
+
+
+def _get_columnar_records(records):
+    if isinstance(records, record_columns.ColumnarRecords):
+        return records
+    columnar = record_columns.ColumnarRecords()
+    for record_id in sorted(records.keys()):
+        columnar[record_id] = records[record_id]
+    return columnar
+
+
+def write_snapshot(memory_storage_inst, path, update_position=None):
+    """Write records and indexes of the memory storage into the file.
+
+    update_position is the position in the update log of runtime storage
+    the records are loaded up to, readers that load the snapshot continue
+    polling updates from it.
+    """
+    records = _get_columnar_records(memory_storage_inst.records)
+    primary_keys = sorted(memory_storage_inst.primary_key_index.items())
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as fd:
+        writer = _SectionWriter(fd)
+        meta = {
+            'count': records.count,
+            'present': writer.add(bytes(records.present)),
+            'columns': dict((field, _write_column(writer, column))
+                            for field, column
+                            in six.iteritems(records.columns)),
+            'indexes': dict((name, _write_index(
+                writer, getattr(memory_storage_inst, name)))
+                for name in INDEX_ATTRIBUTES),
+            'day_index': _write_date_index(writer,
+                                           memory_storage_inst.day_index),
+            'primary_keys': writer.add_strings(pk for pk, i in primary_keys),
+            'primary_key_ids': writer.add(_array_to_bytes(array.array(
+                OFFSET_TYPECODE, (i for pk, i in primary_keys)))),
+            'company_name_mapping': memory_storage_inst.company_name_mapping,
+            'update_position': update_position,
+        }
+        if getattr(memory_storage_inst, 'rollup', None) is not None:
+            # loaded only by readers that keep their own copy of records
+            meta['rollup'] = writer.add(pickle.dumps(
+                memory_storage_inst.rollup.groups, 2))
+        meta_offset = writer.add(pickle.dumps(meta, 2))[0]
+        writer.add(TRAILER.pack(meta_offset))
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.rename(tmp_path, path)
+
+
+def get_version(path):
+    """Return what identifies the snapshot currently at the path."""
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+class StringColumn(object):
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def get(self, row):
+        start, end = self.offsets[row], self.offsets[row + 1]
+        if start == end:
+            return None
+        return bytes(self.blob[start:end]).decode('utf8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class SparseObjectColumn(object):
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, row):
+        return self.values.get(row)
+
+
+class MappedRecords(record_columns.ColumnarRecords):
+    """ColumnarRecords with columns read from a snapshot mapping."""
+
+    def __init__(self, view, meta):
+        self.present = _section(view, meta['present'])
+        self.count = meta['count']
+        self.columns = dict((field, _read_column(view, column_meta))
+                            for field, column_meta
+                            in six.iteritems(meta['columns']))
+
+    def __setitem__(self, record_id, record):
+        raise TypeError('Snapshot records are read-only')
+
+
+def _section(view, location, typecode='B'):
+    offset, length = location
+    section = view[offset:offset + length]
+    if not hasattr(section, 'cast'):
+        # Python 2.7, the slice of mapping is a copy already
+        if typecode == 'B':
+            return bytearray(section)
+        result = array.array(typecode)
+        _array_from_bytes(result, section)
+        return result
+    if typecode != 'B':
+        section = section.cast(typecode)
+    return section
+
+
+def _read_strings(view, meta):
+    return StringColumn(_section(view, meta['blob']),
+                        _section(view, meta['offsets'], OFFSET_TYPECODE))
+
+
+def _read_column(view, meta):
+    if meta['kind'] == 'coded':
+        column = record_columns.CodedColumn()
+        column.codes = _section(view, meta['codes'], 'i')
+        column.values = meta['values']
+        column.value_codes = dict((value, code) for code, value
+                                  in enumerate(column.values))
+    elif meta['kind'] == 'int':
+        column = record_columns.IntColumn(meta['typecode'])
+        column.data = _section(view, meta['data'], meta['typecode'])
+        column.overflow = meta['overflow']
+    elif meta['kind'] == 'string':
+        column = _read_strings(view, meta)
+    else:
+        column = SparseObjectColumn(meta['values'])
+    return column
+
+
+class MappedIndex(object):
+    """BitmapIndex with containers read from a snapshot mapping.
+
+    Bitmaps are turned into ints only while a query runs, so the memory
+    they take is not kept per worker.
+    """
+
+    def __init__(self, view, containers):
+        self.view = view
+        self.containers = containers
+
+    def _get_container(self, key):
+        kind, offset, length = self.containers[key]
+        if kind == 'bitmap':
+            return bitmap_index.RecordIdSet.from_bytes(
+                self.view[offset:offset + length])
+        return _section(self.view, (offset, length),
+                        bitmap_index.ARRAY_TYPECODE)
+
+    def get(self, keys):
+        result = bitmap_index.RecordIdSet()
+        sparse = []
+        for key in keys:
+            if key not in self.containers:
+                continue
+            container = self._get_container(key)
+            if isinstance(container, bitmap_index.RecordIdSet):
+                result |= container
+            else:
+                sparse.append(container)
+        if sparse:
+            result |= bitmap_index.RecordIdSet(
+                i for container in sparse for i in container)
+        return result
+
+    def __getitem__(self, key):
+        return self.get([key])
+
+    def __contains__(self, key):
+        return key in self.containers
+
+    def __iter__(self):
+        return iter(self.containers)
+
+    def __len__(self):
+        return len(self.containers)
+
+    def keys(self):
+        return self.containers.keys()
+
+    def keys_intersecting(self, record_ids):
+        if not isinstance(record_ids, bitmap_index.RecordIdSet):
+            record_ids = bitmap_index.RecordIdSet(record_ids)
+        for key in self.containers:
+            container = self._get_container(key)
+            if isinstance(container, bitmap_index.RecordIdSet):
+                if container & record_ids:
+                    yield key
+            elif any(i in record_ids for i in container):
+                yield key
+
+
+class MappedDateIndex(bitmap_index.DateIndex):
+    """DateIndex with arrays read from a snapshot mapping."""
+
+    def __init__(self, view, meta):
+        super(MappedDateIndex, self).__init__()
+        self.days = _section(view, meta['days'], bitmap_index.DAY_TYPECODE)
+        self.offsets = _section(view, meta['offsets'],
+                                bitmap_index.OFFSET_TYPECODE)
+        self.ids = _section(view, meta['ids'], bitmap_index.ARRAY_TYPECODE)
+        self.all_bitmap = _section(view, meta['all'])
+
+    def _get_all_bits(self):
+        return bitmap_index.RecordIdSet.from_bytes(self.all_bitmap).bits
+
+    def commit(self):
+        raise TypeError('Snapshot indexes are read-only')
+
+
+class MappedKeyIndex(object):
+    """Primary key to record id lookup by binary search over sorted keys."""
+
+    def __init__(self, keys, ids):
+        self.keys = keys
+        self.ids = ids
+
+    def _key_at(self, n):
+        return self.keys.get(n)
+
+    def get(self, primary_key, default=None):
+        lo, hi = 0, len(self.keys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < primary_key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.keys) and self._key_at(lo) == primary_key:
+            return self.ids[lo]
+        return default
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class MappedMemoryStorage(memory_storage.CachedMemoryStorage):
+    """Read-only memory storage over a snapshot file."""
+
+    def __init__(self, path):
+        super(MappedMemoryStorage, self).__init__()
+
+        with open(path, 'rb') as fd:
+            stat = os.fstat(fd.fileno())
+            self.version = stat.st_ino, stat.st_mtime, stat.st_size
+            self.mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Python 2.7 mmap does not support memoryview, slices of it are
+        # copied instead
+        view = memoryview(self.mmap) if six.PY3 else self.mmap
+        if bytes(view[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+            raise ValueError('File %s is not a snapshot' % path)
+        meta_offset = TRAILER.unpack(bytes(view[-TRAILER.size:]))[0]
+        meta = pickle.loads(bytes(view[meta_offset:-TRAILER.size]))
+
+        self.records = MappedRecords(view, meta)
+        for name in INDEX_ATTRIBUTES:
+            setattr(self, name, MappedIndex(view, meta['indexes'][name]))
+        self.day_index = MappedDateIndex(view, meta['day_index'])
+        self.primary_key_index = MappedKeyIndex(
+            _read_strings(view, meta['primary_keys']),
+            _section(view, meta['primary_key_ids'], OFFSET_TYPECODE))
+        self.company_name_mapping = meta['company_name_mapping']
+        self.update_position = meta.get('update_position')
+        self.view = view
+        self.meta = meta
+        # the cube is made of Python objects that can not be shared, so
+        # queries over the snapshot are answered by records
+        self.rollup = None
+
+        self.indexes = {
+            'record_type': self.record_types_index,
+            'company_name': self.company_index,
+            'module': self.module_index,
+            'user_id': self.user_id_index,
+            'release': self.release_index,
+        }
+
+    def update(self, records):
+        raise TypeError('Snapshot memory storage is read-only')
+
+
+def load_snapshot(path, version=None):
+    """Map the snapshot if the file differs from the given version.
+
+    Returns None if the snapshot is not changed or does not exist yet.
+    """
+    try:
+        if get_version(path) == version:
+            return None
+        return MappedMemoryStorage(path)
+    except (IOError, OSError, ValueError) as e:
+        LOG.warning('Snapshot %s is not available: %s', path, e)
+        return None
+
+
+def _copy_array(typecode, section):
+    if isinstance(section, array.array):
+        return array.array(typecode, section)
+    if isinstance(section, memoryview):
+        section = section.cast('B')
+    result = array.array(typecode)
+    _array_from_bytes(result, section)
+    return result
+
+
+def _copy_records(mapped, records, record_class):
+    if not isinstance(records, record_columns.ColumnarRecords):
+        record_ids = mapped.keys()
+        values = [record_ids if field == 'record_id' else
+                  [mapped.columns[field].get(i) for i in record_ids]
+                  for field in record_class._fields]
+        for row in six.moves.zip(*values):
+            records[row[0]] = record_class._make(row)
+        return
+
+    size = len(mapped.present)
+    records.present = bytearray(mapped.present)
+    records.count = mapped.count
+    for field, mapped_column in six.iteritems(mapped.columns):
+        column = records.columns[field]
+        if isinstance(column, record_columns.CodedColumn):
+            column.codes = _copy_array('i', mapped_column.codes)
+            column.values = list(mapped_column.values)
+            column.value_codes = dict(mapped_column.value_codes)
+        elif isinstance(column, record_columns.IntColumn):
+            column.data = _copy_array(column.typecode, mapped_column.data)
+            column.overflow = dict(mapped_column.overflow)
+        else:
+            column.data = [mapped_column.get(row)
+                           for row in six.moves.range(size)]
+
+
+def _copy_index(mapped, index):
+    for key, (kind, offset, length) in six.iteritems(mapped.containers):
+        section = mapped.view[offset:offset + length]
+        if kind == 'bitmap':
+            index.containers[key] = bitmap_index.RecordIdSet.from_bytes(
+                section).bits
+        else:
+            index.containers[key] = _copy_array(bitmap_index.ARRAY_TYPECODE,
+                                                section)
+
+
+def load_memory_storage(path, memory_storage_type, record_class,
+                        rollup_cube=True):
+    """Load the snapshot into memory storage that accepts updates.
+
+    Records of storages that keep them as tuples are made by record_class.
+    The rollup cube is loaded if rollup_cube is set.
+
+    Returns the memory storage and the position in the update log the
+    snapshot is made at, or None if the snapshot can not be loaded.
+    """
+    try:
+        mapped = MappedMemoryStorage(path)
+    except (IOError, OSError, ValueError) as e:
+        LOG.warning('Snapshot %s is not available: %s', path, e)
+        return None
+    if mapped.update_position is None:
+        LOG.warning('Snapshot %s is made without update position', path)
+        return None
+    if rollup_cube and 'rollup' not in mapped.meta:
+        LOG.warning('Snapshot %s is made without rollup cube', path)
+        return None
+
+    memory_storage_inst = memory_storage.get_memory_storage(
+        memory_storage_type, rollup_cube)
+    _copy_records(mapped.records, memory_storage_inst.records,
+                  record_class)
+    universe = len(bytes(mapped.records.present).rstrip(b'\x00'))
+    for name in INDEX_ATTRIBUTES:
+        index = getattr(memory_storage_inst, name)
+        _copy_index(getattr(mapped, name), index)
+        index.universe = universe
+
+    day_index = memory_storage_inst.day_index
+    mapped_day_index = mapped.day_index
+    day_index.days = _copy_array(bitmap_index.DAY_TYPECODE,
+                                 mapped_day_index.days)
+    day_index.offsets = _copy_array(bitmap_index.OFFSET_TYPECODE,
+                                    mapped_day_index.offsets)
+    day_index.ids = _copy_array(bitmap_index.ARRAY_TYPECODE,
+                                mapped_day_index.ids)
+    day_index.all_bits = mapped_day_index._get_all_bits()
+
+    keys = mapped.primary_key_index.keys
+    memory_storage_inst.primary_key_index = dict(
+        (keys.get(n), record_id) for n, record_id
+        in enumerate(mapped.primary_key_index.ids))
+    memory_storage_inst.company_name_mapping = dict(
+        mapped.company_name_mapping)
+    if rollup_cube:
+        memory_storage_inst.rollup.groups = pickle.loads(
+            bytes(_section(mapped.view, mapped.meta['rollup'])))
+
+    return memory_storage_inst, mapped.update_position
@@ -0,0 +1,98 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from stackalytics.dashboard import memory_storage
+from stackalytics.dashboard import snapshot
+from stackalytics.dashboard import vault
+from stackalytics.processor import config
+from stackalytics.processor import runtime_storage
+from stackalytics.processor import utils
+
+
+LOG = logging.getLogger(__name__)
+
+
+def load(runtime_storage_inst, memory_storage_inst, paths, epoch=None,
+         force=False):
+    """Apply updates of the next epoch and write snapshots if needed.
+
+    Returns the epoch that has been applied.
+    """
+    current_epoch = runtime_storage_inst.get_epoch()
+    if current_epoch and current_epoch == epoch and not force:
+        runtime_storage_inst.touch_pid(os.getpid())
+        return epoch
+
+    # the loader polls the update log the same way as a dashboard worker
+    have_updates = memory_storage_inst.update(vault.compact_records(
+        runtime_storage_inst.get_update(os.getpid())))
+    if have_updates or force:
+        update_position = runtime_storage_inst.get_update_position(
+            os.getpid())
+        for path in paths:
+            start = time.time()
+            snapshot.write_snapshot(memory_storage_inst, path,
+                                    update_position)
+            LOG.info('Snapshot of %d records is written to %s in %.1f s',
+                     len(memory_storage_inst.records), path,
+                     time.time() - start)
+    return current_epoch
+
+
+def load_periodically(runtime_storage_inst, memory_storage_inst, paths,
+                      interval):
+    epoch = None
+    force = True
+    while True:
+        try:
+            epoch = load(runtime_storage_inst, memory_storage_inst, paths,
+                         epoch, force)
+            force = False
+        except Exception as e:
+            # the next attempt polls the updates that have not been applied
+            LOG.error('Failed to load snapshot: %s', e)
+            LOG.exception(e)
+        time.sleep(interval)
+
+
+def main():
+    utils.init_config_and_logging(config.CONNECTION_OPTS +
+                                  config.DASHBOARD_OPTS)
+
+    paths = sorted(set(path for path in [cfg.CONF.shared_snapshot_file,
+                                         cfg.CONF.local_snapshot_file]
+                       if path))
+    if not paths:
+        LOG.critical('Neither shared_snapshot_file nor local_snapshot_file '
+                     'is set')
+        return 1
+
+    runtime_storage_inst = runtime_storage.get_runtime_storage(
+        cfg.CONF.runtime_storage_uri)
+    memory_storage_inst = memory_storage.get_memory_storage(
+        memory_storage.MEMORY_STORAGE_COLUMNAR, cfg.CONF.rollup_cube)
+
+    load_periodically(runtime_storage_inst, memory_storage_inst, paths,
+                      cfg.CONF.dashboard_update_interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,8 +14,11 @@
 # limitations under the License.
 
 import collections
+import errno
 import os
 import sys
+import threading
+import time
 
 import flask
 from oslo_config import cfg
@@ -23,6 +26,10 @@ from oslo_log import log as logging
 import six
 
 from stackalytics.dashboard import memory_storage
+from stackalytics.dashboard import response_cache
+from stackalytics.dashboard import shared_cache
+from stackalytics.dashboard import snapshot
+from stackalytics.dashboard import warmup
 from stackalytics.processor import runtime_storage
 from stackalytics.processor import user_processor
 from stackalytics.processor import utils
@@ -41,6 +48,17 @@ CompactRecord = collections.namedtuple('CompactRecord',
                                        RECORD_FIELDS_FOR_AGGREGATE)
 
 
+# strings passed to uniintern and those that were already interned
+INTERN_STATS = {'strings': 0, 'hits': 0}
+
+# serializes updates of the vault pulled by requests
+_update_lock = threading.Lock()
+
+# lock of the local snapshot left by a worker that died while writing it
+# is ignored after this many seconds
+LOCAL_SNAPSHOT_LOCK_TIMEOUT = 3600
+
+
 if six.PY2:
     _unihash = {}
 
@@ -48,13 +66,21 @@ if six.PY2:
         if not isinstance(o, basestring):
             return o
         if isinstance(o, str):
-            return intern(o)
-        if isinstance(o, unicode):
-            return _unihash.setdefault(o, o)
+            interned = intern(o)
+        else:
+            interned = _unihash.setdefault(o, o)
+        INTERN_STATS['strings'] += 1
+        if interned is not o:
+            INTERN_STATS['hits'] += 1
+        return interned
 else:
     def uniintern(o):
         if isinstance(o, str):
-            return sys.intern(o)
+            interned = sys.intern(o)
+            INTERN_STATS['strings'] += 1
+            if interned is not o:
+                INTERN_STATS['hits'] += 1
+            return interned
         else:
             return o
 
@@ -74,49 +100,281 @@ def extend_record(record):
 
 
 def get_vault():
-    vault = getattr(flask.current_app, 'stackalytics_vault', None)
+    vault = getattr(flask.request, 'stackalytics_vault', None)
+    if vault:
+        # the whole request is served by the same vault, even if it is
+        # swapped by the background refresh in the meantime
+        return vault
+
+    app = flask.current_app._get_current_object()
+    vault = getattr(app, 'stackalytics_vault', None)
     if not vault:
         try:
             vault = {}
             runtime_storage_inst = runtime_storage.get_runtime_storage(
                 cfg.CONF.runtime_storage_uri)
             vault['runtime_storage'] = runtime_storage_inst
+            if cfg.CONF.columnar_memory_storage:
+                memory_storage_type = memory_storage.MEMORY_STORAGE_COLUMNAR
+            else:
+                memory_storage_type = memory_storage.MEMORY_STORAGE_CACHED
             vault['memory_storage'] = memory_storage.get_memory_storage(
-                memory_storage.MEMORY_STORAGE_CACHED)
-
-            flask.current_app.stackalytics_vault = vault
+                memory_storage_type, cfg.CONF.rollup_cube)
+            _reset_cache(vault)
+            if cfg.CONF.shared_cache_uri:
+                vault['shared_cache'] = shared_cache.SharedCache(
+                    cfg.CONF.shared_cache_uri, cfg.CONF.shared_cache_ttl,
+                    cfg.CONF.shared_cache_lock_timeout)
+            if (cfg.CONF.local_snapshot_file and
+                    not cfg.CONF.shared_snapshot_file):
+                _load_local_snapshot(vault, memory_storage_type)
+
+            app.stackalytics_vault = vault
         except Exception as e:
             LOG.critical('Failed to initialize application: %s', e)
             LOG.exception(e)
             flask.abort(500)
 
-    if not getattr(flask.request, 'stackalytics_updated', None):
-        time_now = utils.date_to_timestamp('now')
-        may_update_by_time = time_now > vault.get('vault_next_update_time', 0)
-        if may_update_by_time:
-            flask.request.stackalytics_updated = True
-            vault['vault_update_time'] = time_now
-            vault['vault_next_update_time'] = (
-                time_now + cfg.CONF.dashboard_update_interval)
-            memory_storage_inst = vault['memory_storage']
-            have_updates = memory_storage_inst.update(compact_records(
-                vault['runtime_storage'].get_update(os.getpid())))
-            vault['runtime_storage_update_time'] = (
-                vault['runtime_storage'].get_by_key(
-                    'runtime_storage_update_time'))
-
-            if have_updates:
-                vault['cache'] = {}
-                vault['cache_size'] = 0
-                _init_releases(vault)
-                _init_module_groups(vault)
-                _init_project_types(vault)
-                _init_repos(vault)
-                _init_user_index(vault)
+    refreshed_in_background = getattr(app, 'stackalytics_refresh_thread',
+                                      None)
+    # requests of the warm-up are served by the data they warm up for
+    if (not refreshed_in_background and
+            not flask.request.environ.get(warmup.WARMUP_ENVIRON_KEY)):
+        _update_vault_by_request(app, vault)
 
+    flask.request.stackalytics_vault = vault
     return vault
 
 
+def _need_update(vault):
+    return (not vault.get('vault_initialized') or
+            utils.date_to_timestamp('now') >
+            vault.get('vault_next_update_time', 0))
+
+
+def _update_vault_by_request(app, vault):
+    if not _need_update(vault):
+        return
+    # requests wait for the first load, later updates are pulled by one
+    # request while the others are served by the current data
+    if not _update_lock.acquire(not vault.get('vault_initialized')):
+        return
+    try:
+        if not _need_update(vault):
+            return  # updated by another request
+        cache_invalidated = _update_vault(vault)
+        vault['vault_initialized'] = True
+    finally:
+        _update_lock.release()
+
+    if cfg.CONF.background_vault_refresh:
+        # the first load is done by request, the next ones are not
+        _start_refresh_thread(app)
+    elif cache_invalidated and cfg.CONF.cache_warmup_queries:
+        warmup.start_warm_up(app)
+
+
+def _update_vault(vault, copy_on_write=False):
+    """Pull updates from runtime storage into the vault.
+
+    With copy_on_write the structures shared with readers of the vault are
+    not changed, their updated copies are put into the vault instead.
+    Returns True if the cache has been invalidated.
+    """
+    time_now = utils.date_to_timestamp('now')
+    vault['vault_update_time'] = time_now
+    vault['vault_next_update_time'] = (
+        time_now + cfg.CONF.dashboard_update_interval)
+    epoch = vault['runtime_storage'].get_epoch()
+    if cfg.CONF.shared_snapshot_file:
+        have_updates = _attach_snapshot(vault)
+    else:
+        have_updates = _update_memory_storage(vault, epoch, copy_on_write)
+    vault['runtime_storage_update_time'] = (
+        vault['runtime_storage'].get_by_key('runtime_storage_update_time'))
+    vault['data_version'] = _get_data_version(vault, epoch)
+
+    changed_metadata = _get_changed_metadata(vault, epoch, have_updates)
+    if have_updates or changed_metadata:
+        if copy_on_write and 'cache' in vault:
+            vault['cache'] = vault['cache'].copy()
+            vault['filter_cache'] = vault['filter_cache'].copy()
+        _invalidate_cache(vault, changed_metadata)
+        for key, init_func in METADATA_INIT_FUNCS:
+            if key in changed_metadata:
+                init_func(vault)
+        _init_user_index(vault)
+        return True
+    return False
+
+
+def _start_refresh_thread(app):
+    thread = threading.Thread(target=_refresh_vault, args=(app,),
+                              name='vault-refresh')
+    thread.daemon = True
+    app.stackalytics_refresh_thread = thread
+    thread.start()
+
+
+def _refresh_vault(app):
+    # connections of runtime storage are not shared between threads
+    runtime_storage_inst = runtime_storage.get_runtime_storage(
+        cfg.CONF.runtime_storage_uri)
+
+    while True:
+        time.sleep(cfg.CONF.dashboard_update_interval)
+        vault = app.stackalytics_vault
+        try:
+            start = time.time()
+            new_vault = dict(vault, runtime_storage=runtime_storage_inst)
+            cache_invalidated = _update_vault(new_vault, copy_on_write=True)
+            new_vault['runtime_storage'] = vault['runtime_storage']
+            # requests that have started keep the previous vault
+            app.stackalytics_vault = new_vault
+            LOG.debug('Vault is refreshed in %.1f s', time.time() - start)
+            if cache_invalidated and cfg.CONF.cache_warmup_queries:
+                warmup.warm_up(app)
+        except Exception as e:
+            LOG.error('Failed to refresh vault: %s', e)
+            LOG.exception(e)
+
+
+def _update_memory_storage(vault, epoch, copy_on_write=False):
+    # apply only complete epochs published by the processor
+    if epoch and epoch == vault.get('epoch'):
+        vault['runtime_storage'].touch_pid(os.getpid())
+        return False
+    if copy_on_write:
+        vault['memory_storage'] = vault['memory_storage'].copy()
+    have_updates = vault['memory_storage'].update(compact_records(
+        vault['runtime_storage'].get_update(os.getpid())))
+    vault['epoch'] = epoch
+    if vault.pop('write_local_snapshot', False):
+        _write_local_snapshot(vault)
+    return have_updates
+
+
+def _load_local_snapshot(vault, memory_storage_type):
+    path = cfg.CONF.local_snapshot_file
+    start = time.time()
+    result = snapshot.load_memory_storage(path, memory_storage_type,
+                                          CompactRecord, cfg.CONF.rollup_cube)
+    if result:
+        memory_storage_inst, update_position = result
+        if vault['runtime_storage'].resume_update(os.getpid(),
+                                                  update_position):
+            vault['memory_storage'] = memory_storage_inst
+            LOG.info('Loaded %(count)d records from snapshot %(path)s in '
+                     '%(time).1f s',
+                     {'count': len(memory_storage_inst.records),
+                      'path': path, 'time': time.time() - start})
+            return
+        LOG.info('Snapshot %s is older than the update log', path)
+
+    # all records are loaded from runtime storage and saved for next start
+    vault['write_local_snapshot'] = True
+
+
+def _lock_local_snapshot(lock_path):
+    try:
+        if (time.time() - os.path.getmtime(lock_path) >
+                LOCAL_SNAPSHOT_LOCK_TIMEOUT):
+            LOG.warning('Remove stale snapshot lock %s', lock_path)
+            os.remove(lock_path)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+    return True
+
+
+def _write_local_snapshot(vault):
+    # workers that cold start together load the same records, only the
+    # one holding the lock writes them
+    path = cfg.CONF.local_snapshot_file
+    lock_path = path + '.lock'
+    try:
+        if not _lock_local_snapshot(lock_path):
+            LOG.info('Snapshot %s is written by another worker', path)
+            return
+        try:
+            snapshot.write_snapshot(
+                vault['memory_storage'], path,
+                vault['runtime_storage'].get_update_position(os.getpid()))
+        finally:
+            os.remove(lock_path)
+    except (IOError, OSError) as e:
+        LOG.warning('Failed to write snapshot %s: %s', path, e)
+
+
+def _attach_snapshot(vault):
+    memory_storage_inst = snapshot.load_snapshot(
+        cfg.CONF.shared_snapshot_file, vault.get('snapshot_version'))
+    if not memory_storage_inst:
+        return False
+    # requests in flight keep the previous snapshot until they complete
+    vault['memory_storage'] = memory_storage_inst
+    vault['snapshot_version'] = memory_storage_inst.version
+    return True
+
+
+def _get_data_version(vault, epoch):
+    # responses may be shared only by workers that serve the same data
+    if not epoch:
+        return None
+    update_position = getattr(vault['memory_storage'], 'update_position',
+                              None)
+    return runtime_storage.get_digest([epoch, update_position])
+
+
+def _get_changed_metadata(vault, epoch, have_updates):
+    digests = (epoch or {}).get('metadata')
+    if not digests:
+        # the processor does not publish digests, refresh with records
+        if have_updates:
+            return set(runtime_storage.METADATA_KEYS)
+        return set()
+
+    known_digests = vault.get('metadata_digests') or {}
+    vault['metadata_digests'] = digests
+    return set(key for key in runtime_storage.METADATA_KEYS
+               if digests.get(key) != known_digests.get(key))
+
+
+def _reset_cache(vault):
+    if 'cache' in vault:
+        vault['cache'].invalidate()
+        vault['filter_cache'].invalidate()
+    else:
+        vault['cache'] = response_cache.ResponseCache(
+            cfg.CONF.cache_max_size, cfg.CONF.cache_max_entries)
+        # record ids selected by filters, see decorators.record_filter
+        vault['filter_cache'] = response_cache.ResponseCache(
+            cfg.CONF.filter_cache_max_size,
+            cfg.CONF.filter_cache_max_entries)
+
+
+def _invalidate_cache(vault, changed_metadata):
+    memory_storage_inst = vault['memory_storage']
+    changed_record_types = memory_storage_inst.changed_record_types
+    if ('cache' not in vault or changed_metadata or
+            changed_record_types is None or
+            any(memory_storage_inst.new_index_keys.values())):
+        # new modules, companies or users may appear in any response
+        _reset_cache(vault)
+        return
+
+    # filters select records of all types
+    vault['filter_cache'].invalidate()
+    vault['cache'].invalidate(changed_record_types)
+    LOG.debug('Cache is invalidated for record types %s, entries left: %d',
+              changed_record_types, len(vault['cache']))
+
+
 def get_memory_storage():
     return get_vault()['memory_storage']
 
@@ -169,6 +427,14 @@ def _init_user_index(vault):
     vault['user_index'] = {}
 
 
+METADATA_INIT_FUNCS = [
+    ('releases', _init_releases),
+    ('module_groups', _init_module_groups),
+    ('project_types', _init_project_types),
+    ('repos', _init_repos),
+]
+
+
 def get_project_types():
     return get_vault()['project_types']
 
@@ -0,0 +1,138 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Group-by aggregation of records over typed columns with NumPy.
+
+Aggregation works only if NumPy is installed and records are kept in
+ColumnarRecords. Every function returns None if the aggregation can not be
+done here, e.g. a column holds values that do not fit its type, and the
+caller is expected to fall back to iteration over records.
+"""
+
+from stackalytics.dashboard import bitmap_index
+from stackalytics.dashboard import record_columns
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def is_available(records):
+    return (numpy is not None and
+            isinstance(records, record_columns.ColumnarRecords))
+
+
+def _get_id_array(record_ids):
+    if isinstance(record_ids, bitmap_index.RecordIdSet):
+        bitmap = numpy.frombuffer(record_ids.to_bytes(), dtype=numpy.uint8)
+        # bitorder of unpackbits needs numpy 1.17, bits of every byte are
+        # reversed instead, the record id 8 * N + K is bit K of byte N
+        bits = numpy.unpackbits(bitmap).reshape(-1, 8)[:, ::-1]
+        return numpy.flatnonzero(bits)
+    return numpy.fromiter(record_ids, dtype=numpy.int64)
+
+
+def _get_codes(records, field, ids):
+    codes = records.columns[field].codes
+    return numpy.frombuffer(codes, dtype=numpy.int32)[ids]
+
+
+def _get_ints(records, field, ids):
+    column = records.columns[field]
+    values = numpy.frombuffer(column.data,
+                              dtype=numpy.dtype(column.typecode))[ids]
+    if numpy.any(values <= column.overflow_mark):
+        return None  # None or values kept aside
+    return values
+
+
+def _make_result(records, ids, groups, metric, param_id, param_title):
+    column = records.columns[param_id]
+    title_column = records.columns[param_title]
+    # name of the group is taken from its last record, as in iteration
+    reversed_groups = groups[::-1]
+    group_codes, last = numpy.unique(reversed_groups, return_index=True)
+    last_ids = ids[::-1][last]
+
+    result = {}
+    for code, record_id in zip(group_codes.tolist(), last_ids.tolist()):
+        key = column.values[code]
+        result[key] = {'metric': int(metric[code]), 'id': key,
+                       'name': title_column.get(record_id)}
+    return result
+
+
+def _prepare(records, record_ids, param_id):
+    ids = _get_id_array(record_ids)
+    ids = ids[ids < len(records.present)]
+    present = numpy.frombuffer(records.present, dtype=numpy.uint8)
+    ids = ids[present[ids] != 0]
+    groups = _get_codes(records, param_id, ids)
+    size = len(records.columns[param_id].values)
+    return ids, groups, size
+
+
+def count_by(records, record_ids, param_id, param_title):
+    ids, groups, size = _prepare(records, record_ids, param_id)
+    metric = numpy.bincount(groups, minlength=size)
+    return _make_result(records, ids, groups, metric, param_id, param_title)
+
+
+def sum_by(records, record_ids, field, param_id, param_title):
+    ids, groups, size = _prepare(records, record_ids, param_id)
+    values = _get_ints(records, field, ids)
+    if values is None:
+        return None
+    metric = numpy.bincount(groups, weights=values, minlength=size)
+    return _make_result(records, ids, groups, metric.astype(numpy.int64),
+                        param_id, param_title)
+
+
+def marks_by(records, record_ids, param_id, param_title):
+    """Aggregate marks the same way as decorators.mark_filter does."""
+    ids, groups, size = _prepare(records, record_ids, param_id)
+    values = _get_ints(records, 'value', ids)
+    if values is None:
+        return None
+
+    type_column = records.columns['type']
+    types = _get_codes(records, 'type', ids)
+    code_review = types == type_column.value_codes.get('Code-Review', -2)
+    workflow = types == type_column.value_codes.get('Workflow', -2)
+    other = ~(code_review | workflow)
+
+    disagreement_column = records.columns['disagreement']
+    truthy = numpy.array([bool(v) for v in disagreement_column.values] +
+                         [False], dtype=bool)
+    disagreement = truthy[_get_codes(records, 'disagreement', ids)]
+
+    metric = numpy.bincount(groups[code_review], minlength=size)
+    result = _make_result(records, ids, groups, metric, param_id,
+                          param_title)
+
+    counters = [(value, code_review & (values == value))
+                for value in numpy.unique(values[code_review]).tolist()]
+    counters += [('A', workflow & (values == 1)),
+                 ('WIP', workflow & (values != 1)),
+                 (0, other), ('disagreements', disagreement)]
+
+    column = records.columns[param_id]
+    for name, mask in counters:
+        counts = numpy.bincount(groups[mask], minlength=size)
+        for code in numpy.flatnonzero(counts).tolist():
+            row = result[column.values[code]]
+            row[name] = row.get(name, 0) + int(counts[code])
+    return result
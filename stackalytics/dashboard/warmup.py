@@ -0,0 +1,110 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Warm-up of the response cache after vault updates.
+
+Cached endpoints record the queries they serve. After an update has
+invalidated the cache, the most frequent queries are requested again from
+a background thread, so that their responses are cached before visitors
+ask for them.
+"""
+
+import collections
+import threading
+import time
+
+import flask
+from oslo_config import cfg
+from oslo_log import log as logging
+from six.moves.urllib import parse
+
+
+LOG = logging.getLogger(__name__)
+
+# marks requests made by the warm-up, they are not counted
+WARMUP_ENVIRON_KEY = 'stackalytics.warmup'
+# JSONP callback and jQuery cache buster do not change cached responses
+IGNORED_ARGS = frozenset(['callback', '_'])
+# how many more queries are tracked than warmed up
+TRACKED_QUERIES_FACTOR = 10
+
+
+class QueryStats(object):
+    """Frequencies of queries, bounded in the number of queries."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def record(self, query, limit):
+        with self.lock:
+            self.counts[query] += 1
+            if len(self.counts) > limit:
+                # the most frequent half survives with halved counts, so
+                # that queries popular in the past give way to new ones
+                self.counts = collections.Counter(dict(
+                    (q, max(count // 2, 1))
+                    for q, count in self.counts.most_common(limit // 2)))
+
+    def get_top(self, n):
+        with self.lock:
+            return [q for q, count in self.counts.most_common(n)]
+
+
+query_stats = QueryStats()
+_warm_up_thread = None
+
+
+def record_query():
+    request = flask.request
+    limit = cfg.CONF.cache_warmup_queries
+    if not limit or request.environ.get(WARMUP_ENVIRON_KEY):
+        return
+    args = sorted((key, value)
+                  for key, value in request.args.items(multi=True)
+                  if key not in IGNORED_ARGS)
+    query = request.path
+    if args:
+        query += '?' + parse.urlencode(args)
+    query_stats.record(query, limit * TRACKED_QUERIES_FACTOR)
+
+
+def warm_up(app):
+    """Request the most frequent queries, so that responses are cached."""
+    vault = getattr(app, 'stackalytics_vault', None)
+    if not vault or not vault.get('vault_initialized'):
+        # responses would be cached for data that is not loaded yet
+        LOG.debug('Vault is not initialized, skip cache warm-up')
+        return
+    start = time.time()
+    client = app.test_client()
+    queries = query_stats.get_top(cfg.CONF.cache_warmup_queries)
+    for query in queries:
+        try:
+            client.get(query, environ_base={WARMUP_ENVIRON_KEY: True})
+        except Exception as e:
+            LOG.warning('Failed to warm up cache with %s: %s', query, e)
+    LOG.info('Cache is warmed up with %(count)d queries in %(time).1f s',
+             {'count': len(queries), 'time': time.time() - start})
+
+
+def start_warm_up(app):
+    global _warm_up_thread
+    if _warm_up_thread and _warm_up_thread.is_alive():
+        return
+    _warm_up_thread = threading.Thread(target=warm_up, args=(app,),
+                                       name='cache-warmup')
+    _warm_up_thread.daemon = True
+    _warm_up_thread.start()
@@ -26,9 +26,12 @@ import six
 from stackalytics.dashboard import decorators
 from stackalytics.dashboard import helpers
 from stackalytics.dashboard import kpi
+from stackalytics.dashboard import memory_report
 from stackalytics.dashboard import parameters
 from stackalytics.dashboard import reports
+from stackalytics.dashboard import rollup
 from stackalytics.dashboard import vault
+from stackalytics.dashboard import vectorized
 from stackalytics.processor import config
 from stackalytics.processor import utils
 
@@ -61,21 +64,59 @@ def widget():
 
 # AJAX Handlers ---------
 
+def _get_vectorized_stats(record_ids, metric_filter, param_id, param_title):
+    records = vault.get_memory_storage().records
+    if record_ids is None or not vectorized.is_available(records):
+        return None
+
+    if metric_filter in (None, decorators.incremental_filter):
+        return vectorized.count_by(records, record_ids, param_id,
+                                   param_title)
+    elif metric_filter is decorators.loc_filter:
+        return vectorized.sum_by(records, record_ids, 'loc', param_id,
+                                 param_title)
+    elif metric_filter is decorators.mark_filter:
+        return vectorized.marks_by(records, record_ids, param_id,
+                                   param_title)
+    return None
+
+
+def _get_rollup_stats(rollup_query, metric_filter, param_id, param_title):
+    cube = vault.get_memory_storage().rollup
+    if rollup_query is None or cube is None:
+        return None
+
+    if metric_filter in (None, decorators.incremental_filter):
+        return cube.aggregate(rollup_query, param_id, param_title)
+    elif metric_filter is decorators.loc_filter:
+        return cube.aggregate(rollup_query, param_id, param_title,
+                              rollup.LOC)
+    return None
+
+
 def _get_aggregated_stats(records, metric_filter, keys, param_id,
-                          param_title=None, finalize_handler=None):
+                          param_title=None, finalize_handler=None,
+                          record_ids=None, rollup_query=None):
     param_title = param_title or param_id
-    result = dict((c, {'metric': 0, 'id': c}) for c in keys)
-    context = {'vault': vault.get_vault()}
-    if metric_filter:
-        for record in records:
-            metric_filter(result, record, param_id, context)
-            result[getattr(record, param_id)]['name'] = (
-                getattr(record, param_title))
-    else:
-        for record in records:
-            record_param_id = getattr(record, param_id)
-            result[record_param_id]['metric'] += 1
-            result[record_param_id]['name'] = getattr(record, param_title)
+    result = _get_rollup_stats(rollup_query, metric_filter, param_id,
+                               param_title)
+    if result is None:
+        result = _get_vectorized_stats(record_ids, metric_filter, param_id,
+                                       param_title)
+    if result is None:
+        result = dict((c, {'metric': 0, 'id': c}) for c in keys)
+        context = {'vault': vault.get_vault()}
+        if metric_filter:
+            for record in records:
+                metric_filter(result, record, param_id, context)
+                result[getattr(record, param_id)]['name'] = (
+                    getattr(record, param_title))
+        else:
+            for record in records:
+                record_param_id = getattr(record, param_id)
+                result[record_param_id]['metric'] += 1
+                result[record_param_id]['name'] = getattr(record,
+                                                          param_title)
 
     response = [r for r in result.values() if r['metric']]
     if finalize_handler:
@@ -126,7 +167,9 @@ def get_companies(records, metric_filter, finalize_handler, **kwargs):
     return _get_aggregated_stats(records, metric_filter,
                                  vault.get_memory_storage().get_companies(),
                                  'company_name',
-                                 finalize_handler=finalize_handler)
+                                 finalize_handler=finalize_handler,
+                                 record_ids=kwargs['record_ids'],
+                                 rollup_query=kwargs['rollup_query'])
 
 
 @app.route('/api/1.0/stats/modules')
@@ -139,7 +182,9 @@ def get_companies(records, metric_filter, finalize_handler, **kwargs):
 def get_modules(records, metric_filter, finalize_handler, **kwargs):
     return _get_aggregated_stats(records, metric_filter,
                                  vault.get_memory_storage().get_modules(),
-                                 'module', finalize_handler=finalize_handler)
+                                 'module', finalize_handler=finalize_handler,
+                                 record_ids=kwargs['record_ids'],
+                                 rollup_query=kwargs['rollup_query'])
 
 
 def get_core_engineer_branch(user, modules):
@@ -173,7 +218,9 @@ def get_engineers(records, metric_filter, finalize_handler, **kwargs):
     return _get_aggregated_stats(records, metric_filter,
                                  vault.get_memory_storage().get_user_ids(),
                                  'user_id', 'author_name',
-                                 finalize_handler=postprocessing)
+                                 finalize_handler=postprocessing,
+                                 record_ids=kwargs['record_ids'],
+                                 rollup_query=kwargs['rollup_query'])
 
 
 @app.route('/api/1.0/stats/engineers_extended')
@@ -535,6 +582,16 @@ def get_company_changes(**kwargs):
     return result
 
 
+@app.route('/api/1.0/memory')
+@decorators.exception_handler()
+@decorators.response(versioned=False)
+@decorators.jsonify('memory')
+def get_memory_report(**kwargs):
+    if not cfg.CONF.memory_report_api:
+        flask.abort(404)
+    return memory_report.get_report(vault.get_vault())
+
+
 def _get_week(kwargs, param_name):
     date_param = parameters.get_single_parameter(kwargs, param_name)
     if date_param:
@@ -547,7 +604,8 @@ def _get_week(kwargs, param_name):
 @app.route('/api/1.0/stats/timeline')
 @decorators.exception_handler()
 @decorators.response()
-@decorators.cached()
+# the timeline ends with the current week
+@decorators.cached(ttl=24 * 60 * 60)
 @decorators.jsonify('timeline')
 @decorators.record_filter(ignore=['release', 'start_date'])
 def timeline(records, **kwargs):
@@ -585,13 +643,23 @@ def timeline(records, **kwargs):
     week_stat_commits = dict((c, 0) for c in weeks)
     week_stat_commits_hl = dict((c, 0) for c in weeks)
 
-    if ('commits' in metric) or ('loc' in metric):
+    with_loc = ('commits' in metric) or ('loc' in metric)
+    if with_loc:
         handler = lambda record: record.loc
     else:
         handler = lambda record: 0
 
+    cube = vault.get_memory_storage().rollup
+    rollup_query = kwargs['rollup_query']
+
     # fill stats with the data
-    if 'person-day' in metric:
+    if (cube is not None and rollup_query is not None and
+            'person-day' not in metric and 'members' not in metric):
+        week_stat_loc, week_stat_commits, week_stat_commits_hl = (
+            cube.timeline(rollup_query, start_week, end_week, release_name))
+        if not with_loc:
+            week_stat_loc = dict((c, 0) for c in weeks)
+    elif 'person-day' in metric:
         # special case for man-day effort metric
         release_stat = collections.defaultdict(set)
         all_stat = collections.defaultdict(set)
@@ -0,0 +1,48 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from stackalytics.processor import config
+from stackalytics.processor import runtime_storage
+from stackalytics.processor import utils
+
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.IntOpt('max-pid-age', default=24 * 60 * 60,
+               short='a',
+               help='Readers that have not polled updates for this number '
+                    'of seconds are expired'),
+]
+
+
+def main():
+    utils.init_config_and_logging(config.CONNECTION_OPTS + OPTS)
+
+    runtime_storage_inst = runtime_storage.get_runtime_storage(
+        cfg.CONF.runtime_storage_uri)
+
+    report = runtime_storage_inst.compact_updates(cfg.CONF.max_pid_age)
+
+    LOG.info('Compaction reclaimed %(reclaimed_keys)d keys: '
+             '%(expired_pids)d expired readers, %(purged_updates)d polled '
+             'updates, %(duplicate_updates)d duplicate updates', report)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,7 +20,9 @@ from oslo_config import cfg
 
 CONNECTION_OPTS = [
     cfg.StrOpt('runtime-storage-uri', default='memcached://127.0.0.1:11211',
-               help='Storage URI'),
+               help='Storage URI, either memcached://host:port[,host:port], '
+                    'memcached+ring://host:port[,host:port] to place keys '
+                    'on a consistent hash ring or sqlite:///path/to/file'),
 ]
 
 PROCESSOR_OPTS = [
@@ -54,6 +56,15 @@ PROCESSOR_OPTS = [
                help='URI for default data'),
     cfg.IntOpt('members-look-ahead', default=250,
                help='How many member profiles to look ahead after the last'),
+    cfg.IntOpt('runtime-storage-min-compress-len', default=0,
+               help='Values longer than this are compressed when stored in '
+                    'memcached runtime storage, 0 disables compression'),
+    cfg.BoolOpt('runtime-storage-compact-records', default=False,
+                help='Store records in runtime storage in compact '
+                     'field-ordered encoding'),
+    cfg.StrOpt('runtime-storage-stats-file',
+               help='Name of file to store runtime storage statistics in '
+                    'JSON format at the end of processing'),
 ]
 
 DASHBOARD_OPTS = [
@@ -74,6 +85,58 @@ DASHBOARD_OPTS = [
                help='Name of file to store python profiler data'),
     cfg.IntOpt('age-warn', default=2 * 24 * 60 * 60,
                help='Warn if the age of data is more than this value, sec'),
+    cfg.BoolOpt('columnar-memory-storage', default=False,
+                help='Keep records in memory in typed columns instead of '
+                     'a tuple per record'),
+    cfg.BoolOpt('rollup-cube', default=True,
+                help='Keep counts of records by their dimensions, so that '
+                     'stats and timeline are summed over them instead of '
+                     'records'),
+    cfg.StrOpt('shared-snapshot-file',
+               help='If set, dashboard workers map the snapshot of records '
+                    'written into this file by stackalytics-snapshot instead '
+                    'of loading records into memory of every worker'),
+    cfg.StrOpt('local-snapshot-file',
+               help='If set, dashboard workers start from records loaded '
+                    'from this snapshot and catch up through the update log. '
+                    'The snapshot is written by a worker that loaded all '
+                    'records and by stackalytics-snapshot'),
+    cfg.BoolOpt('background-vault-refresh', default=False,
+                help='Pull updates into dashboard workers from a background '
+                     'thread instead of a request. Requires threads to be '
+                     'enabled in uwsgi'),
+    cfg.IntOpt('cache-max-size', default=256 * 1024 * 1024,
+               help='The limit of the total size of responses cached by a '
+                    'dashboard worker, in bytes, 0 means no limit'),
+    cfg.IntOpt('cache-max-entries', default=100000,
+               help='The limit of the number of responses cached by a '
+                    'dashboard worker, 0 means no limit'),
+    cfg.IntOpt('filter-cache-max-size', default=64 * 1024 * 1024,
+               help='The limit of the total size of record sets selected by '
+                    'request filters that are cached by a dashboard worker, '
+                    'in bytes, 0 means no limit'),
+    cfg.IntOpt('filter-cache-max-entries', default=1000,
+               help='The limit of the number of record sets selected by '
+                    'request filters that are cached by a dashboard worker, '
+                    '0 means no limit'),
+    cfg.IntOpt('cache-warmup-queries', default=0,
+               help='The number of the most frequent queries that are '
+                    'requested again by a dashboard worker after an update '
+                    'invalidates its cache, 0 disables the warm-up. The '
+                    'warm-up runs in a thread, that must be enabled in uwsgi'),
+    cfg.StrOpt('shared-cache-uri',
+               help='If set, responses are shared by dashboard workers '
+                    'through memcached at this uri, e.g. '
+                    'memcached://localhost:11211'),
+    cfg.IntOpt('shared-cache-ttl', default=24 * 60 * 60,
+               help='How long responses are kept in the shared cache, sec'),
+    cfg.IntOpt('shared-cache-lock-timeout', default=60,
+               help='How long a worker waits for the response computed by '
+                    'another worker before computing it itself, sec'),
+    cfg.BoolOpt('memory-report-api', default=False,
+                help='Serve the memory report of a dashboard worker at '
+                     '/api/1.0/memory. The report takes seconds to compute '
+                     'and is meant for operators only'),
 ]
 
 
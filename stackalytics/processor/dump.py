@@ -17,19 +17,22 @@ import pickle
 import re
 import sys
 
-import memcache
 from oslo_config import cfg
 from oslo_log import log as logging
 import six
 from six.moves.urllib import parse
 
-from stackalytics.processor import config
+from stackalytics.processor import runtime_storage
 from stackalytics.processor import utils
 
 
 LOG = logging.getLogger(__name__)
 
 OPTS = [
+    cfg.StrOpt('runtime-storage-uri', default='memcached://127.0.0.1:11211',
+               help='Memcached URI, either memcached://host:port[,host:port] '
+                    'or memcached+ring://host:port[,host:port]; other '
+                    'runtime storages are not supported by the dump'),
     cfg.BoolOpt('restore',
                 short='r',
                 help='Restore data into memcached'),
@@ -47,7 +50,6 @@ SINGLE_KEYS = ['module_groups', 'project_types', 'repos', 'releases',
                'runtime_storage_update_time']
 ARRAY_KEYS = ['record', 'user']
 BULK_READ_SIZE = 64
-MEMCACHED_URI_PREFIX = r'^memcached:\/\/'
 
 
 def read_records_from_fd(fd):
@@ -143,18 +145,20 @@ def export_data(memcached_inst, fd):
 
 
 def _connect_to_memcached(uri):
-    stripped = re.sub(MEMCACHED_URI_PREFIX, '', uri)
-    if stripped:
-        storage_uri = stripped.split(',')
-        return memcache.Client(storage_uri)
-    else:
-        raise Exception('Invalid storage uri %s' % uri)
+    if not (re.search(runtime_storage.MEMCACHED_URI_PREFIX, uri) or
+            re.search(runtime_storage.MEMCACHED_RING_URI_PREFIX, uri)):
+        LOG.critical('Dump supports memcached runtime storage only, '
+                     'got uri %s', uri)
+        return None
+    return runtime_storage.make_memcached_client(uri)
 
 
 def main():
-    utils.init_config_and_logging(config.CONNECTION_OPTS + OPTS)
+    utils.init_config_and_logging(OPTS)
 
     memcached_inst = _connect_to_memcached(cfg.CONF.runtime_storage_uri)
+    if not memcached_inst:
+        return 1
 
     filename = cfg.CONF.file
 
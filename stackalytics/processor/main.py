@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+
 from oslo_config import cfg
 from oslo_log import log as logging
 import psutil
@@ -34,6 +37,23 @@ from stackalytics.processor import vcs
 
 LOG = logging.getLogger(__name__)
 
+# processes that poll the update log of runtime storage
+READER_PROCESS_NAMES = ['uwsgi', 'stackalytics-snapshot']
+
+
+def _get_reader_name(p, psutil2):
+    # process name is truncated to 15 chars by the kernel and console
+    # scripts are run by the interpreter, so command line is checked too
+    name = p.name() if psutil2 else p.name
+    if name in READER_PROCESS_NAMES:
+        return name
+    cmdline = p.cmdline() if psutil2 else p.cmdline
+    for arg in cmdline[:2]:
+        name = os.path.basename(arg)
+        if name in READER_PROCESS_NAMES:
+            return name
+    return None
+
 
 def get_pids():
     # needs to be compatible with psutil >= 1.1.1 since it's a global req.
@@ -42,9 +62,9 @@ def get_pids():
     for pid in psutil.get_pid_list():
         try:
             p = psutil.Process(pid)
-            name = p.name() if PSUTIL2 else p.name
-            if name == 'uwsgi':
-                LOG.debug('Found uwsgi process, pid: %s', pid)
+            name = _get_reader_name(p, PSUTIL2)
+            if name:
+                LOG.debug('Found %s process, pid: %s', name, pid)
                 result.add(pid)
         except Exception as e:
             LOG.debug('Exception while iterating process list: %s', e)
@@ -227,8 +247,13 @@ def process(runtime_storage_inst, record_processor_inst):
     #TODO(adiantum): replace stub with tranlslation acquisition logic
     _process_translation(runtime_storage_inst, record_processor_inst)
 
+    # dashboards see changes only once the phase is complete
+    runtime_storage_inst.publish_epoch()
+
     _post_process_records(record_processor_inst, repos)
 
+    runtime_storage_inst.publish_epoch()
+
 
 def apply_corrections(uri, runtime_storage_inst):
     LOG.info('Applying corrections from uri %s', uri)
@@ -265,12 +290,25 @@ def process_project_list(runtime_storage_inst, project_list_uri):
     runtime_storage_inst.set_by_key('module_groups', module_groups)
 
 
+def dump_storage_stats(runtime_storage_inst, filename):
+    runtime_storage_inst.stats.log_summary()
+
+    stats = json.dumps(runtime_storage_inst.stats.as_dict(), sort_keys=True)
+    if filename:
+        with open(filename, 'w') as fd:
+            fd.write(stats)
+    else:
+        LOG.info('Runtime storage stats: %s', stats)
+
+
 def main():
     utils.init_config_and_logging(config.CONNECTION_OPTS +
                                   config.PROCESSOR_OPTS)
 
     runtime_storage_inst = runtime_storage.get_runtime_storage(
-        cfg.CONF.runtime_storage_uri)
+        cfg.CONF.runtime_storage_uri,
+        min_compress_len=cfg.CONF.runtime_storage_min_compress_len,
+        compact_records=cfg.CONF.runtime_storage_compact_records)
 
     default_data = utils.read_json_from_uri(cfg.CONF.default_data_uri)
     if not default_data:
@@ -297,6 +335,10 @@ def main():
 
     runtime_storage_inst.set_by_key('runtime_storage_update_time',
                                     utils.date_to_timestamp('now'))
+    runtime_storage_inst.publish_epoch()
+
+    dump_storage_stats(runtime_storage_inst,
+                       cfg.CONF.runtime_storage_stats_file)
 
 
 if __name__ == '__main__':
@@ -13,7 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import collections
+import hashlib
+import itertools
+import json
+from multiprocessing import pool
+import pickle
 import re
+import sqlite3
+import threading
+import time
+import zlib
 
 import memcache
 from oslo_log import log as logging
@@ -24,16 +35,222 @@ from stackalytics.processor import utils
 
 LOG = logging.getLogger(__name__)
 
+# keys of metadata that dashboards refresh only when digests published with
+# the epoch change
+# user_version changes in the epoch that stores or deletes any user profile
+METADATA_KEYS = ['releases', 'module_groups', 'project_types', 'repos',
+                 'user_version']
+
 BULK_READ_SIZE = 64
+BULK_READ_MIN_SIZE = 16
+BULK_READ_MAX_SIZE = 4096
+BULK_READ_TARGET_BYTES = 256 * 1024
+BULK_READ_THREADS = 4
+BULK_READ_WINDOW = 4
 BULK_DELETE_SIZE = 4096
+BULK_WRITE_SIZE = 256
 RECORD_ID_PREFIX = 'record:'
 UPDATE_ID_PREFIX = 'update:'
+INDEX_SHARD_PREFIX = 'pk_index:'
+# 5M records make about 1200 keys or 80 KB per shard, far below the limit
+# of memcached item size
+INDEX_SHARD_COUNT = 4096
+INDEX_SHARD_WRITE_SIZE = 64
+INDEX_SHARD_WARN_KEYS = 10000
+# dirty shards are written at the end of a run and, during long runs, not
+# more often than once per interval, sec
+INDEX_FLUSH_INTERVAL = 600
 MEMCACHED_URI_PREFIX = r'^memcached:\/\/'
+MEMCACHED_RING_URI_PREFIX = r'^memcached\+ring:\/\/'
+MEMCACHED_RING_POINTS = 160
+# counters and reader positions must survive changes of the server list,
+# they always live on the first server of the ring
+MEMCACHED_PINNED_KEYS = frozenset([
+    b'record:count', b'update:count', b'user:count', b'pids', b'epoch',
+    b'first_valid_update', b'pk_index:count'])
+MEMCACHED_PINNED_PREFIXES = (b'pid:', b'pid_time:')
+SQLITE_URI_PREFIX = r'^sqlite:\/\/'
+STATS_KEY_PREFIXES = ['record:', 'update:', 'user:', 'pid:', 'vcs:', 'rcs:',
+                      'mail_link:']
+# upper bounds of latency histogram buckets, in seconds
+STATS_LATENCY_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2,
+                         0.5, 1.0]
+STATS_LOG_INTERVAL = 300
+SQLITE_READ_SIZE = 1024
+SQLITE_PICKLE_PROTOCOL = 2
+MEMCACHED_PICKLE_PROTOCOL = 2
+
+# Records are stored either as plain dicts or, if compact encoding is
+# enabled, as tuples (tag, mask, values, extra) where bit N of mask tells
+# that field N of COMPACT_RECORD_FIELDS is present in values. The tag
+# versions the encoding: the list of fields may only be extended under a
+# new tag, while values stored with older tags must still be decodable.
+COMPACT_RECORD_TAG = 'cr1'
+COMPACT_RECORD_FIELDS = [
+    'record_id', 'primary_key', 'record_type', 'company_name', 'module',
+    'user_id', 'release', 'date', 'week', 'author_name', 'author_email',
+    'launchpad_id', 'loc', 'type', 'disagreement', 'value', 'status',
+    'blueprint_id', 'bug_id', 'branch', 'branches', 'review_id', 'patch',
+    'id', 'number', 'subject', 'message', 'commit_id', 'change_id',
+    'lines_added', 'lines_deleted', 'files_changed', 'url', 'topic', 'open',
+    'project', 'lastUpdated', 'createdOn', 'review_number', 'description',
+    'gerrit_id', 'message_id', 'body', 'links', 'mention_count',
+    'mention_date', 'web_link', 'owner', 'assignee', 'date_created',
+    'date_fix_committed', 'member_id', 'company_draft', 'title',
+]
+_COMPACT_RECORD_FIELD_INDEX = dict(
+    (field, n) for n, field in enumerate(COMPACT_RECORD_FIELDS))
+
+
+def encode_record(record):
+    mask = 0
+    extra = {}
+    present = []
+    for field, value in six.iteritems(record):
+        n = _COMPACT_RECORD_FIELD_INDEX.get(field)
+        if n is None:
+            extra[field] = value
+        else:
+            mask |= 1 << n
+            present.append((n, value))
+    present.sort(key=lambda x: x[0])
+    return (COMPACT_RECORD_TAG, mask, tuple(v for n, v in present),
+            extra or None)
+
+
+_compact_record_masks = {}
+
+
+def _get_compact_record_fields(mask):
+    # records of the same type share the set of fields, so the number of
+    # distinct masks is small
+    fields = _compact_record_masks.get(mask)
+    if fields is None:
+        fields = tuple(field for n, field in enumerate(COMPACT_RECORD_FIELDS)
+                       if mask & (1 << n))
+        _compact_record_masks[mask] = fields
+    return fields
+
+
+def decode_record(value):
+    if not (isinstance(value, tuple) and value and
+            value[0] == COMPACT_RECORD_TAG):
+        return value  # plain value or record stored without encoding
+
+    _, mask, values, extra = value
+    record = dict(six.moves.zip(_get_compact_record_fields(mask), values))
+    if extra:
+        record.update(extra)
+    return record
+
+
+class StorageStats(object):
+    """Counters of storage operations grouped by key prefix.
+
+    For every operation and prefix the number of calls, keys, bytes
+    transferred, total time and a histogram of call latencies are kept,
+    and for bulk reads the number of keys not found after retries.
+    Keys that do not match STATS_KEY_PREFIXES are counted as 'other'.
+    The summary is logged every log_interval seconds.
+    """
+
+    def __init__(self, log_interval=STATS_LOG_INTERVAL):
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.log_interval = log_interval
+        self.last_log_time = time.time()
+
+    def add(self, operation, key, keys, size, elapsed):
+        prefix = get_stats_prefix(key)
+        now = time.time()
+        with self.lock:
+            counter = self._get_counter(operation, prefix)
+            counter['calls'] += 1
+            counter['keys'] += keys
+            counter['bytes'] += size
+            counter['time'] += elapsed
+            counter['latency'][bisect.bisect_left(STATS_LATENCY_BUCKETS,
+                                                  elapsed)] += 1
+
+            log_summary = (self.log_interval and
+                           now - self.last_log_time >= self.log_interval)
+            if log_summary:
+                self.last_log_time = now
+
+        if log_summary:
+            self.log_summary()
+
+    def _get_counter(self, operation, prefix):
+        counter = self.counters.get((operation, prefix))
+        if counter is None:
+            counter = self.counters[(operation, prefix)] = {
+                'calls': 0, 'keys': 0, 'bytes': 0, 'time': 0.0,
+                'missing': 0,
+                'latency': [0] * (len(STATS_LATENCY_BUCKETS) + 1)}
+        return counter
+
+    def add_missing(self, key, keys):
+        """Count keys that bulk reads have not found."""
+        prefix = get_stats_prefix(key)
+        with self.lock:
+            self._get_counter('get_multi', prefix)['missing'] += keys
+
+    def as_dict(self):
+        buckets = [str(b) for b in STATS_LATENCY_BUCKETS] + ['inf']
+        result = {}
+        with self.lock:
+            for (operation, prefix), counter in six.iteritems(self.counters):
+                counter = dict(counter)
+                counter['latency'] = dict(six.moves.zip(buckets,
+                                                        counter['latency']))
+                result.setdefault(operation, {})[prefix] = counter
+        return result
+
+    def log_summary(self):
+        for operation, prefixes in sorted(six.iteritems(self.as_dict())):
+            for prefix, counter in sorted(six.iteritems(prefixes)):
+                message = ('Storage %(operation)s %(prefix)s: %(calls)d '
+                           'calls, %(keys)d keys, %(bytes)d bytes, '
+                           '%(time).3f s')
+                if counter['missing']:
+                    message += ', %(missing)d keys missing'
+                LOG.info(message,
+                         dict(counter, operation=operation, prefix=prefix))
+
+
+def get_stats_prefix(key):
+    if isinstance(key, bytes):
+        key = key.decode('utf8')
+    for prefix in STATS_KEY_PREFIXES:
+        if key.startswith(prefix):
+            return prefix
+    return 'other'
+
+
+def _json_default(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    return repr(value)
+
+
+def _iter_unique(iterator):
+    seen = set()
+    for value in iterator:
+        if value not in seen:
+            seen.add(value)
+            yield value
+
+
+def get_digest(value):
+    """Return digest of the value that does not depend on set order."""
+    data = json.dumps(value, sort_keys=True, default=_json_default)
+    return hashlib.md5(data.encode('utf8')).hexdigest()
 
 
 class RuntimeStorage(object):
-    def __init__(self, uri):
-        pass
+    def __init__(self, uri, **kwargs):
+        self.stats = StorageStats()
+        self.users_changed = False
 
     def set_records(self, records_iterator):
         pass
@@ -53,65 +270,386 @@ class RuntimeStorage(object):
     def active_pids(self, pids):
         pass
 
+    def compact_updates(self, max_pid_age):
+        pass
+
     def get_all_records(self):
         pass
 
+    def get_update_position(self, pid):
+        """Return the position in the update log the reader has polled to."""
+        return self.get_by_key('pid:%s' % pid)
+
+    def resume_update(self, pid, update_position):
+        """Make the reader poll updates from the given position.
+
+        Returns False if updates after the position are purged already and
+        the reader has to load all records.
+        """
+        if not update_position:
+            return False
+        if update_position < (self.get_by_key('first_valid_update') or 0):
+            return False
+        self._set_pid_update(pid, update_position)
+        return True
+
+    def touch_pid(self, pid):
+        """Keep the reader from expiring while it has nothing to poll."""
+        self.set_by_key('pid_time:%s' % pid, utils.date_to_timestamp('now'))
+
+    def get_all_users(self):
+        for n in six.moves.range(0, self.get_by_key('user:count') + 1):
+            user = self.get_by_key('user:%s' % n)
+            if user:
+                yield user
+
+    def mark_users_changed(self):
+        """Make the next epoch invalidate everything read from profiles."""
+        self.users_changed = True
+
+    def publish_epoch(self):
+        if self.users_changed:
+            self.set_by_key('user_version',
+                            (self.get_by_key('user_version') or 0) + 1)
+            self.users_changed = False
+        epoch = self.get_epoch() or {'epoch': 0}
+        epoch = {'epoch': epoch['epoch'] + 1,
+                 'update_count': self._get_update_count(),
+                 'metadata': dict((key, get_digest(self.get_by_key(key)))
+                                  for key in METADATA_KEYS)}
+        LOG.debug('Publish epoch %(epoch)s at update %(update_count)s', epoch)
+        self.set_by_key('epoch', epoch)
+        return epoch
+
+    def get_epoch(self):
+        return self.get_by_key('epoch')
+
+    def _get_update_count(self):
+        return self.get_by_key('update:count') or 0
+
+    def _get_update_limit(self):
+        # readers do not go past the last published epoch, storages that
+        # were never written by an epoch-aware processor expose the whole log
+        epoch = self.get_epoch()
+        if epoch:
+            return epoch['update_count']
+        return self._get_update_count()
+
+    def _set_pids(self, pid):
+        pids = self.get_by_key('pids') or set()
+        if pid in pids:
+            return
+        pids.add(pid)
+        self.set_by_key('pids', pids)
+
+    def _set_pid_update(self, pid, update_count):
+        self.set_by_key('pid:%s' % pid, update_count)
+        self.set_by_key('pid_time:%s' % pid, utils.date_to_timestamp('now'))
+        self._set_pids(pid)
+
+    def _get_min_pid_update(self, pids):
+        min_update = self._get_update_limit()
+        for pid in pids:
+            n = self.get_by_key('pid:%s' % pid)
+            if n:
+                if n < min_update:
+                    min_update = n
+        return min_update
+
+    def _expire_pids(self, max_pid_age):
+        now = utils.date_to_timestamp('now')
+        pids = self.get_by_key('pids') or set()
+        expired = set()
+        for pid in pids:
+            pid_time = self.get_by_key('pid_time:%s' % pid)
+            if pid_time is None:
+                # the reader has not polled since times are recorded
+                self.set_by_key('pid_time:%s' % pid, now)
+            elif now - pid_time > max_pid_age:
+                expired.add(pid)
+
+        if expired:
+            LOG.info('Expire readers that have not polled updates for '
+                     '%(age)s seconds: %(pids)s',
+                     {'age': max_pid_age, 'pids': expired})
+            self.set_by_key('pids', pids - expired)
+        return expired
+
+    def _get_record_name(self, record_id):
+        return RECORD_ID_PREFIX + str(record_id)
+
+    def _get_record_count(self):
+        return self.get_by_key('record:count') or 0
+
+    def _set_record_count(self, count):
+        self.set_by_key('record:count', count)
+
+    def _init_user_count(self):
+        if not self.get_by_key('user:count'):
+            self.set_by_key('user:count', 1)
+
+
+class MemcachedClient(memcache.Client):
+    """Memcached client that counts the size of sent and received values.
+
+    The client is thread-local, every thread gets its own connections
+    and its own counters.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MemcachedClient, self).__init__(*args, **kwargs)
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def _recv_value(self, server, flags, rlen):
+        self.bytes_received += rlen
+        return super(MemcachedClient, self)._recv_value(server, flags, rlen)
+
+    def _val_to_store_info(self, val, min_compress_len):
+        info = super(MemcachedClient, self)._val_to_store_info(
+            val, min_compress_len)
+        self.bytes_sent += info[1]
+        return info
+
+
+class ConsistentHashMemcachedClient(MemcachedClient):
+    """Memcached client that places keys on a consistent hash ring.
+
+    Adding or removing a server moves only the keys of the affected ring
+    segments instead of reshuffling almost every key as modulo hashing
+    does. Keys from MEMCACHED_PINNED_KEYS and MEMCACHED_PINNED_PREFIXES
+    are kept on the first server, so it must stay first in the list.
+    """
+
+    def _init_buckets(self):
+        super(ConsistentHashMemcachedClient, self)._init_buckets()
+        ring = []
+        for server in self.servers:
+            name = server.address
+            if isinstance(name, tuple):
+                name = '%s:%s' % name[:2]
+            for n in six.moves.range(MEMCACHED_RING_POINTS * server.weight):
+                ring.append((_hash_key('%s-%d' % (name, n)), server))
+        ring.sort(key=lambda point: point[0])
+        self.ring_points = [point for point, server in ring]
+        self.ring_servers = [server for point, server in ring]
+
+    def _get_server(self, key):
+        if isinstance(key, tuple):
+            return super(ConsistentHashMemcachedClient, self)._get_server(
+                key)
+        if not self.ring_servers:
+            return None, None
+
+        raw_key = key
+        if isinstance(raw_key, six.text_type):
+            raw_key = raw_key.encode('utf8')
+        if (raw_key in MEMCACHED_PINNED_KEYS or
+                raw_key.startswith(MEMCACHED_PINNED_PREFIXES)):
+            server = self.servers[0]
+            if server.connect():
+                return server, key
+            return None, None
+
+        # walk the ring clockwise until a live server is found
+        start = bisect.bisect(self.ring_points, _hash_key(raw_key))
+        for n in six.moves.range(len(self.ring_servers)):
+            server = self.ring_servers[(start + n) % len(self.ring_servers)]
+            if server.connect():
+                return server, key
+        return None, None
+
+
+def _hash_key(key):
+    if isinstance(key, six.text_type):
+        key = key.encode('utf8')
+    return zlib.crc32(key) & 0xffffffff
+
+
+def make_memcached_client(uri, **kwargs):
+    if re.search(MEMCACHED_RING_URI_PREFIX, uri):
+        client_class = ConsistentHashMemcachedClient
+        stripped = re.sub(MEMCACHED_RING_URI_PREFIX, '', uri)
+    else:
+        client_class = MemcachedClient
+        stripped = re.sub(MEMCACHED_URI_PREFIX, '', uri)
+    if not stripped:
+        raise Exception('Invalid storage uri %s' % uri)
+    return client_class(stripped.split(','), **kwargs)
+
 
 class MemcachedStorage(RuntimeStorage):
-    def __init__(self, uri):
+    def __init__(self, uri, min_compress_len=0, compact_records=False):
         super(MemcachedStorage, self).__init__(uri)
 
-        stripped = re.sub(MEMCACHED_URI_PREFIX, '', uri)
-        if stripped:
-            storage_uri = stripped.split(',')
-            self.memcached = memcache.Client(storage_uri)
-            self._init_user_count()
-            self.record_index = {}
-        else:
-            raise Exception('Invalid storage uri %s' % uri)
+        self.memcached = make_memcached_client(
+            uri, pickleProtocol=MEMCACHED_PICKLE_PROTOCOL)
+        self.read_pool = None
+        self.min_compress_len = min_compress_len
+        self.compact_records = compact_records
+        self._init_user_count()
+        # shard number -> {primary_key: record_id}, loaded on demand
+        self.record_index = {}
+        self.dirty_index_shards = set()
+        self.index_checked = False
+        self.index_flush_time = time.time()
 
     def _build_index_lazily(self):
-        if self.record_index:
+        if self.index_checked:
+            return
+        self.index_checked = True
+
+        # the index is valid only if it covers all stored records and is
+        # split into the same number of shards
+        index_meta = self.get_by_key(INDEX_SHARD_PREFIX + 'count')
+        if index_meta != self._get_index_meta(self._get_record_count()):
+            LOG.info('Primary key index is missing or stale, rebuild it')
+            self._rebuild_index()
+
+    def _rebuild_index(self):
+        # shards that are already loaded are authoritative, the rest are
+        # re-created from records stored in memcached
+        rebuilt = set(six.moves.range(INDEX_SHARD_COUNT)) - set(
+            self.record_index.keys())
+        if not rebuilt:
             return
+        for n in rebuilt:
+            self.record_index[n] = {}
+
         for record in self.get_all_records():
-            self.record_index[record['primary_key']] = record['record_id']
+            n = self._get_index_shard_number(record['primary_key'])
+            if n in rebuilt:
+                self.record_index[n][record['primary_key']] = (
+                    record['record_id'])
+
+        # shards are written together with the rest of the index
+        self.dirty_index_shards |= rebuilt
+
+    def _get_index_shard_number(self, primary_key):
+        key = six.text_type(primary_key).encode('utf8')
+        return (zlib.crc32(key) & 0xffffffff) % INDEX_SHARD_COUNT
+
+    def _get_index_shard(self, primary_key):
+        n = self._get_index_shard_number(primary_key)
+        if n not in self.record_index:
+            shard = self.get_by_key(INDEX_SHARD_PREFIX + str(n))
+            if shard is None:
+                LOG.warn('Primary key index shard %s is evicted, rebuild '
+                         'the index', n)
+                self._rebuild_index()
+            else:
+                self.record_index[n] = shard
+        return self.record_index[n]
+
+    def _get_record_id(self, primary_key):
+        return self._get_index_shard(primary_key).get(primary_key)
+
+    def _set_record_id(self, primary_key, record_id):
+        self._get_index_shard(primary_key)[primary_key] = record_id
+        self.dirty_index_shards.add(
+            self._get_index_shard_number(primary_key))
+
+    @staticmethod
+    def _get_index_meta(record_count):
+        return {'records': record_count, 'shards': INDEX_SHARD_COUNT}
+
+    def _flush_index(self, record_count):
+        self.index_flush_time = time.time()
+        if not self.dirty_index_shards:
+            return
+
+        LOG.debug('Flush %d primary key index shards',
+                  len(self.dirty_index_shards))
+        shard_numbers = sorted(self.dirty_index_shards)
+        for n in shard_numbers:
+            if len(self.record_index[n]) > INDEX_SHARD_WARN_KEYS:
+                LOG.warning('Primary key index shard %(n)s has %(keys)d '
+                            'keys, increase the number of shards',
+                            {'n': n, 'keys': len(self.record_index[n])})
+        for i in six.moves.range(0, len(shard_numbers),
+                                 INDEX_SHARD_WRITE_SIZE):
+            self.set_multi_by_keys(
+                dict((n, self.record_index[n])
+                     for n in shard_numbers[i:i + INDEX_SHARD_WRITE_SIZE]),
+                INDEX_SHARD_PREFIX)
+        self.set_by_key(INDEX_SHARD_PREFIX + 'count',
+                        self._get_index_meta(record_count))
+        self.dirty_index_shards = set()
 
     def set_records(self, records_iterator, merge_handler=None):
         self._build_index_lazily()
-        for record in records_iterator:
-            if record['primary_key'] in self.record_index:
-                # update
-                record_id = self.record_index[record['primary_key']]
-                if not merge_handler:
-                    record['record_id'] = record_id
-                    LOG.debug('Update record %s', record)
-                    self.set_by_key(self._get_record_name(record_id), record)
+
+        # record ids are allocated from the local counter, the counter and
+        # the update log are published once per flushed bucket
+        record_count = self._get_record_count()
+        bucket = collections.OrderedDict()
+
+        try:
+            for record in records_iterator:
+                record_id = self._get_record_id(record['primary_key'])
+                if record_id is not None:
+                    # update
+                    if not merge_handler:
+                        record['record_id'] = record_id
+                        LOG.debug('Update record %s', record)
+                        bucket[record_id] = record
+                    else:
+                        original = bucket.get(record_id) or self.get_by_key(
+                            self._get_record_name(record_id))
+                        if merge_handler(original, record):
+                            LOG.debug('Update record with merge %s', record)
+                            bucket[record_id] = original
                 else:
-                    original = self.get_by_key(self._get_record_name(
-                        record_id))
-                    if merge_handler(original, record):
-                        LOG.debug('Update record with merge %s', record)
-                        self.set_by_key(self._get_record_name(record_id),
-                                        original)
-            else:
-                # insert record
-                record_id = self._get_record_count()
-                record['record_id'] = record_id
-                self.record_index[record['primary_key']] = record_id
-                LOG.debug('Insert new record %s', record)
-                self.set_by_key(self._get_record_name(record_id), record)
-                self._set_record_count(record_id + 1)
+                    # insert record
+                    record_id = record_count
+                    record_count += 1
+                    record['record_id'] = record_id
+                    self._set_record_id(record['primary_key'], record_id)
+                    LOG.debug('Insert new record %s', record)
+                    bucket[record_id] = record
 
-            self._commit_update(record_id)
+                if len(bucket) >= BULK_WRITE_SIZE:
+                    self._flush_records(bucket, record_count)
+                    bucket = collections.OrderedDict()
+        finally:
+            self._flush_records(bucket, record_count)
+            self._flush_index(record_count)
+
+    def _flush_records(self, bucket, record_count):
+        if bucket:
+            LOG.debug('Flush bucket of %d records', len(bucket))
+            # records go first, then the counter and only then the update
+            # log, so that readers never see an id pointing to a missing
+            # record
+            values = bucket
+            if self.compact_records:
+                values = dict((record_id, encode_record(record))
+                              for record_id, record in six.iteritems(bucket))
+            self.set_multi_by_keys(values, RECORD_ID_PREFIX)
+            if record_count != self._get_record_count():
+                self._set_record_count(record_count)
+
+        # the index is written after the records it refers to and is
+        # marked valid only after all its shards are stored. Every flush
+        # rewrites all dirty shards, so it is done once per run or interval
+        if time.time() - self.index_flush_time > INDEX_FLUSH_INTERVAL:
+            self._flush_index(record_count)
+
+        if bucket:
+            self._commit_updates(bucket.keys())
 
     def apply_corrections(self, corrections_iterator):
         self._build_index_lazily()
+        record_count = self._get_record_count()
+        bucket = collections.OrderedDict()
+
         for correction in corrections_iterator:
-            if correction['primary_key'] not in self.record_index:
+            record_id = self._get_record_id(correction['primary_key'])
+            if record_id is None:
                 continue
 
-            record_id = self.record_index[correction['primary_key']]
-            original = self.get_by_key(self._get_record_name(record_id))
+            original = bucket.get(record_id) or self.get_by_key(
+                self._get_record_name(record_id))
             need_update = False
 
             for field, value in six.iteritems(correction):
@@ -120,57 +658,83 @@ class MemcachedStorage(RuntimeStorage):
                     original[field] = value
 
             if need_update:
-                self.set_by_key(self._get_record_name(record_id), original)
-                self._commit_update(record_id)
+                bucket[record_id] = original
+
+            if len(bucket) >= BULK_WRITE_SIZE:
+                self._flush_records(bucket, record_count)
+                bucket = collections.OrderedDict()
+
+        self._flush_records(bucket, record_count)
+        self._flush_index(record_count)
 
     def inc_user_count(self):
         return self.memcached.incr('user:count')
 
-    def get_all_users(self):
-        for n in six.moves.range(0, self.get_by_key('user:count') + 1):
-            user = self.get_by_key('user:%s' % n)
-            if user:
-                yield user
+    def _measure(self, operation, key, keys, func, *args, **kwargs):
+        transferred = (getattr(self.memcached, 'bytes_received', 0) +
+                       getattr(self.memcached, 'bytes_sent', 0))
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.stats.add(operation, key, keys,
+                           getattr(self.memcached, 'bytes_received', 0) +
+                           getattr(self.memcached, 'bytes_sent', 0) -
+                           transferred, time.time() - start)
 
     def get_by_key(self, key):
         if six.PY2:
             key = key.encode('utf8')
-        return self.memcached.get(key)
+        return decode_record(self._measure('get', key, 1,
+                                           self.memcached.get, key))
 
     def set_by_key(self, key, value):
         if six.PY2:
             key = key.encode('utf8')
-        if not self.memcached.set(key, value):
+        if not self._measure('set', key, 1, self.memcached.set, key, value,
+                             min_compress_len=self.min_compress_len):
             LOG.critical('Failed to store data in memcached: '
                          'key %(key)s, value %(value)s',
                          {'key': key, 'value': value})
             raise Exception('Memcached set failed')
 
+    def set_multi_by_keys(self, mapping, key_prefix=''):
+        failed = self._measure(
+            'set_multi', key_prefix, len(mapping), self.memcached.set_multi,
+            mapping, key_prefix=key_prefix,
+            min_compress_len=self.min_compress_len)
+        if failed:
+            LOG.critical('Failed to store data in memcached: '
+                         'keys %(keys)s with prefix %(prefix)s',
+                         {'keys': failed, 'prefix': key_prefix})
+            raise Exception('Memcached set_multi failed')
+
     def delete_by_key(self, key):
         if six.PY2:
             key = key.encode('utf8')
-        if not self.memcached.delete(key):
+        if not self._measure('delete', key, 1, self.memcached.delete, key):
             LOG.critical('Failed to delete data from memcached: key %s', key)
             raise Exception('Memcached delete failed')
 
     def get_update(self, pid):
         last_update = self.get_by_key('pid:%s' % pid)
-        update_count = self._get_update_count()
+        update_count = self._get_update_limit()
 
-        self.set_by_key('pid:%s' % pid, update_count)
-        self._set_pids(pid)
+        self._set_pid_update(pid, update_count)
 
         if not last_update:
             for i in self.get_all_records():
                 yield i
         else:
-            for update_id_set in utils.make_range(last_update, update_count,
-                                                  BULK_READ_SIZE):
-                update_set = self.memcached.get_multi(
-                    update_id_set, UPDATE_ID_PREFIX).values()
-                for i in self.memcached.get_multi(
-                        update_set, RECORD_ID_PREFIX).values():
-                    yield i
+            # compaction leaves holes in the log, they are not repaired
+            record_ids = self._read_multi(
+                six.moves.range(last_update, update_count), UPDATE_ID_PREFIX,
+                repair=False)
+            # a record updated several times since the last read is read
+            # once, its latest version is stored under the same key
+            for i in self._read_multi(_iter_unique(record_ids),
+                                      RECORD_ID_PREFIX):
+                yield decode_record(i)
 
     def active_pids(self, pids):
         stored_pids = self.get_by_key('pids') or set()
@@ -178,70 +742,434 @@ class MemcachedStorage(RuntimeStorage):
             if pid not in pids:
                 LOG.debug('Purge dead uwsgi pid %s from pids list', pid)
                 self.delete_by_key('pid:%s' % pid)
+                # readers started before pid times were recorded lack it
+                self._delete_multi(['pid_time:%s' % pid])
 
         self.set_by_key('pids', pids)
 
         # remove unneeded updates
-        min_update = self._get_update_count()
-        for pid in pids:
-            n = self.get_by_key('pid:%s' % pid)
-            if n:
-                if n < min_update:
-                    min_update = n
+        self._purge_updates(self._get_min_pid_update(pids))
 
-        first_valid_update = self.get_by_key('first_valid_update') or 0
-        LOG.debug('Purge polled updates from %(first)s to %(min)s',
-                  {'first': first_valid_update, 'min': min_update})
+    def compact_updates(self, max_pid_age):
+        expired = self._expire_pids(max_pid_age)
+        pid_keys = (['pid:%s' % pid for pid in expired] +
+                    ['pid_time:%s' % pid for pid in expired])
+        self._delete_multi(pid_keys)
 
-        for delete_id_set in utils.make_range(first_valid_update, min_update,
-                                              BULK_DELETE_SIZE):
-            if not self.memcached.delete_multi(delete_id_set,
-                                               key_prefix=UPDATE_ID_PREFIX):
+        min_update = self._get_min_pid_update(self.get_by_key('pids') or set())
+        purged = self._purge_updates(min_update)
+        duplicates = self._collapse_updates(min_update,
+                                            self._get_update_limit())
+
+        return {'expired_pids': len(expired), 'purged_updates': purged,
+                'duplicate_updates': duplicates,
+                'reclaimed_keys': len(pid_keys) + purged + duplicates}
+
+    def _delete_multi(self, keys, key_prefix=''):
+        for i in six.moves.range(0, len(keys), BULK_DELETE_SIZE):
+            chunk = keys[i:i + BULK_DELETE_SIZE]
+            if not self._measure('delete_multi', key_prefix, len(chunk),
+                                 self.memcached.delete_multi, chunk,
+                                 key_prefix=key_prefix):
                 LOG.critical('Failed to delete_multi from memcached')
                 raise Exception('Failed to delete_multi from memcached')
 
+    def _purge_updates(self, min_update):
+        first_valid_update = self.get_by_key('first_valid_update') or 0
+        if min_update <= first_valid_update:
+            return 0
+
+        LOG.debug('Purge polled updates from %(first)s to %(min)s',
+                  {'first': first_valid_update, 'min': min_update})
+
+        self._delete_multi(
+            list(six.moves.range(first_valid_update, min_update)),
+            UPDATE_ID_PREFIX)
         self.set_by_key('first_valid_update', min_update)
+        return min_update - first_valid_update
 
-    def _get_update_count(self):
-        return self.get_by_key('update:count') or 0
+    def _collapse_updates(self, start, stop):
+        # only the latest update of a record is needed by any reader
+        updates = {}
+        for update_id_set in utils.make_range(start, stop, BULK_DELETE_SIZE):
+            updates.update(self._measure(
+                'get_multi', UPDATE_ID_PREFIX, len(update_id_set),
+                self.memcached.get_multi, update_id_set, UPDATE_ID_PREFIX))
 
-    def _set_pids(self, pid):
-        pids = self.get_by_key('pids') or set()
-        if pid in pids:
+        seen = set()
+        duplicates = []
+        for update_id in sorted(updates, reverse=True):
+            record_id = updates[update_id]
+            if record_id in seen:
+                duplicates.append(update_id)
+            else:
+                seen.add(record_id)
+
+        LOG.debug('Collapse %(count)d duplicate updates from %(start)s to '
+                  '%(stop)s', {'count': len(duplicates), 'start': start,
+                               'stop': stop})
+        self._delete_multi(duplicates, UPDATE_ID_PREFIX)
+        return len(duplicates)
+
+    def get_all_records(self):
+        for i in self._read_multi(
+                six.moves.range(0, self._get_record_count()),
+                RECORD_ID_PREFIX):
+            yield decode_record(i)
+
+    def _get_read_pool(self):
+        if not self.read_pool:
+            self.read_pool = pool.ThreadPool(BULK_READ_THREADS)
+        return self.read_pool
+
+    def _get_multi(self, keys, key_prefix, repair=True):
+        received = getattr(self.memcached, 'bytes_received', 0)
+        values = self._measure('get_multi', key_prefix, len(keys),
+                               self.memcached.get_multi, keys, key_prefix)
+        if repair and len(values) < len(keys):
+            self._repair_multi(keys, values, key_prefix)
+        return values, getattr(self.memcached, 'bytes_received', 0) - received
+
+    def _repair_multi(self, keys, values, key_prefix):
+        # memcached may return fewer values than requested, e.g. if the
+        # response exceeds its buffer; retry missing keys in halving chunks
+        # until single keys, what is still missing is really absent
+        missing = [key for key in keys if key not in values]
+        chunk_size = len(keys)
+        while missing and chunk_size > 1:
+            chunk_size = max(chunk_size // 2, 1)
+            LOG.debug('Bulk read of %(prefix)s returned %(missing)d keys '
+                      'less than requested, retry by %(size)d keys',
+                      {'prefix': key_prefix, 'missing': len(missing),
+                       'size': chunk_size})
+            still_missing = []
+            for i in six.moves.range(0, len(missing), chunk_size):
+                chunk = missing[i:i + chunk_size]
+                found = self._measure('get_multi', key_prefix, len(chunk),
+                                      self.memcached.get_multi, chunk,
+                                      key_prefix)
+                values.update(found)
+                still_missing.extend(key for key in chunk if key not in found)
+            missing = still_missing
+
+        if missing:
+            LOG.warn('Keys are missing in memcached: %(prefix)s%(keys)s',
+                     {'prefix': key_prefix, 'keys': missing})
+            self.stats.add_missing(key_prefix, len(missing))
+
+    def _read_multi(self, keys_iterator, key_prefix, repair=True):
+        """Read values by keys keeping several get_multi calls in flight.
+
+        Values are yielded lazily in the order of keys, missing ones are
+        skipped. The size of the next batch is chosen from the average size
+        of values received so far.
+        """
+        keys_iterator = iter(keys_iterator)
+        read_pool = self._get_read_pool()
+        in_flight = collections.deque()
+        batch_size = BULK_READ_SIZE
+        exhausted = False
+
+        while True:
+            while not exhausted and len(in_flight) < BULK_READ_WINDOW:
+                keys = list(itertools.islice(keys_iterator, batch_size))
+                if keys:
+                    in_flight.append((keys, read_pool.apply_async(
+                        self._get_multi, (keys, key_prefix, repair))))
+                else:
+                    exhausted = True
+
+            if not in_flight:
+                break
+
+            keys, result = in_flight.popleft()
+            values, size = result.get()
+
+            if values and size:
+                value_size = max(size // len(values), 1)
+                batch_size = max(BULK_READ_MIN_SIZE, min(
+                    BULK_READ_MAX_SIZE, BULK_READ_TARGET_BYTES // value_size))
+
+            for key in keys:
+                if key in values:
+                    yield values[key]
+
+    def _commit_updates(self, record_ids):
+        count = self._get_update_count()
+        updates = dict((count + n, record_id)
+                       for n, record_id in enumerate(record_ids))
+        if not updates:
             return
-        pids.add(pid)
-        self.set_by_key('pids', pids)
+        self.set_multi_by_keys(updates, UPDATE_ID_PREFIX)
+        self.set_by_key('update:count', count + len(updates))
 
-    def _get_record_name(self, record_id):
-        return RECORD_ID_PREFIX + str(record_id)
 
-    def _get_record_count(self):
-        return self.get_by_key('record:count') or 0
+class SqliteStorage(RuntimeStorage):
+    def __init__(self, uri, compact_records=False, **kwargs):
+        super(SqliteStorage, self).__init__(uri)
 
-    def _set_record_count(self, count):
-        self.set_by_key('record:count', count)
+        path = re.sub(SQLITE_URI_PREFIX, '', uri)
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.compact_records = compact_records
+            self._init_schema()
+            self._init_user_count()
+        else:
+            raise Exception('Invalid storage uri %s' % uri)
 
-    def get_all_records(self):
-        for record_id_set in utils.make_range(0, self._get_record_count(),
-                                              BULK_READ_SIZE):
-            for i in self.memcached.get_multi(
-                    record_id_set, RECORD_ID_PREFIX).values():
+    def _init_schema(self):
+        with self.connection:
+            # WAL allows dashboard workers to read while processor writes
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS kv ('
+                'key TEXT PRIMARY KEY, value BLOB)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS records ('
+                'record_id INTEGER PRIMARY KEY, '
+                'primary_key TEXT NOT NULL UNIQUE, value BLOB NOT NULL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS updates ('
+                'update_id INTEGER PRIMARY KEY, record_id INTEGER NOT NULL)')
+
+    def _dumps(self, value):
+        return sqlite3.Binary(pickle.dumps(value, SQLITE_PICKLE_PROTOCOL))
+
+    def _loads(self, value):
+        return decode_record(pickle.loads(bytes(value)))
+
+    def _dumps_record(self, record):
+        if self.compact_records:
+            return self._dumps(encode_record(record))
+        return self._dumps(record)
+
+    def _get_record_id(self, primary_key):
+        row = self.connection.execute(
+            'SELECT record_id FROM records WHERE primary_key = ?',
+            (primary_key,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def _get_record(self, record_id):
+        row = self.connection.execute(
+            'SELECT value FROM records WHERE record_id = ?',
+            (record_id,)).fetchone()
+        if row:
+            return self._loads(row[0])
+        return None
+
+    def set_records(self, records_iterator, merge_handler=None):
+        record_count = self._get_record_count()
+        bucket = collections.OrderedDict()
+        pending_index = {}
+
+        try:
+            for record in records_iterator:
+                primary_key = record['primary_key']
+                record_id = pending_index.get(primary_key)
+                if record_id is None:
+                    record_id = self._get_record_id(primary_key)
+
+                if record_id is not None:
+                    # update
+                    if not merge_handler:
+                        record['record_id'] = record_id
+                        LOG.debug('Update record %s', record)
+                        bucket[record_id] = record
+                    else:
+                        original = (bucket.get(record_id) or
+                                    self._get_record(record_id))
+                        if merge_handler(original, record):
+                            LOG.debug('Update record with merge %s', record)
+                            bucket[record_id] = original
+                else:
+                    # insert record
+                    record_id = record_count
+                    record_count += 1
+                    record['record_id'] = record_id
+                    pending_index[primary_key] = record_id
+                    LOG.debug('Insert new record %s', record)
+                    bucket[record_id] = record
+
+                if len(bucket) >= BULK_WRITE_SIZE:
+                    self._flush_records(bucket, record_count)
+                    bucket = collections.OrderedDict()
+                    pending_index = {}
+        finally:
+            self._flush_records(bucket, record_count)
+
+    def _flush_records(self, bucket, record_count):
+        if not bucket:
+            return
+
+        LOG.debug('Flush bucket of %d records', len(bucket))
+        update_count = self._get_update_count()
+
+        # records, counters and the update log are committed atomically
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO records '
+                '(record_id, primary_key, value) VALUES (?, ?, ?)',
+                ((record_id, record['primary_key'], self._dumps_record(record))
+                 for record_id, record in six.iteritems(bucket)))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO updates (update_id, record_id) '
+                'VALUES (?, ?)',
+                ((update_count + n, record_id)
+                 for n, record_id in enumerate(bucket.keys())))
+            self._set_value('record:count', record_count)
+            self._set_value('update:count', update_count + len(bucket))
+
+    def apply_corrections(self, corrections_iterator):
+        record_count = self._get_record_count()
+        bucket = collections.OrderedDict()
+
+        for correction in corrections_iterator:
+            record_id = self._get_record_id(correction['primary_key'])
+            if record_id is None:
+                continue
+
+            original = bucket.get(record_id) or self._get_record(record_id)
+            need_update = False
+
+            for field, value in six.iteritems(correction):
+                if (field not in original) or (original[field] != value):
+                    need_update = True
+                    original[field] = value
+
+            if need_update:
+                bucket[record_id] = original
+
+            if len(bucket) >= BULK_WRITE_SIZE:
+                self._flush_records(bucket, record_count)
+                bucket = collections.OrderedDict()
+
+        self._flush_records(bucket, record_count)
+
+    def inc_user_count(self):
+        with self.connection:
+            count = (self.get_by_key('user:count') or 0) + 1
+            self._set_value('user:count', count)
+        return count
+
+    def _split_record_name(self, key):
+        if key.startswith(RECORD_ID_PREFIX):
+            record_id = key[len(RECORD_ID_PREFIX):]
+            if record_id.isdigit():
+                return int(record_id)
+        return None
+
+    def get_by_key(self, key):
+        record_id = self._split_record_name(key)
+        if record_id is not None:
+            return self._get_record(record_id)
+
+        row = self.connection.execute(
+            'SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        if row:
+            return self._loads(row[0])
+        return None
+
+    def _set_value(self, key, value):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)',
+            (key, self._dumps(value)))
+
+    def set_by_key(self, key, value):
+        if self._split_record_name(key) is not None:
+            raise Exception('Records must be stored with set_records, '
+                            'key %s' % key)
+        with self.connection:
+            self._set_value(key, value)
+
+    def delete_by_key(self, key):
+        with self.connection:
+            self.connection.execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def get_update(self, pid):
+        last_update = self.get_by_key('pid:%s' % pid)
+        update_count = self._get_update_limit()
+
+        self._set_pid_update(pid, update_count)
+
+        if not last_update:
+            for i in self.get_all_records():
                 yield i
+        else:
+            for update_id_set in utils.make_range(last_update, update_count,
+                                                  SQLITE_READ_SIZE):
+                rows = self.connection.execute(
+                    'SELECT value FROM records WHERE record_id IN ('
+                    'SELECT record_id FROM updates '
+                    'WHERE update_id >= ? AND update_id < ?)',
+                    (update_id_set[0], update_id_set[-1] + 1)).fetchall()
+                for row in rows:
+                    yield self._loads(row[0])
 
-    def _commit_update(self, record_id):
-        count = self._get_update_count()
-        self.set_by_key(UPDATE_ID_PREFIX + str(count), record_id)
-        self.set_by_key('update:count', count + 1)
+    def active_pids(self, pids):
+        stored_pids = self.get_by_key('pids') or set()
+        for pid in stored_pids:
+            if pid not in pids:
+                LOG.debug('Purge dead uwsgi pid %s from pids list', pid)
+                self.delete_by_key('pid:%s' % pid)
+                self.delete_by_key('pid_time:%s' % pid)
 
-    def _init_user_count(self):
-        if not self.get_by_key('user:count'):
-            self.set_by_key('user:count', 1)
+        self.set_by_key('pids', pids)
+
+        # remove unneeded updates
+        self._purge_updates(self._get_min_pid_update(pids))
+
+    def compact_updates(self, max_pid_age):
+        expired = self._expire_pids(max_pid_age)
+        for pid in expired:
+            self.delete_by_key('pid:%s' % pid)
+            self.delete_by_key('pid_time:%s' % pid)
+
+        min_update = self._get_min_pid_update(self.get_by_key('pids') or set())
+        purged = self._purge_updates(min_update)
+
+        # only the latest update of a record is needed by any reader
+        window = (min_update, self._get_update_limit())
+        with self.connection:
+            duplicates = self.connection.execute(
+                'DELETE FROM updates WHERE update_id >= ? AND update_id < ? '
+                'AND update_id NOT IN (SELECT MAX(update_id) FROM updates '
+                'WHERE update_id >= ? AND update_id < ? GROUP BY record_id)',
+                window + window).rowcount
+
+        return {'expired_pids': len(expired), 'purged_updates': purged,
+                'duplicate_updates': duplicates,
+                'reclaimed_keys': len(expired) * 2 + purged + duplicates}
+
+    def _purge_updates(self, min_update):
+        LOG.debug('Purge polled updates up to %s', min_update)
+        with self.connection:
+            purged = self.connection.execute(
+                'DELETE FROM updates WHERE update_id < ?',
+                (min_update,)).rowcount
+            self._set_value('first_valid_update', min_update)
+        return purged
+
+    def get_all_records(self):
+        # rows are fetched page by page, so that callers are free to write
+        # records while iterating
+        for record_id_set in utils.make_range(0, self._get_record_count(),
+                                              SQLITE_READ_SIZE):
+            rows = self.connection.execute(
+                'SELECT value FROM records '
+                'WHERE record_id >= ? AND record_id < ? ORDER BY record_id',
+                (record_id_set[0], record_id_set[-1] + 1)).fetchall()
+            for row in rows:
+                yield self._loads(row[0])
 
 
-def get_runtime_storage(uri):
+def get_runtime_storage(uri, **kwargs):
     LOG.debug('Runtime storage is requested for uri %s', uri)
-    match = re.search(MEMCACHED_URI_PREFIX, uri)
-    if match:
-        return MemcachedStorage(uri)
+    if (re.search(MEMCACHED_URI_PREFIX, uri) or
+            re.search(MEMCACHED_RING_URI_PREFIX, uri)):
+        return MemcachedStorage(uri, **kwargs)
+    elif re.search(SQLITE_URI_PREFIX, uri):
+        return SqliteStorage(uri, **kwargs)
     else:
         raise Exception('Unknown runtime storage uri %s' % uri)
@@ -53,6 +53,7 @@ def store_user(runtime_storage_inst, user):
     if not write_flag:
         return
 
+    runtime_storage_inst.mark_users_changed()
     runtime_storage_inst.set_by_key('user:%d' % user['seq'], user)
     if user.get('user_id'):
         runtime_storage_inst.set_by_key('user:%s' % user['user_id'], user)
@@ -93,6 +94,7 @@ def load_user(runtime_storage_inst, seq=None, user_id=None, email=None,
 
 def delete_user(runtime_storage_inst, user):
     LOG.debug('Delete user: %s', user)
+    runtime_storage_inst.mark_users_changed()
     runtime_storage_inst.delete_by_key('user:%s' % user['seq'])
 
 
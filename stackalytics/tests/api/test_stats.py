@@ -13,6 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import mock
+
+from stackalytics.dashboard import decorators
+from stackalytics.processor import runtime_storage
 from stackalytics.tests.api import test_api
 
 
@@ -57,6 +61,18 @@ class TestAPIStats(test_api.TestAPI):
             self.assertEqual(60, stats[1]['metric'])
             self.assertEqual('nova', stats[1]['id'])
 
+            # records selected by the same filter are reused by other
+            # metrics and endpoints
+            response = self.app.get('/api/1.0/stats/modules?metric=commits&'
+                                    'project_type=all')
+            stats = test_api.load_json(response)['stats']
+            self.assertEqual(3, stats[0]['metric'])
+            self.app.get('/api/1.0/stats/companies?metric=commits&'
+                         'project_type=all')
+            filter_cache = test_api.web.app.stackalytics_vault['filter_cache']
+            self.assertEqual(2, filter_cache.stats['hits'])
+            self.assertLess(0, filter_cache.size)
+
     def test_get_engineers(self):
         with test_api.make_runtime_storage(
                 {
@@ -176,3 +192,90 @@ class TestAPIStats(test_api.TestAPI):
             self.assertEqual('john_doe', stats[0]['id'])
             self.assertEqual(3, stats[0]['commit'])
             self.assertEqual(2, stats[0]['1'])
+
+    def test_profile_change_invalidates_cache(self):
+        data = {
+            'repos': [{'module': 'nova', 'organization': 'openstack',
+                       'uri': 'git://git.openstack.org/openstack/nova.git'}],
+            'releases': [{'release_name': 'prehistory',
+                          'end_date': 1234567890},
+                         {'release_name': 'icehouse',
+                          'end_date': 1234567890}],
+            'module_groups': {'nova': test_api.make_module('nova')},
+            'project_types': [{'id': 'all', 'title': 'All',
+                               'modules': ['nova']}],
+            'user:john_doe': {
+                'seq': 1, 'user_id': 'john_doe', 'user_name': 'John Doe',
+                'companies': [{'company_name': 'NEC', 'end_date': 0}],
+                'emails': ['john_doe@gmail.com'], 'core': []}}
+        metadata = dict((key, runtime_storage.get_digest(data.get(key)))
+                        for key in runtime_storage.METADATA_KEYS)
+        data['epoch'] = {'epoch': 1, 'update_count': 1, 'metadata': metadata}
+        with test_api.make_runtime_storage(
+                data, test_api.make_records(record_type=['commit'],
+                                            module=['nova'],
+                                            user_id=['john_doe'])) as storage:
+            url = ('/api/1.0/stats/engineers?metric=commits&'
+                   'project_type=all&module=nova')
+            stats = test_api.load_json(self.app.get(url))['stats']
+            self.assertIsNone(stats[0]['core'])
+
+            # the processor updates the profile only, no records change
+            data['user:john_doe'] = dict(data['user:john_doe'],
+                                         core=[('nova', 'master')])
+            data['epoch'] = {'epoch': 2, 'update_count': 1,
+                             'metadata': dict(metadata, user_version='1')}
+            test_api.web.app.stackalytics_vault['vault_next_update_time'] = 0
+            with mock.patch.object(storage, 'get_update',
+                                   return_value=iter([])):
+                stats = test_api.load_json(self.app.get(url))['stats']
+            self.assertEqual('master', stats[0]['core'])
+
+    def _test_conditional_get(self, data):
+        data.update({
+            'repos': [{'module': 'nova', 'organization': 'openstack',
+                       'uri': 'git://git.openstack.org/openstack/nova.git'}],
+            'releases': [{'release_name': 'prehistory',
+                          'end_date': 1234567890},
+                         {'release_name': 'icehouse',
+                          'end_date': 1234567890}],
+            'module_groups': {'nova': test_api.make_module('nova')},
+            'project_types': [{'id': 'all', 'title': 'All',
+                               'modules': ['nova']}]})
+        with test_api.make_runtime_storage(
+                data, test_api.make_records(record_type=['commit'],
+                                            module=['nova'])):
+            url = '/api/1.0/stats/modules?metric=commits&project_type=all'
+            response = self.app.get(url)
+            self.assertEqual(200, response.status_code)
+            etag = response.headers['etag']
+
+            response = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(b'', response.data)
+            self.assertEqual(etag, response.headers['etag'])
+
+            # proxies that compress responses weaken their ETags
+            with mock.patch('stackalytics.dashboard.decorators.'
+                            '_prepare_params',
+                            side_effect=decorators._prepare_params) as prepare:
+                response = self.app.get(url,
+                                        headers={'If-None-Match': 'W/' + etag})
+            self.assertEqual(304, response.status_code)
+            # a versioned response is not made to be compared
+            self.assertEqual('epoch' not in data, prepare.called)
+
+            response = self.app.get(url + '&callback=cb',
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(200, response.status_code)
+            return etag
+
+    def test_conditional_get_by_body_digest(self):
+        self._test_conditional_get({})
+
+    def test_conditional_get_by_data_version(self):
+        etag = self._test_conditional_get(
+            {'epoch': {'epoch': 1, 'update_count': 1}})
+        # the tag is known before the response is made
+        self.assertNotEqual(etag, self._test_conditional_get(
+            {'epoch': {'epoch': 2, 'update_count': 2}}))
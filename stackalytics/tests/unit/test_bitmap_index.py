@@ -0,0 +1,165 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+
+import testtools
+
+from stackalytics.dashboard import bitmap_index
+
+
+class TestRecordIdSet(testtools.TestCase):
+
+    def test_operations(self):
+        first = bitmap_index.RecordIdSet([1, 5, 9, 1000])
+        second = bitmap_index.RecordIdSet([5, 1000, 2000])
+
+        self.assertEqual([5, 1000], list(first & second))
+        self.assertEqual([1, 5, 9, 1000, 2000], list(first | second))
+        self.assertEqual([1, 9], list(first - second))
+        self.assertEqual(4, len(first))
+        self.assertIn(1000, first)
+        self.assertNotIn(2000, first)
+        self.assertNotIn(100000, first)
+
+    def test_operations_with_iterables(self):
+        ids = bitmap_index.RecordIdSet([1, 2, 3])
+
+        self.assertEqual(set([2, 3]), ids & [2, 3, 4])
+        self.assertEqual(set([2, 3]), [2, 3, 4] & ids)
+        self.assertEqual(set([1, 2, 3, 4]), set([4]) | ids)
+        self.assertEqual(set([4]), set([3, 4]) - ids)
+
+    def test_empty(self):
+        ids = bitmap_index.RecordIdSet()
+
+        self.assertFalse(ids)
+        self.assertEqual(0, len(ids))
+        self.assertEqual([], list(ids))
+        self.assertEqual(set(), ids & [1, 2])
+
+
+class TestBitmapIndex(testtools.TestCase):
+
+    def test_add_remove(self):
+        index = bitmap_index.BitmapIndex()
+        for n in range(10):
+            index.add('even' if n % 2 == 0 else 'odd', n)
+        index.commit()
+
+        self.assertEqual([0, 2, 4, 6, 8], list(index['even']))
+        self.assertEqual(set(range(10)), index.get(['even', 'odd']))
+        self.assertEqual(set(), index.get(['unknown']))
+
+        # record 4 is moved to another key within a single update
+        index.remove('even', 4)
+        index.add('odd', 4)
+        index.remove('odd', 7)
+        index.add('odd', 7)
+        index.commit()
+
+        self.assertEqual([0, 2, 6, 8], list(index['even']))
+        self.assertEqual([1, 3, 4, 5, 7, 9], list(index['odd']))
+
+    def test_sparse_and_dense_keys(self):
+        index = bitmap_index.BitmapIndex()
+        for n in range(1000):
+            index.add('dense', n)
+        index.add('sparse', 10)
+        index.add('sparse', 999)
+        index.commit()
+
+        self.assertIsInstance(index.containers['sparse'], array.array)
+        self.assertNotIsInstance(index.containers['dense'], array.array)
+        self.assertEqual(set([10, 999]),
+                         index['dense'] & index['sparse'])
+
+        for n in range(10, 1000):
+            index.remove('dense', n)
+        index.commit()
+        self.assertIsInstance(index.containers['dense'], array.array)
+        self.assertEqual(list(range(10)), list(index['dense']))
+
+    def test_keys_intersecting(self):
+        index = bitmap_index.BitmapIndex()
+        for n in range(100):
+            index.add('all', n)
+        index.add('few', 42)
+        index.add('other', 7)
+        index.commit()
+
+        self.assertEqual(set(['all', 'few']), set(
+            index.keys_intersecting(bitmap_index.RecordIdSet([42]))))
+        self.assertEqual(set(['all', 'other']),
+                         set(index.keys_intersecting([7])))
+
+
+class TestDateIndex(testtools.TestCase):
+
+    def setUp(self):
+        super(TestDateIndex, self).setUp()
+        self.index = bitmap_index.DateIndex()
+        # record n is made on day 100 + n // 3, every tenth day is empty
+        for n in range(300):
+            if (n // 3) % 10:
+                self.index.add(100 + n // 3, n)
+        self.index.commit()
+
+    def _expected(self, start_day, end_day):
+        return set(n for n in range(300)
+                   if (n // 3) % 10 and start_day <= 100 + n // 3 <= end_day)
+
+    def test_get_range(self):
+        for start_day, end_day in [(0, 50), (0, 1000), (105, 105),
+                                   (110, 110), (99, 140), (120, 199),
+                                   (150, 300)]:
+            self.assertEqual(self._expected(start_day, end_day),
+                             self.index.get_range(start_day, end_day))
+        self.assertEqual(self._expected(101, 102),
+                         self.index.get([101, 102, 110]))
+        self.assertEqual(101, self.index.days[0])
+
+    def test_move_records(self):
+        # records move from day 101 to day 110 that was empty
+        for n in range(3, 6):
+            self.index.remove(101, n)
+            self.index.add(110, n)
+        self.index.remove(102, 6)
+        self.index.commit()
+
+        self.assertEqual(set(), self.index[101])
+        self.assertEqual(set([3, 4, 5]), self.index[110])
+        self.assertNotIn(101, self.index)
+        self.assertEqual(self._expected(0, 1000) - set([6]),
+                         self.index.get_range(0, 1000))
+
+    def test_commit_merges_staged_days(self):
+        copy = self.index.copy()
+        # new records after the last day, on a new day in the middle and
+        # on an existing day
+        self.index.add(300, 1000)
+        self.index.add(110, 1001)
+        self.index.add(105, 1002)
+        self.index.commit()
+
+        expected = self._expected(0, 1000) | set([1000, 1001, 1002])
+        self.assertEqual(expected, self.index.get_range(0, 1000))
+        self.assertEqual(set([15, 16, 17, 1002]), self.index[105])
+        self.assertEqual(set([1001]), self.index[110])
+        self.assertEqual(set([1000]), self.index.get_range(200, 300))
+        self.assertEqual(sorted(self.index.days), list(self.index.days))
+        self.assertEqual(len(self.index.ids), self.index.offsets[-1])
+        # the copy keeps reading the arrays it had
+        self.assertEqual(self._expected(0, 1000), copy.get_range(0, 1000))
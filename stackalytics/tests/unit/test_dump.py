@@ -66,3 +66,8 @@ class TestDump(testtools.TestCase):
                 expected_calls.append(mock.call(('record:%d' % i,
                                                  data['record:%d' % i]), fd))
             pickle_dump.assert_has_calls(expected_calls, any_order=True)
+
+    def test_connect_to_memcached(self):
+        self.assertIsNone(dump._connect_to_memcached('sqlite:///tmp/db'))
+        self.assertIsNotNone(dump._connect_to_memcached(
+            'memcached+ring://127.0.0.1:11211'))
@@ -0,0 +1,71 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+
+import testtools
+
+from stackalytics.dashboard import memory_report
+from stackalytics.dashboard import memory_storage
+from stackalytics.dashboard import response_cache
+from stackalytics.dashboard import vault
+
+
+class TestMemoryReport(testtools.TestCase):
+
+    def test_get_size_counts_shared_objects_once(self):
+        shared = 'x' * 100
+        first = [shared]
+        second = {'key': shared}
+        seen = set()
+
+        self.assertEqual(sys.getsizeof(first) + sys.getsizeof(shared),
+                         memory_report.get_size(first, seen))
+        self.assertEqual(sys.getsizeof(second) + sys.getsizeof('key'),
+                         memory_report.get_size(second, seen))
+
+    def _test_get_report(self, memory_storage_type):
+        memory_storage_inst = memory_storage.get_memory_storage(
+            memory_storage_type)
+        memory_storage_inst.update(vault.compact_records(
+            {'record_id': n, 'primary_key': 'pk-%d' % n,
+             'record_type': 'commit', 'company_name': 'Mirantis',
+             'module': 'module-%d' % (n % 3), 'user_id': 'john',
+             'release': 'liberty', 'date': 1435000000, 'week': 2370,
+             'author_name': 'John'} for n in range(10)))
+        cache = response_cache.ResponseCache()
+        cache.set('key', 'value')
+        vault_inst = {'memory_storage': memory_storage_inst,
+                      'user_index': {}, 'cache': cache}
+
+        report = memory_report.get_report(vault_inst)
+
+        structures = dict((s['name'], s) for s in report['structures'])
+        self.assertEqual(10, structures['records']['entries'])
+        self.assertEqual(3, structures['indexes.module']['entries'])
+        self.assertEqual(1, structures['day_index']['entries'])
+        self.assertEqual(1, structures['cache']['entries'])
+        self.assertTrue(all(s['size'] > 0 for s in report['structures']))
+        self.assertEqual(sum(s['size'] for s in report['structures']),
+                         report['total_size'])
+        self.assertIn('hit_rate', report['intern'])
+        self.assertEqual(1, report['cache']['entries'])
+        self.assertIn('indexes.module', memory_report.format_report(report))
+
+    def test_get_report_cached(self):
+        self._test_get_report(memory_storage.MEMORY_STORAGE_CACHED)
+
+    def test_get_report_columnar(self):
+        self._test_get_report(memory_storage.MEMORY_STORAGE_COLUMNAR)
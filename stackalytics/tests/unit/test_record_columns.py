@@ -0,0 +1,91 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import testtools
+
+from stackalytics.dashboard import memory_storage
+from stackalytics.dashboard import record_columns
+from stackalytics.dashboard import vault
+
+
+def _make_records():
+    return list(vault.compact_records([
+        {'record_id': 0, 'primary_key': 'c0', 'record_type': 'commit',
+         'company_name': 'Mirantis', 'module': 'nova', 'user_id': 'john',
+         'release': 'liberty', 'date': 1435000000, 'week': 2370,
+         'author_name': 'John', 'loc': 120, 'blueprint_id': ['nova:bp']},
+        {'record_id': 2, 'primary_key': 'm2', 'record_type': 'mark',
+         'company_name': 'Mirantis', 'module': 'glance', 'user_id': 'jane',
+         'release': 'liberty', 'date': 1435000100, 'week': 2370,
+         'author_name': 'Jane', 'type': 'Code-Review', 'value': -2,
+         'disagreement': True},
+        {'record_id': 3, 'primary_key': 'x3', 'record_type': 'ci_vote',
+         'company_name': '*independent', 'module': 'nova', 'user_id': 'ci',
+         'release': 'liberty', 'date': 1435000200, 'week': 2370,
+         'author_name': 'CI', 'value': True, 'loc': 2 ** 40},
+    ]))
+
+
+class TestColumnarRecords(testtools.TestCase):
+
+    def test_all_aggregate_fields_are_stored(self):
+        records = record_columns.ColumnarRecords()
+        self.assertEqual(set(vault.RECORD_FIELDS_FOR_AGGREGATE),
+                         set(records.columns) | set(['record_id']))
+
+    def test_rows_match_records(self):
+        records = record_columns.ColumnarRecords()
+        for record in _make_records():
+            records[record.record_id] = record
+
+        for record in _make_records():
+            self.assertEqual(record._asdict(),
+                             records[record.record_id]._asdict())
+        self.assertEqual([0, 2, 3], records.keys())
+        self.assertEqual(3, len(records))
+        self.assertNotIn(1, records)
+        self.assertRaises(KeyError, lambda: records[1])
+        self.assertIsNone(records.get(100))
+
+        # values that do not fit typed columns are kept as is
+        self.assertIs(True, records[3].value)
+        self.assertEqual(2 ** 40, records[3].loc)
+        self.assertIsNone(records[2].loc)
+
+    def test_overwrite(self):
+        records = record_columns.ColumnarRecords()
+        record = _make_records()[2]
+        records[3] = record
+        records[3] = record._replace(value=1, loc=None)
+
+        self.assertEqual(1, records[3].value)
+        self.assertIsNone(records[3].loc)
+        self.assertEqual(1, len(records))
+
+
+class TestColumnarMemoryStorage(testtools.TestCase):
+
+    def test_update(self):
+        storage = memory_storage.get_memory_storage(
+            memory_storage.MEMORY_STORAGE_COLUMNAR)
+        storage.update(_make_records())
+
+        record_ids = (storage.get_record_ids_by_modules(['nova']) &
+                      storage.get_record_ids_by_types(['commit']))
+        self.assertEqual([('c0', 120)],
+                         [(r.primary_key, r.loc)
+                          for r in storage.get_records(record_ids)])
+        self.assertEqual('jane',
+                         storage.get_record_by_primary_key('m2').user_id)
@@ -0,0 +1,84 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import testtools
+
+from stackalytics.dashboard import response_cache
+
+
+class TestResponseCache(testtools.TestCase):
+
+    def test_evict_least_recently_used_by_entries(self):
+        cache = response_cache.ResponseCache(max_entries=2)
+        cache.set('a', 'value')
+        cache.set('b', 'value')
+        self.assertEqual('value', cache.get('a'))
+        cache.set('c', 'value')
+
+        self.assertEqual(['a', 'c'], list(cache))
+        self.assertEqual(1, cache.stats['evictions'])
+        self.assertEqual(len('ac') + 2 * len('value'), cache.size)
+
+    def test_evict_by_size(self):
+        cache = response_cache.ResponseCache(max_size=20)
+        cache.set('a', 'x' * 9)
+        cache.set('b', 'x' * 9)
+        cache.set('c', 'x' * 9)
+        # values larger than the cache are not stored at all
+        cache.set('d', 'x' * 20)
+
+        self.assertEqual(['b', 'c'], list(cache))
+        self.assertEqual(20, cache.size)
+
+    def test_hits_and_misses(self):
+        cache = response_cache.ResponseCache()
+        cache.set('a', 'value')
+        cache.get('a')
+        cache.get('b')
+
+        stats = cache.get_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['entries'])
+
+    @mock.patch('time.time')
+    def test_ttl(self, time_mock):
+        time_mock.return_value = 1000
+        cache = response_cache.ResponseCache()
+        cache.set('a', 'value', ttl=10)
+        cache.set('b', 'value')
+
+        time_mock.return_value = 1011
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual('value', cache.get('b'))
+        self.assertEqual(1, cache.stats['expirations'])
+        self.assertEqual(len('b') + len('value'), cache.size)
+
+    def test_invalidate(self):
+        cache = response_cache.ResponseCache()
+        cache.set('commits', 'value', set(['commit']))
+        cache.set('marks', 'value', set(['mark']))
+        cache.set('any', 'value')
+
+        copy = cache.copy()
+        cache.invalidate(set(['mark']))
+        self.assertEqual(['commits'], list(cache))
+        self.assertEqual(3, len(copy))
+
+        cache.invalidate()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.size)
+        self.assertEqual(3, cache.stats['invalidations'])
@@ -0,0 +1,167 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import testtools
+
+from stackalytics.dashboard import memory_storage
+from stackalytics.dashboard import rollup
+from stackalytics.dashboard import vault
+
+
+def _make_records(count=200, offset=0):
+    for n in range(offset, offset + count):
+        yield {'record_id': n, 'primary_key': 'pk-%d' % n,
+               'record_type': ['commit', 'mark'][n % 2],
+               'company_name': 'c%d' % (n % 3), 'module': 'm%d' % (n % 5),
+               'user_id': 'u%d' % (n % 7), 'author_name': 'User %d' % n,
+               'release': ['kilo', 'liberty'][n % 4 // 3],
+               'date': 1435000000 + n * 86400, 'week': 2370 + n // 7,
+               'loc': n if n % 2 == 0 else None}
+
+
+def _aggregate(records, param_id, param_title, field=None):
+    result = {}
+    for record in records:
+        key = getattr(record, param_id)
+        row = result.setdefault(key, {'metric': 0, 'id': key})
+        row['metric'] += getattr(record, field) if field else 1
+        row['name'] = getattr(record, param_title)
+    return result
+
+
+class TestRollupCube(testtools.TestCase):
+
+    def setUp(self):
+        super(TestRollupCube, self).setUp()
+        self.storage = memory_storage.get_memory_storage(
+            memory_storage.MEMORY_STORAGE_CACHED)
+        self.storage.update(vault.compact_records(_make_records()))
+
+    def _select(self, query):
+        record_ids = set(self.storage.get_record_ids())
+        if query.releases is not None:
+            record_ids &= self.storage.get_record_ids_by_releases(
+                query.releases)
+        if query.record_types is not None:
+            record_ids &= self.storage.get_record_ids_by_types(
+                query.record_types)
+        if query.companies is not None:
+            record_ids &= self.storage.get_record_ids_by_companies(
+                query.companies)
+        return self.storage.get_records(sorted(record_ids))
+
+    def test_aggregate(self):
+        query = rollup.RollupQuery()
+        query.releases = set(['liberty'])
+        query.restrict_record_types(['commit', 'mark'])
+        query.restrict_record_types(['commit'])
+        query.companies = set(['c1', 'c2'])
+
+        cube = self.storage.rollup
+        self.assertEqual(_aggregate(self._select(query), 'user_id',
+                                    'author_name'),
+                         cube.aggregate(query, 'user_id', 'author_name'))
+        self.assertEqual(_aggregate(self._select(query), 'module', 'module',
+                                    'loc'),
+                         cube.aggregate(query, 'module', 'module',
+                                        rollup.LOC))
+
+    def test_module_releases(self):
+        query = rollup.RollupQuery()
+        query.module_releases = set([('m1', None), ('m2', 'kilo')])
+
+        result = self.storage.rollup.aggregate(query, 'module', 'module')
+        self.assertEqual(
+            len(self.storage.get_record_ids_by_modules(['m1'])),
+            result['m1']['metric'])
+        self.assertEqual(
+            len(self.storage.get_record_ids_by_module_release('m2', 'kilo')),
+            result['m2']['metric'])
+        self.assertEqual(['m1', 'm2'], sorted(result))
+
+    def test_timeline(self):
+        query = rollup.RollupQuery()
+        query.record_types = set(['commit'])
+
+        loc, commits, commits_hl = self.storage.rollup.timeline(
+            query, 2371, 2375, 'kilo')
+
+        self.assertEqual([2371, 2372, 2373, 2374], sorted(commits))
+        for week in range(2371, 2375):
+            records = [r for r in self._select(query) if r.week == week]
+            self.assertEqual(len(records), commits[week])
+            self.assertEqual(sum(r.loc for r in records), loc[week])
+            self.assertEqual(len([r for r in records if r.release == 'kilo']),
+                             commits_hl[week])
+
+    def test_update_replaces_records(self):
+        self.storage.update(vault.compact_records(
+            dict(r, company_name='c9') for r in _make_records(100)))
+
+        result = self.storage.rollup.aggregate(rollup.RollupQuery(),
+                                               'company_name', 'company_name')
+        self.assertEqual(100, result['c9']['metric'])
+        self.assertEqual(200, sum(r['metric'] for r in result.values()))
+        self.assertEqual(
+            len(self.storage.rollup),
+            len(set(rollup.RollupCube._get_keys(r)
+                    for r in self.storage.get_records(
+                        self.storage.get_record_ids()))))
+
+    def test_last_record_is_recomputed(self):
+        user = {'record_type': 'commit', 'company_name': 'c1',
+                'module': 'm1', 'user_id': 'u-x', 'release': 'kilo',
+                'date': 1435000000, 'week': 2370, 'loc': 1}
+        self.storage.update(vault.compact_records([
+            dict(user, record_id=300, primary_key='pk-300', author_name='A'),
+            dict(user, record_id=301, primary_key='pk-301', author_name='B'),
+            dict(user, record_id=302, primary_key='pk-302', author_name='A'),
+        ]))
+        query = rollup.RollupQuery()
+        query.user_ids = set(['u-x'])
+        self.assertEqual('A', self.storage.rollup.aggregate(
+            query, 'user_id', 'author_name')['u-x']['name'])
+
+        # the last record of the cell moves to another user
+        self.storage.update(vault.compact_records([
+            dict(user, record_id=302, primary_key='pk-302', author_name='A',
+                 user_id='u-y')]))
+
+        self.assertEqual(
+            _aggregate(self.storage.get_records([300, 301]), 'user_id',
+                       'author_name'),
+            self.storage.rollup.aggregate(query, 'user_id', 'author_name'))
+        self.assertEqual(set(), self.storage.rollup.stale)
+
+    def test_record_of_robots_is_removed(self):
+        robot = dict(next(_make_records(1, offset=10)),
+                     company_name='*robots')
+        for n in range(2):
+            self.storage.update(vault.compact_records([robot]))
+
+        result = self.storage.rollup.aggregate(rollup.RollupQuery(),
+                                               'company_name', 'company_name')
+        self.assertEqual(199, sum(r['metric'] for r in result.values()))
+        self.assertNotIn(10, self.storage.get_record_ids())
+
+    def test_cube_is_disabled(self):
+        storage = memory_storage.get_memory_storage(
+            memory_storage.MEMORY_STORAGE_COLUMNAR, rollup_cube=False)
+        storage.update(vault.compact_records(_make_records()))
+        storage.update(vault.compact_records(_make_records(10)))
+
+        self.assertIsNone(storage.rollup)
+        self.assertIsNone(storage.copy().rollup)
+        self.assertEqual(200, len(storage.records))
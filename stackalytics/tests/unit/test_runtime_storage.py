@@ -0,0 +1,636 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import testtools
+
+from stackalytics.processor import runtime_storage
+from stackalytics.processor import user_processor
+from stackalytics.processor import utils
+
+
+class FakeMemcached(object):
+    def __init__(self, *args, **kwargs):
+        self.data = {}
+        self.calls = []
+        self.bytes_received = 0
+        self.value_size = 0
+        self.max_multi = None
+
+    def get(self, key):
+        self.calls.append(('get', key))
+        return self.data.get(key)
+
+    def set(self, key, value, min_compress_len=0):
+        self.calls.append(('set', key))
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        self.calls.append(('delete', key))
+        self.data.pop(key, None)
+        return True
+
+    def incr(self, key, delta=1):
+        self.data[key] = self.data.get(key, 0) + delta
+        return self.data[key]
+
+    def get_multi(self, keys, key_prefix=''):
+        self.calls.append(('get_multi', key_prefix))
+        values = dict((k, self.data[key_prefix + str(k)]) for k in keys
+                      if key_prefix + str(k) in self.data)
+        if self.max_multi:
+            # emulate truncated response
+            values = dict((k, values[k])
+                          for k in sorted(values)[:self.max_multi])
+        self.bytes_received += self.value_size * len(values)
+        return values
+
+    def set_multi(self, mapping, key_prefix='', min_compress_len=0):
+        self.calls.append(('set_multi', key_prefix))
+        for k, v in mapping.items():
+            self.data[key_prefix + str(k)] = v
+        return []
+
+    def delete_multi(self, keys, key_prefix=''):
+        self.calls.append(('delete_multi', key_prefix))
+        for k in keys:
+            self.data.pop(key_prefix + str(k), None)
+        return True
+
+
+def _make_records(count, start=0):
+    for n in range(start, start + count):
+        yield {'primary_key': 'pk-%d' % n, 'value': n}
+
+
+class TestMemcachedStorage(testtools.TestCase):
+
+    def setUp(self):
+        super(TestMemcachedStorage, self).setUp()
+        p = mock.patch('stackalytics.processor.runtime_storage.'
+                       'MemcachedClient', FakeMemcached)
+        p.start()
+        self.addCleanup(p.stop)
+        self.storage = runtime_storage.get_runtime_storage(
+            'memcached://127.0.0.1:11211')
+        self.memcached = self.storage.memcached
+
+    def _count_calls(self, call):
+        return len([c for c in self.memcached.calls if c == call])
+
+    def test_set_records_insert(self):
+        self.storage.set_records(_make_records(10))
+
+        self.assertEqual(10, self.memcached.data['record:count'])
+        self.assertEqual(10, self.memcached.data['update:count'])
+        for n in range(10):
+            record = self.memcached.data['record:%d' % n]
+            self.assertEqual('pk-%d' % n, record['primary_key'])
+            self.assertEqual(n, record['record_id'])
+            self.assertEqual(n, self.memcached.data['update:%d' % n])
+
+    def test_set_records_writes_counters_per_bucket(self):
+        count = runtime_storage.BULK_WRITE_SIZE * 2 + 10
+        self.storage.set_records(_make_records(count))
+
+        self.assertEqual(count, self.memcached.data['record:count'])
+        self.assertEqual(count, self.memcached.data['update:count'])
+        self.assertEqual(3, self._count_calls(('set', 'record:count')))
+        self.assertEqual(3, self._count_calls(('set', 'update:count')))
+        self.assertEqual(3, self._count_calls(('set_multi', 'record:')))
+        self.assertEqual(3, self._count_calls(('set_multi', 'update:')))
+
+    def test_set_records_update_with_merge_in_same_bucket(self):
+        self.storage.set_records(_make_records(3))
+
+        def merge(original, new):
+            return utils.merge_records(original, new)
+
+        self.storage.set_records(iter([
+            {'primary_key': 'pk-1', 'value': 'a'},
+            {'primary_key': 'pk-1', 'extra': 'b'},
+            {'primary_key': 'pk-2', 'value': 2},  # no changes
+        ]), merge)
+
+        record = self.memcached.data['record:1']
+        self.assertEqual('a', record['value'])
+        self.assertEqual('b', record['extra'])
+        self.assertEqual(3, self.memcached.data['record:count'])
+        self.assertEqual(4, self.memcached.data['update:count'])
+        self.assertEqual(1, self.memcached.data['update:3'])
+
+    def test_set_records_flushes_on_error(self):
+        def records():
+            for record in _make_records(2):
+                yield record
+            raise ValueError()
+
+        self.assertRaises(ValueError, self.storage.set_records, records())
+        self.assertEqual(2, self.memcached.data['record:count'])
+        self.assertEqual(2, self.memcached.data['update:count'])
+
+    def test_get_update_after_set_records(self):
+        self.storage.set_records(_make_records(5))
+        self.assertEqual(5, len(list(self.storage.get_update(1))))
+
+        self.storage.set_records(iter([
+            {'primary_key': 'pk-1', 'value': 'a'},
+            {'primary_key': 'pk-new', 'value': 'b'},
+        ]))
+        updates = sorted(self.storage.get_update(1),
+                         key=lambda r: r['record_id'])
+        self.assertEqual([1, 5], [r['record_id'] for r in updates])
+
+    def test_get_update_reads_record_once(self):
+        self.storage.set_records(_make_records(5))
+        list(self.storage.get_update(1))
+
+        for value in ['a', 'b', 'c']:
+            self.storage.set_records(iter([
+                {'primary_key': 'pk-1', 'value': value}]))
+        updates = list(self.storage.get_update(1))
+
+        self.assertEqual([(1, 'c')],
+                         [(r['record_id'], r['value']) for r in updates])
+
+    def test_get_update_stops_at_published_epoch(self):
+        self.storage.set_records(_make_records(3))
+        epoch = self.storage.publish_epoch()
+        self.assertEqual((1, 3), (epoch['epoch'], epoch['update_count']))
+        self.assertEqual(3, len(list(self.storage.get_update(1))))
+
+        self.storage.set_records(iter([{'primary_key': 'pk-1', 'value': 'a'}]))
+        self.assertEqual([], list(self.storage.get_update(1)))
+
+        self.storage.set_records(iter([{'primary_key': 'pk-2', 'value': 'b'}]))
+        self.storage.publish_epoch()
+        updates = sorted(self.storage.get_update(1),
+                         key=lambda r: r['record_id'])
+        self.assertEqual([1, 2], [r['record_id'] for r in updates])
+        epoch = self.storage.get_epoch()
+        self.assertEqual((2, 5), (epoch['epoch'], epoch['update_count']))
+
+    def test_publish_epoch_with_metadata_digests(self):
+        self.storage.set_by_key('releases', [{'release_name': 'kilo'}])
+        self.storage.set_by_key('module_groups', {'nova': {
+            'modules': set(['nova', 'python-novaclient'])}})
+        first = self.storage.publish_epoch()['metadata']
+        self.assertEqual(set(runtime_storage.METADATA_KEYS), set(first))
+
+        self.storage.set_by_key('module_groups', {'nova': {
+            'modules': set(['python-novaclient', 'nova'])}})
+        self.storage.set_by_key('repos', [{'module': 'nova'}])
+        second = self.storage.publish_epoch()['metadata']
+        self.assertEqual(['repos'], [key for key in first
+                                     if first[key] != second[key]])
+
+        user_processor.store_user(self.storage, {'user_id': 'john'})
+        third = self.storage.publish_epoch()['metadata']
+        self.assertEqual(['user_version'], [key for key in second
+                                            if second[key] != third[key]])
+
+    @mock.patch('stackalytics.processor.utils.date_to_timestamp')
+    def test_compact_updates(self, date_to_timestamp):
+        date_to_timestamp.return_value = 1000
+        self.storage.set_records(_make_records(5))
+        list(self.storage.get_update(1))
+        list(self.storage.get_update(2))
+
+        self.storage.set_records(iter([
+            {'primary_key': 'pk-1', 'value': 'a'},
+            {'primary_key': 'pk-2', 'value': 'b'},
+            {'primary_key': 'pk-1', 'value': 'c'},
+        ]))
+        # reader 1 keeps polling, reader 2 is gone
+        date_to_timestamp.return_value = 2000
+        list(self.storage.get_update(1))
+        for record in [{'primary_key': 'pk-3', 'value': 'a'},
+                       {'primary_key': 'pk-1', 'value': 'd'},
+                       {'primary_key': 'pk-3', 'value': 'b'}]:
+            self.storage.set_records(iter([record]))
+
+        report = self.storage.compact_updates(500)
+
+        self.assertEqual({'expired_pids': 1, 'purged_updates': 7,
+                          'duplicate_updates': 1, 'reclaimed_keys': 10},
+                         report)
+        self.assertEqual(set([1]), self.memcached.data['pids'])
+        self.assertNotIn('pid:2', self.memcached.data)
+        self.assertNotIn('pid_time:2', self.memcached.data)
+        self.assertEqual(7, self.memcached.data['first_valid_update'])
+        self.assertNotIn('update:7', self.memcached.data)
+        self.assertEqual(3, self.memcached.data['update:9'])
+
+        updates = sorted(self.storage.get_update(1),
+                         key=lambda r: r['record_id'])
+        self.assertEqual([(1, 'd'), (3, 'b')],
+                         [(r['record_id'], r['value']) for r in updates])
+        self.assertEqual(0, sum(
+            c['missing'] for c in self.storage.stats.as_dict().get(
+                'get_multi', {}).values()))
+
+    def test_stats(self):
+        self.storage.set_records(_make_records(5))
+        list(self.storage.get_all_records())
+
+        stats = self.storage.stats.as_dict()
+        self.assertEqual(5, stats['set_multi']['record:']['keys'])
+        self.assertEqual(5, stats['set_multi']['update:']['keys'])
+        self.assertEqual(5, stats['get_multi']['record:']['keys'])
+        self.assertEqual(1, stats['get_multi']['record:']['calls'])
+        self.assertIn('record:', stats['get'])
+
+    def test_get_all_records_ordered(self):
+        for n in range(1000):
+            self.memcached.data['record:%d' % n] = {'record_id': n}
+        self.memcached.data['record:count'] = 1000
+        del self.memcached.data['record:500']
+
+        records = list(self.storage.get_all_records())
+        self.assertEqual([n for n in range(1000) if n != 500],
+                         [r['record_id'] for r in records])
+
+    def test_get_all_records_repairs_truncated_batches(self):
+        for n in range(300):
+            self.memcached.data['record:%d' % n] = {'record_id': n}
+        self.memcached.data['record:count'] = 300
+        self.memcached.max_multi = 10
+
+        records = list(self.storage.get_all_records())
+
+        self.assertEqual(list(range(300)), [r['record_id'] for r in records])
+        stats = self.storage.stats.as_dict()
+        self.assertEqual(0, stats['get_multi']['record:']['missing'])
+
+    def test_get_all_records_counts_missing(self):
+        for n in range(300):
+            self.memcached.data['record:%d' % n] = {'record_id': n}
+        self.memcached.data['record:count'] = 300
+        del self.memcached.data['record:10']
+        del self.memcached.data['record:200']
+
+        records = list(self.storage.get_all_records())
+
+        self.assertEqual(298, len(records))
+        stats = self.storage.stats.as_dict()
+        self.assertEqual(2, stats['get_multi']['record:']['missing'])
+
+    def test_read_multi_adapts_batch_size(self):
+        for n in range(10000):
+            self.memcached.data['record:%d' % n] = n
+        self.memcached.value_size = runtime_storage.BULK_READ_TARGET_BYTES
+
+        values = list(self.storage._read_multi(range(10000), 'record:'))
+
+        self.assertEqual(list(range(10000)), values)
+        # large values shrink batches to the minimal size
+        self.assertLess(
+            10000 // runtime_storage.BULK_READ_SIZE + 1,
+            self._count_calls(('get_multi', 'record:')))
+
+    def test_read_multi_is_lazy(self):
+        self.memcached.data['record:0'] = 0
+        keys = iter(range(100000))
+        values = self.storage._read_multi(keys, 'record:')
+        next(values, None)
+        self.assertLess(0, len(list(keys)))
+
+    def test_apply_corrections(self):
+        self.storage.set_records(_make_records(3))
+        self.storage.apply_corrections([
+            {'primary_key': 'pk-0', 'value': 'x'},
+            {'primary_key': 'pk-1', 'value': 1},  # no changes
+            {'primary_key': 'pk-unknown', 'value': 'y'},
+        ])
+
+        self.assertEqual('x', self.memcached.data['record:0']['value'])
+        self.assertEqual(4, self.memcached.data['update:count'])
+        self.assertEqual(0, self.memcached.data['update:3'])
+
+    def _reopen_storage(self):
+        data = self.memcached.data
+        self.storage = runtime_storage.get_runtime_storage(
+            'memcached://127.0.0.1:11211')
+        self.memcached = self.storage.memcached
+        self.memcached.data = data
+
+    def test_index_is_persisted(self):
+        self.storage.set_records(_make_records(100))
+        self.assertEqual({'records': 100, 'shards': 4096},
+                         self.memcached.data['pk_index:count'])
+
+        self._reopen_storage()
+        self.storage.set_records(iter([
+            {'primary_key': 'pk-42', 'value': 'a'},
+            {'primary_key': 'pk-new', 'value': 'b'},
+        ]))
+
+        # no full scan of records on start
+        self.assertEqual(0, self._count_calls(('get_multi', 'record:')))
+        self.assertEqual('a', self.memcached.data['record:42']['value'])
+        self.assertEqual(100, self.memcached.data['record:100']['record_id'])
+        self.assertEqual(101, self.memcached.data['record:count'])
+        self.assertEqual(101,
+                         self.memcached.data['pk_index:count']['records'])
+
+    def test_index_is_rebuilt_if_stale(self):
+        self.storage.set_records(_make_records(10))
+        del self.memcached.data['pk_index:count']
+
+        self._reopen_storage()
+        self.storage.set_records(iter([{'primary_key': 'pk-3', 'v': 1}]))
+
+        self.assertEqual(1, self.memcached.data['record:3']['v'])
+        self.assertEqual(10, self.memcached.data['record:count'])
+        self.assertEqual(10,
+                         self.memcached.data['pk_index:count']['records'])
+
+    def test_index_is_rebuilt_if_shard_count_changes(self):
+        self.storage.set_records(_make_records(10))
+        self.memcached.data['pk_index:count']['shards'] = 1024
+
+        self._reopen_storage()
+        self.storage.set_records(iter([{'primary_key': 'pk-3', 'v': 1}]))
+
+        self.assertEqual(1, self._count_calls(('get_multi', 'record:')))
+        self.assertEqual(1, self.memcached.data['record:3']['v'])
+        self.assertEqual(10, self.memcached.data['record:count'])
+
+    def test_index_is_flushed_once_per_run(self):
+        self.storage.set_records(_make_records(1000))
+        flushes = self._count_calls(('set_multi', 'pk_index:'))
+
+        self.assertEqual(1000, self.memcached.data['record:count'])
+        # all shards fit into the writes of a single flush
+        self.assertLessEqual(flushes, 4096 // 64)
+        self.assertEqual(1, len([c for c in self.memcached.calls
+                                 if c == ('set', 'pk_index:count')]))
+
+    def test_index_shard_is_rebuilt_if_evicted(self):
+        self.storage.set_records(_make_records(10))
+        n = self.storage._get_index_shard_number('pk-5')
+        del self.memcached.data['pk_index:%d' % n]
+
+        self._reopen_storage()
+        self.storage.set_records(iter([{'primary_key': 'pk-5', 'v': 1}]))
+
+        self.assertEqual(1, self.memcached.data['record:5']['v'])
+        self.assertEqual(10, self.memcached.data['record:count'])
+        self.assertIn('pk-5', self.memcached.data['pk_index:%d' % n])
+
+    def test_compact_records(self):
+        self.storage.compact_records = True
+        self.storage.set_records(_make_records(3))
+
+        stored = self.memcached.data['record:1']
+        self.assertEqual(runtime_storage.COMPACT_RECORD_TAG, stored[0])
+        self.assertEqual({'primary_key': 'pk-1', 'value': 1,
+                          'record_id': 1},
+                         self.storage.get_by_key('record:1'))
+        self.assertEqual([0, 1, 2], sorted(
+            r['record_id'] for r in self.storage.get_all_records()))
+
+    def test_compact_records_mixed_with_plain(self):
+        self.storage.set_records(_make_records(2))
+        self.storage.compact_records = True
+        self.storage.set_records(_make_records(2, start=2))
+
+        self.assertIsInstance(self.memcached.data['record:0'], dict)
+        self.assertEqual([0, 1, 2, 3], sorted(
+            r['record_id'] for r in self.storage.get_all_records()))
+
+
+class TestStorageStats(testtools.TestCase):
+
+    def test_add(self):
+        stats = runtime_storage.StorageStats(log_interval=0)
+        stats.add('get', 'record:1', 1, 100, 0.0005)
+        stats.add('get', b'record:count', 1, 10, 0.003)
+        stats.add('get', 'bug_modified_since-nova', 1, 5, 2)
+
+        result = stats.as_dict()
+        record = result['get']['record:']
+        self.assertEqual(2, record['calls'])
+        self.assertEqual(110, record['bytes'])
+        self.assertEqual(1, record['latency']['0.001'])
+        self.assertEqual(1, record['latency']['0.005'])
+        self.assertEqual(1, result['get']['other']['latency']['inf'])
+
+    def test_log_missing_keys(self):
+        stats = runtime_storage.StorageStats(log_interval=0)
+        stats.add('get_multi', 'record:', 10, 100, 0.001)
+        stats.add_missing('record:', 2)
+
+        self.assertEqual(2, stats.as_dict()['get_multi']['record:']['missing'])
+        with mock.patch.object(runtime_storage.LOG, 'info') as log:
+            stats.log_summary()
+        self.assertIn('2 keys missing', log.call_args[0][0] %
+                      log.call_args[0][1])
+
+    def test_log_summary_periodically(self):
+        stats = runtime_storage.StorageStats(log_interval=60)
+        with mock.patch.object(stats, 'log_summary') as log_summary:
+            stats.add('get', 'pid:1', 1, 0, 0.001)
+            self.assertFalse(log_summary.called)
+            stats.last_log_time -= 60
+            stats.add('get', 'pid:1', 1, 0, 0.001)
+            self.assertTrue(log_summary.called)
+
+
+class TestConsistentHashMemcachedClient(testtools.TestCase):
+
+    def setUp(self):
+        super(TestConsistentHashMemcachedClient, self).setUp()
+        p = mock.patch('memcache._Host.connect', return_value=True)
+        self.connect = p.start()
+        self.addCleanup(p.stop)
+
+    def _place(self, client, keys):
+        return dict((key, client._get_server(key)[0].address)
+                    for key in keys)
+
+    def test_make_memcached_client(self):
+        client = runtime_storage.make_memcached_client(
+            'memcached+ring://10.0.0.1:11211,10.0.0.2:11211')
+        self.assertIsInstance(
+            client, runtime_storage.ConsistentHashMemcachedClient)
+        client = runtime_storage.make_memcached_client(
+            'memcached://10.0.0.1:11211')
+        self.assertNotIsInstance(
+            client, runtime_storage.ConsistentHashMemcachedClient)
+        self.assertRaises(Exception, runtime_storage.make_memcached_client,
+                          'memcached+ring://')
+
+    def test_adding_server_moves_few_keys(self):
+        servers = ['10.0.0.%d:11211' % n for n in range(1, 4)]
+        keys = ['record:%d' % n for n in range(3000)]
+        before = self._place(
+            runtime_storage.ConsistentHashMemcachedClient(servers), keys)
+        after = self._place(runtime_storage.ConsistentHashMemcachedClient(
+            servers + ['10.0.0.4:11211']), keys)
+
+        moved = [key for key in keys if before[key] != after[key]]
+        self.assertTrue(len(moved) < len(keys) * 0.4)
+        self.assertEqual(set([('10.0.0.4', 11211)]),
+                         set(after[key] for key in moved))
+
+    def test_pinned_keys(self):
+        servers = ['10.0.0.%d:11211' % n for n in range(1, 5)]
+        client = runtime_storage.ConsistentHashMemcachedClient(servers)
+        keys = ['record:count', 'update:count', 'pids', 'pid:123',
+                b'pid_time:123', 'epoch']
+        self.assertEqual(set([('10.0.0.1', 11211)]),
+                         set(self._place(client, keys).values()))
+
+    def test_dead_server_is_skipped(self):
+        servers = ['10.0.0.1:11211', '10.0.0.2:11211']
+        client = runtime_storage.ConsistentHashMemcachedClient(servers)
+        client.servers[1].connect = mock.Mock(return_value=False)
+
+        placement = self._place(client, ['record:%d' % n for n in range(100)])
+        self.assertEqual(set([('10.0.0.1', 11211)]), set(placement.values()))
+
+
+class TestRecordCodec(testtools.TestCase):
+
+    def test_encode_decode(self):
+        record = {'record_id': 5, 'primary_key': 'I123', 'date': 1234,
+                  'value': None, 'blueprint_id': ['nova:bp'],
+                  'unknown_field': {'a': 1}}
+        encoded = runtime_storage.encode_record(record)
+        self.assertEqual(runtime_storage.COMPACT_RECORD_TAG, encoded[0])
+        self.assertEqual({'unknown_field': {'a': 1}}, encoded[3])
+        self.assertEqual(record, runtime_storage.decode_record(encoded))
+
+    def test_decode_plain_values(self):
+        record = {'record_id': 5, 'primary_key': 'I123'}
+        self.assertEqual(record, runtime_storage.decode_record(record))
+        self.assertEqual(10, runtime_storage.decode_record(10))
+        self.assertEqual((1, 2), runtime_storage.decode_record((1, 2)))
+        self.assertIsNone(runtime_storage.decode_record(None))
+
+
+class TestSqliteStorage(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSqliteStorage, self).setUp()
+        self.storage = runtime_storage.get_runtime_storage('sqlite://:memory:')
+
+    def test_set_records_insert(self):
+        self.storage.set_records(_make_records(10))
+
+        self.assertEqual(10, self.storage.get_by_key('record:count'))
+        self.assertEqual(10, self.storage.get_by_key('update:count'))
+        records = list(self.storage.get_all_records())
+        self.assertEqual(list(range(10)), [r['record_id'] for r in records])
+        self.assertEqual('pk-7', self.storage.get_by_key('record:7')[
+            'primary_key'])
+
+    def test_set_records_update_with_merge(self):
+        self.storage.set_records(_make_records(3))
+        self.storage.set_records(iter([
+            {'primary_key': 'pk-1', 'value': 'a'},
+            {'primary_key': 'pk-1', 'extra': 'b'},
+            {'primary_key': 'pk-new', 'value': 'c'},
+            {'primary_key': 'pk-new', 'extra': 'd'},
+        ]), utils.merge_records)
+
+        record = self.storage.get_by_key('record:1')
+        self.assertEqual('a', record['value'])
+        self.assertEqual('b', record['extra'])
+        record = self.storage.get_by_key('record:3')
+        self.assertEqual('c', record['value'])
+        self.assertEqual('d', record['extra'])
+        self.assertEqual(4, self.storage.get_by_key('record:count'))
+
+    def test_get_update_and_active_pids(self):
+        self.storage.set_records(_make_records(5))
+        self.assertEqual(5, len(list(self.storage.get_update(1))))
+
+        self.storage.set_records(iter([
+            {'primary_key': 'pk-1', 'value': 'a'},
+            {'primary_key': 'pk-new', 'value': 'b'},
+        ]))
+        self.storage.active_pids(set([1]))
+
+        updates = sorted(self.storage.get_update(1),
+                         key=lambda r: r['record_id'])
+        self.assertEqual([1, 5], [r['record_id'] for r in updates])
+        self.assertEqual([], list(self.storage.get_update(1)))
+
+    def test_apply_corrections(self):
+        self.storage.set_records(_make_records(3))
+        self.storage.apply_corrections([
+            {'primary_key': 'pk-0', 'value': 'x'},
+            {'primary_key': 'pk-unknown', 'value': 'y'},
+        ])
+
+        self.assertEqual('x', self.storage.get_by_key('record:0')['value'])
+        self.assertEqual(4, self.storage.get_by_key('update:count'))
+
+    def test_resume_update(self):
+        self.storage.set_records(_make_records(5))
+        list(self.storage.get_update(1))
+        self.assertEqual(5, self.storage.get_update_position(1))
+
+        self.storage.set_records(iter([{'primary_key': 'pk-2',
+                                        'value': 'a'}]))
+        self.assertTrue(self.storage.resume_update(2, 5))
+        self.assertEqual([2], [r['record_id']
+                               for r in self.storage.get_update(2)])
+
+        # updates before the position of the only reader are purged
+        self.storage.active_pids(set([2]))
+        self.assertFalse(self.storage.resume_update(3, 4))
+        self.assertFalse(self.storage.resume_update(3, None))
+        self.assertIsNone(self.storage.get_update_position(3))
+
+    @mock.patch('stackalytics.processor.utils.date_to_timestamp')
+    def test_compact_updates(self, date_to_timestamp):
+        date_to_timestamp.return_value = 1000
+        self.storage.set_records(_make_records(5))
+        list(self.storage.get_update(1))
+        list(self.storage.get_update(2))
+
+        date_to_timestamp.return_value = 2000
+        list(self.storage.get_update(1))
+        self.storage.set_records(iter([{'primary_key': 'pk-1', 'value': 'a'}]))
+        self.storage.set_records(iter([{'primary_key': 'pk-1', 'value': 'b'}]))
+        report = self.storage.compact_updates(500)
+
+        self.assertEqual({'expired_pids': 1, 'purged_updates': 5,
+                          'duplicate_updates': 1, 'reclaimed_keys': 8},
+                         report)
+        self.assertIsNone(self.storage.get_by_key('pid:2'))
+        self.assertEqual(set([1]), self.storage.get_by_key('pids'))
+        updates = list(self.storage.get_update(1))
+        self.assertEqual([('pk-1', 'b')],
+                         [(r['primary_key'], r['value']) for r in updates])
+
+    def test_compact_records(self):
+        storage = runtime_storage.get_runtime_storage(
+            'sqlite://:memory:', compact_records=True)
+        storage.set_records(_make_records(3))
+        self.assertEqual({'primary_key': 'pk-1', 'value': 1,
+                          'record_id': 1}, storage.get_by_key('record:1'))
+
+    def test_users(self):
+        self.assertEqual(2, self.storage.inc_user_count())
+        self.storage.set_by_key('user:2', {'user_id': 'john_doe'})
+        self.assertEqual([{'user_id': 'john_doe'}],
+                         list(self.storage.get_all_users()))
+        self.storage.delete_by_key('user:2')
+        self.assertIsNone(self.storage.get_by_key('user:2'))
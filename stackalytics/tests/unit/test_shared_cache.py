@@ -0,0 +1,108 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+import mock
+import testtools
+
+from stackalytics.dashboard import shared_cache
+
+
+class FakeMemcached(object):
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, time=0, min_compress_len=0):
+        self.data[key] = value
+        return True
+
+    def add(self, key, value, time=0):
+        with self.lock:
+            if key in self.data:
+                return False
+            self.data[key] = value
+            return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+        return True
+
+
+class TestSharedCache(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSharedCache, self).setUp()
+        self.memcached = FakeMemcached()
+        with mock.patch('stackalytics.processor.runtime_storage.'
+                        'make_memcached_client') as make_client:
+            make_client.return_value = self.memcached
+            self.cache = shared_cache.SharedCache('memcached://x', 60, 5)
+
+    def test_get_or_compute(self):
+        compute = mock.Mock(return_value='value')
+
+        self.assertEqual('value', self.cache.get_or_compute('k', 'v1',
+                                                            compute))
+        self.assertEqual('value', self.cache.get_or_compute('k', 'v1',
+                                                            compute))
+        self.assertEqual(1, compute.call_count)
+
+        # responses computed from other data are not shared
+        self.cache.get_or_compute('k', 'v2', compute)
+        self.assertEqual(2, compute.call_count)
+        self.assertFalse(any(key.endswith(shared_cache.LOCK_SUFFIX)
+                             for key in self.memcached.data))
+
+    def test_concurrent_misses_compute_once(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'value'
+
+        results = []
+        first = threading.Thread(target=lambda: results.append(
+            self.cache.get_or_compute('k', 'v1', compute)))
+        first.start()
+        started.wait()
+
+        second = threading.Thread(target=lambda: results.append(
+            self.cache.get_or_compute('k', 'v1', compute)))
+        second.start()
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(['value', 'value'], results)
+        self.assertEqual(1, len(calls))
+
+    def test_compute_if_lock_is_released_without_value(self):
+        lock_key = (self.cache._make_key('k', 'v1') +
+                    shared_cache.LOCK_SUFFIX)
+        self.memcached.data[lock_key] = 1
+
+        with mock.patch('time.sleep') as sleep:
+            sleep.side_effect = lambda s: self.memcached.delete(lock_key)
+            self.assertEqual('value', self.cache.get_or_compute(
+                'k', 'v1', lambda: 'value'))
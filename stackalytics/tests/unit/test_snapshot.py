@@ -0,0 +1,192 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+import testtools
+
+from stackalytics.dashboard import memory_storage
+from stackalytics.dashboard import rollup
+from stackalytics.dashboard import snapshot
+from stackalytics.dashboard import snapshot_loader
+from stackalytics.dashboard import vault
+
+
+def _make_records(count=300):
+    for n in range(count):
+        yield {'record_id': n, 'primary_key': 'pk-%d' % n,
+               'record_type': ['commit', 'mark', 'bpd'][n % 3],
+               'company_name': 'Company %d' % (n % 4),
+               'module': 'module-%d' % (n % 50), 'user_id': 'u%d' % (n % 7),
+               'author_name': 'User %d' % (n % 7), 'release': 'liberty',
+               'date': 1435000000 + n * 86400, 'week': 2370 + n // 7,
+               'loc': n * 10 if n % 3 == 0 else None,
+               'blueprint_id': ['nova:bp-%d' % n] if n % 3 == 2 else None}
+
+
+class TestSnapshot(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, 'snapshot')
+
+    def _make_storage(self, memory_storage_type, records):
+        storage = memory_storage.get_memory_storage(memory_storage_type)
+        storage.update(vault.compact_records(records))
+        return storage
+
+    def _assert_same(self, expected, actual):
+        self.assertEqual(sorted(expected.get_record_ids()),
+                         sorted(actual.get_record_ids()))
+        for record_id in expected.get_record_ids():
+            self.assertEqual(expected.records[record_id]._asdict(),
+                             actual.records[record_id]._asdict())
+
+        for query in [
+                lambda s: s.get_record_ids_by_modules(['module-1',
+                                                       'module-7']),
+                lambda s: s.get_record_ids_by_types(['commit']),
+                lambda s: s.get_record_ids_by_companies(['company 2']),
+                lambda s: s.get_record_ids_by_user_ids(['u3', 'missing']),
+                lambda s: s.get_record_ids_by_releases(['liberty']),
+                lambda s: s.get_record_ids_by_blueprint_ids(['nova:bp-5']),
+                lambda s: s.get_record_ids_by_module_release('module-3',
+                                                             'liberty'),
+                lambda s: s.get_record_ids_by_day_range(16610, 16650),
+                lambda s: s.get_record_ids_by_day_range(16600, 20000)]:
+            self.assertEqual(query(expected), query(actual))
+
+        record_ids = expected.get_record_ids_by_types(['mark'])
+        self.assertEqual(
+            expected.get_index_keys_by_record_ids('module', record_ids),
+            actual.get_index_keys_by_record_ids('module', record_ids))
+        self.assertEqual(set(expected.get_companies()),
+                         set(actual.get_companies()))
+        self.assertEqual(expected.get_first_record_day(),
+                         actual.get_first_record_day())
+        self.assertEqual(17, actual.get_record_by_primary_key(
+            'pk-17').record_id)
+        self.assertIsNone(actual.get_record_by_primary_key('pk-x'))
+
+    def test_columnar_storage(self):
+        storage = self._make_storage(
+            memory_storage.MEMORY_STORAGE_COLUMNAR, _make_records())
+        snapshot.write_snapshot(storage, self.path)
+
+        self._assert_same(storage, snapshot.MappedMemoryStorage(self.path))
+
+    def test_cached_storage(self):
+        storage = self._make_storage(
+            memory_storage.MEMORY_STORAGE_CACHED, _make_records())
+        snapshot.write_snapshot(storage, self.path)
+
+        self._assert_same(storage, snapshot.MappedMemoryStorage(self.path))
+
+    def test_copied_sections(self):
+        # the way sections are read where memoryview can not be cast
+        self.patch(snapshot.six, 'PY3', False)
+        storage = self._make_storage(
+            memory_storage.MEMORY_STORAGE_COLUMNAR, _make_records())
+        snapshot.write_snapshot(storage, self.path, 300)
+
+        self._assert_same(storage, snapshot.MappedMemoryStorage(self.path))
+        loaded, update_position = snapshot.load_memory_storage(
+            self.path, memory_storage.MEMORY_STORAGE_COLUMNAR,
+            vault.CompactRecord)
+        self._assert_same(storage, loaded)
+
+    def test_load_snapshot(self):
+        self.assertIsNone(snapshot.load_snapshot(self.path))
+
+        storage = self._make_storage(
+            memory_storage.MEMORY_STORAGE_COLUMNAR, _make_records(10))
+        snapshot.write_snapshot(storage, self.path)
+        first = snapshot.load_snapshot(self.path)
+        self.assertEqual(10, len(first.records))
+        self.assertIsNone(snapshot.load_snapshot(self.path, first.version))
+
+        storage.update(vault.compact_records(_make_records(20)))
+        snapshot.write_snapshot(storage, self.path)
+        second = snapshot.load_snapshot(self.path, first.version)
+
+        # the first snapshot stays readable after it has been replaced
+        self.assertEqual(10, len(first.records))
+        self.assertEqual(20, len(second.records))
+        self.assertEqual(['snapshot'], os.listdir(self.tmp_dir))
+        self.assertRaises(TypeError, second.update, [])
+
+    def _test_load_memory_storage(self, memory_storage_type):
+        storage = self._make_storage(memory_storage_type, _make_records())
+        snapshot.write_snapshot(storage, self.path, 300)
+
+        loaded, update_position = snapshot.load_memory_storage(
+            self.path, memory_storage_type, vault.CompactRecord)
+        self.assertEqual(300, update_position)
+        self._assert_same(storage, loaded)
+
+        # loaded storage accepts updates the same way as the original one
+        updates = [dict(record, company_name='Company 9')
+                   for record in _make_records(20)]
+        updates.append(dict(next(_make_records(1)), record_id=300,
+                            primary_key='pk-300'))
+        for memory_storage_inst in [storage, loaded]:
+            memory_storage_inst.update(vault.compact_records(updates))
+        self._assert_same(storage, loaded)
+        self.assertEqual(
+            storage.rollup.aggregate(rollup.RollupQuery(), 'company_name',
+                                     'company_name'),
+            loaded.rollup.aggregate(rollup.RollupQuery(), 'company_name',
+                                    'company_name'))
+
+    def test_load_columnar_memory_storage(self):
+        self._test_load_memory_storage(memory_storage.MEMORY_STORAGE_COLUMNAR)
+
+    def test_load_cached_memory_storage(self):
+        self._test_load_memory_storage(memory_storage.MEMORY_STORAGE_CACHED)
+
+    def test_load_memory_storage_without_position(self):
+        storage = self._make_storage(
+            memory_storage.MEMORY_STORAGE_COLUMNAR, _make_records(10))
+        snapshot.write_snapshot(storage, self.path)
+
+        self.assertIsNone(snapshot.load_memory_storage(
+            self.path, memory_storage.MEMORY_STORAGE_COLUMNAR,
+            vault.CompactRecord))
+
+    @mock.patch('time.sleep')
+    def test_loader_retries_after_error(self, sleep):
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_epoch.return_value = {'epoch': 1}
+        runtime_storage_inst.get_update.side_effect = [
+            Exception('Connection lost'), iter(_make_records(10))]
+        runtime_storage_inst.get_update_position.return_value = 10
+        sleep.side_effect = [None, StopIteration]
+        memory_storage_inst = memory_storage.get_memory_storage(
+            memory_storage.MEMORY_STORAGE_COLUMNAR)
+
+        self.assertRaises(StopIteration, snapshot_loader.load_periodically,
+                          runtime_storage_inst, memory_storage_inst,
+                          [self.path], 60)
+
+        loaded, update_position = snapshot.load_memory_storage(
+            self.path, memory_storage.MEMORY_STORAGE_COLUMNAR,
+            vault.CompactRecord)
+        self.assertEqual(10, update_position)
+        self.assertEqual(10, len(loaded.records))
@@ -0,0 +1,199 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+from oslo_config import cfg
+import six
+import testtools
+
+from stackalytics.dashboard import memory_storage
+from stackalytics.dashboard import rollup
+from stackalytics.dashboard import vault
+from stackalytics.processor import config
+from stackalytics.processor import runtime_storage
+
+
+def _make_record(record_id, record_type, company_name='Mirantis'):
+    return {'record_id': record_id, 'primary_key': 'pk-%d' % record_id,
+            'record_type': record_type, 'company_name': company_name,
+            'module': 'nova', 'user_id': 'john', 'release': 'liberty',
+            'date': 1435000000, 'week': 2370, 'author_name': 'John'}
+
+
+class TestVaultRefresh(testtools.TestCase):
+
+    def setUp(self):
+        super(TestVaultRefresh, self).setUp()
+        memory_storage_inst = memory_storage.get_memory_storage(
+            memory_storage.MEMORY_STORAGE_CACHED)
+        memory_storage_inst.update(vault.compact_records([
+            _make_record(0, 'commit'), _make_record(1, 'mark')]))
+        self.vault = {'memory_storage': memory_storage_inst}
+        cfg.CONF.register_opts(config.DASHBOARD_OPTS)
+        vault._reset_cache(self.vault)
+
+        for key, record_types in [('commits', set(['commit'])),
+                                  ('marks', set(['mark'])),
+                                  ('any', None)]:
+            self.vault['cache'].set(key, 'value', record_types)
+
+    def _update(self, *records):
+        self.vault['memory_storage'].update(vault.compact_records(records))
+
+    def test_invalidate_changed_record_types(self):
+        self._update(_make_record(2, 'mark'))
+        vault._invalidate_cache(self.vault, set())
+
+        self.assertEqual(['commits'], list(self.vault['cache']))
+        self.assertEqual(len('commits') + len('value'),
+                         self.vault['cache'].size)
+
+    def test_invalidate_all_on_new_company(self):
+        self._update(_make_record(2, 'mark', 'Red Hat'))
+        vault._invalidate_cache(self.vault, set())
+
+        self.assertEqual(0, len(self.vault['cache']))
+        self.assertEqual(
+            'Red Hat',
+            self.vault['memory_storage'].get_original_company_name('red hat'))
+
+    def test_invalidate_all_on_metadata(self):
+        self._update(_make_record(2, 'mark'))
+        vault._invalidate_cache(self.vault, set(['releases']))
+
+        self.assertEqual(0, len(self.vault['cache']))
+
+    def test_changed_metadata(self):
+        self.assertEqual(set(runtime_storage.METADATA_KEYS),
+                         vault._get_changed_metadata(self.vault, None, True))
+        self.assertEqual(set(),
+                         vault._get_changed_metadata(self.vault, None, False))
+
+        digests = dict((key, 'a') for key in runtime_storage.METADATA_KEYS)
+        self.assertEqual(
+            set(runtime_storage.METADATA_KEYS),
+            vault._get_changed_metadata(self.vault, {'metadata': digests},
+                                        False))
+        digests = dict(digests, repos='b')
+        self.assertEqual(
+            set(['repos']),
+            vault._get_changed_metadata(self.vault, {'metadata': digests},
+                                        True))
+
+    def _test_copy_on_write(self, memory_storage_type):
+        memory_storage_inst = memory_storage.get_memory_storage(
+            memory_storage_type)
+        memory_storage_inst.update(vault.compact_records([
+            _make_record(0, 'commit'), _make_record(1, 'mark')]))
+        runtime_storage_inst = mock.Mock()
+        runtime_storage_inst.get_update.return_value = [
+            dict(_make_record(1, 'mark'), company_name='Red Hat'),
+            _make_record(2, 'commit')]
+        old_vault = {'memory_storage': memory_storage_inst, 'epoch': 'a'}
+        new_vault = dict(old_vault, runtime_storage=runtime_storage_inst)
+
+        self.assertTrue(vault._update_memory_storage(new_vault, 'b', True))
+
+        old = old_vault['memory_storage']
+        new = new_vault['memory_storage']
+        self.assertIsNot(old, new)
+        self.assertEqual(set([0, 1]), set(old.get_record_ids()))
+        self.assertEqual(set([0, 1, 2]), set(new.get_record_ids()))
+        self.assertEqual('Mirantis', old.records[1].company_name)
+        self.assertEqual('Red Hat', new.records[1].company_name)
+        self.assertEqual(set([0, 1]),
+                         set(old.get_record_ids_by_companies(['mirantis'])))
+        self.assertEqual(set([0, 2]),
+                         set(new.get_record_ids_by_companies(['mirantis'])))
+        self.assertNotIn('Red Hat', old.get_companies())
+        self.assertEqual(set([0]), set(old.get_record_ids_by_types(
+            ['commit'])))
+        self.assertEqual(set([0, 1]), set(old.get_record_ids_by_day_range(
+            16000, 17000)))
+        self.assertEqual(set([0, 1, 2]), set(new.get_record_ids_by_day_range(
+            16000, 17000)))
+        query = rollup.RollupQuery()
+        self.assertEqual(
+            {'Mirantis': 2},
+            dict((k, v['metric']) for k, v in six.iteritems(
+                old.rollup.aggregate(query, 'company_name', 'company_name'))))
+        self.assertEqual(
+            {'Mirantis': 2, 'Red Hat': 1},
+            dict((k, v['metric']) for k, v in six.iteritems(
+                new.rollup.aggregate(query, 'company_name', 'company_name'))))
+
+    @mock.patch('stackalytics.processor.utils.date_to_timestamp')
+    def test_skipped_epoch_keeps_reader_alive(self, date_to_timestamp):
+        date_to_timestamp.return_value = 1000
+        runtime_storage_inst = runtime_storage.get_runtime_storage(
+            'sqlite://:memory:')
+        runtime_storage_inst.set_records(iter([_make_record(0, 'commit')]))
+        epoch = runtime_storage_inst.publish_epoch()
+        self.vault['runtime_storage'] = runtime_storage_inst
+        self.assertTrue(vault._update_memory_storage(self.vault, epoch))
+
+        # the processor publishes nothing new for longer than max_pid_age
+        for now in (2000, 3000):
+            date_to_timestamp.return_value = now
+            self.assertFalse(vault._update_memory_storage(self.vault, epoch))
+
+        report = runtime_storage_inst.compact_updates(500)
+
+        self.assertEqual(0, report['expired_pids'])
+        self.assertIn(os.getpid(), runtime_storage_inst.get_by_key('pids'))
+
+    @mock.patch('stackalytics.dashboard.snapshot.write_snapshot')
+    def test_local_snapshot_single_writer(self, write_snapshot):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'snapshot')
+        cfg.CONF.set_override('local_snapshot_file', path)
+        self.addCleanup(cfg.CONF.clear_override, 'local_snapshot_file')
+        self.vault['runtime_storage'] = mock.Mock()
+
+        # another worker is writing the snapshot
+        open(path + '.lock', 'w').close()
+        vault._write_local_snapshot(self.vault)
+        self.assertEqual(0, write_snapshot.call_count)
+
+        os.remove(path + '.lock')
+        vault._write_local_snapshot(self.vault)
+        self.assertEqual(1, write_snapshot.call_count)
+        self.assertEqual([], os.listdir(tmp_dir))
+
+    def test_copy_on_write_cached(self):
+        self._test_copy_on_write(memory_storage.MEMORY_STORAGE_CACHED)
+
+    def test_copy_on_write_columnar(self):
+        self._test_copy_on_write(memory_storage.MEMORY_STORAGE_COLUMNAR)
+
+    @mock.patch('stackalytics.dashboard.vault._update_vault')
+    def test_update_by_request(self, update_vault):
+        update_vault.return_value = False
+        vault_inst = {}
+
+        vault._update_vault_by_request(None, vault_inst)
+        self.assertTrue(vault_inst['vault_initialized'])
+        self.assertEqual(1, update_vault.call_count)
+
+        # an update pulled by another request is not waited for
+        vault_inst['vault_next_update_time'] = 0
+        with vault._update_lock:
+            vault._update_vault_by_request(None, vault_inst)
+        self.assertEqual(1, update_vault.call_count)
@@ -0,0 +1,90 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+
+import testtools
+
+from stackalytics.dashboard import bitmap_index
+from stackalytics.dashboard import decorators
+from stackalytics.dashboard import record_columns
+from stackalytics.dashboard import vault
+from stackalytics.dashboard import vectorized
+
+
+def _make_records():
+    types = itertools.cycle([('Code-Review', 2), ('Code-Review', -1),
+                             ('Workflow', 1), ('Workflow', 0),
+                             ('Verified', 1), ('Code-Review', 0)])
+    for n in range(60):
+        mark_type, value = next(types)
+        yield {'record_id': n * 2, 'primary_key': 'pk-%d' % n,
+               'record_type': 'mark', 'company_name': 'c%d' % (n % 4),
+               'module': 'm%d' % (n % 3), 'user_id': 'u%d' % (n % 5),
+               'author_name': 'User %d' % n, 'release': 'liberty',
+               'date': 1435000000 + n, 'week': 2370, 'loc': n * 10,
+               'type': mark_type, 'value': value,
+               'disagreement': n % 7 == 0}
+
+
+def _aggregate(records, metric_filter, param_id, param_title):
+    result = {}
+    for record in records:
+        key = getattr(record, param_id)
+        result.setdefault(key, {'metric': 0, 'id': key})
+        if metric_filter:
+            metric_filter(result, record, param_id, {})
+        else:
+            result[key]['metric'] += 1
+        result[key]['name'] = getattr(record, param_title)
+    return result
+
+
+@testtools.skipUnless(vectorized.numpy, 'NumPy is not installed')
+class TestVectorized(testtools.TestCase):
+
+    def setUp(self):
+        super(TestVectorized, self).setUp()
+        self.records = record_columns.ColumnarRecords()
+        for record in vault.compact_records(_make_records()):
+            self.records[record.record_id] = record
+        self.record_ids = bitmap_index.RecordIdSet(
+            i for i in self.records.keys() if i % 3)
+        self.selected = [self.records[i] for i in self.record_ids]
+
+    def test_count_by(self):
+        self.assertEqual(
+            _aggregate(self.selected, None, 'user_id', 'author_name'),
+            vectorized.count_by(self.records, self.record_ids, 'user_id',
+                                'author_name'))
+
+    def test_sum_by(self):
+        self.assertEqual(
+            _aggregate(self.selected, decorators.loc_filter, 'module',
+                       'module'),
+            vectorized.sum_by(self.records, list(self.record_ids), 'loc',
+                              'module', 'module'))
+
+    def test_marks_by(self):
+        self.assertEqual(
+            _aggregate(self.selected, decorators.mark_filter,
+                       'company_name', 'company_name'),
+            vectorized.marks_by(self.records, self.record_ids,
+                                'company_name', 'company_name'))
+
+    def test_fallback_on_values_out_of_column(self):
+        self.records.columns['loc'].set(2, None)
+        self.assertIsNone(vectorized.sum_by(self.records, [2, 4], 'loc',
+                                            'module', 'module'))
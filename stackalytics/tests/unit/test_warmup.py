@@ -0,0 +1,80 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import flask
+from oslo_config import cfg
+import testtools
+
+from stackalytics.dashboard import warmup
+from stackalytics.processor import config
+
+
+class TestWarmUp(testtools.TestCase):
+
+    def setUp(self):
+        super(TestWarmUp, self).setUp()
+        cfg.CONF.register_opts(config.DASHBOARD_OPTS)
+        cfg.CONF.set_override('cache_warmup_queries', 2)
+        self.addCleanup(cfg.CONF.clear_override, 'cache_warmup_queries')
+
+        self.query_stats = warmup.QueryStats()
+        self.patch(warmup, 'query_stats', self.query_stats)
+
+        self.app = flask.Flask(__name__)
+        self.app.stackalytics_vault = {'vault_initialized': True}
+        self.served = []
+
+        @self.app.route('/api/stats')
+        def stats():
+            warmup.record_query()
+            self.served.append(flask.request.full_path)
+            return 'stats'
+
+    def test_record_and_warm_up(self):
+        client = self.app.test_client()
+        for url in ['/api/stats?release=all&metric=commits&callback=cb',
+                    '/api/stats?metric=commits&release=all&_=1',
+                    '/api/stats?metric=marks',
+                    '/api/stats', '/api/stats']:
+            client.get(url)
+
+        self.assertEqual(
+            ['/api/stats?metric=commits&release=all', '/api/stats',
+             '/api/stats?metric=marks'],
+            self.query_stats.get_top(3))
+
+        del self.served[:]
+        warmup.warm_up(self.app)
+
+        self.assertEqual(2, len(self.served))
+        # queries of the warm-up are not counted
+        self.assertEqual(2, self.query_stats.counts[
+            '/api/stats?metric=commits&release=all'])
+
+    def test_skip_until_vault_is_initialized(self):
+        self.app.test_client().get('/api/stats')
+        del self.served[:]
+        self.app.stackalytics_vault = {}
+
+        warmup.warm_up(self.app)
+        self.assertEqual([], self.served)
+
+    def test_query_stats_are_bounded(self):
+        for n in range(10):
+            for i in range(n + 1):
+                self.query_stats.record('q%d' % n, 8)
+
+        self.assertLessEqual(len(self.query_stats.counts), 8)
+        self.assertEqual(['q9', 'q8'], self.query_stats.get_top(2))
@@ -0,0 +1,123 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare Python and NumPy aggregation of dashboard stats.
+
+A synthetic set of records is put into columnar memory storage, then
+stats by company are computed for a filter that selects a half of records,
+first by iteration over records the way /api/1.0/stats/* does, then by the
+vectorized functions. NumPy must be installed.
+
+Usage: benchmark_aggregation.py [record count]
+"""
+
+import array
+import random
+import sys
+import time
+
+from stackalytics.dashboard import bitmap_index
+from stackalytics.dashboard import decorators
+from stackalytics.dashboard import record_columns
+from stackalytics.dashboard import vectorized
+
+
+MARK_TYPES = [('Code-Review', -2), ('Code-Review', -1), ('Code-Review', 1),
+              ('Code-Review', 2), ('Workflow', 1), ('Workflow', -1)]
+
+
+def _fill_coded(column, count, values):
+    codes = [column.encode(value) for value in values]
+    column.codes = array.array('i', (random.choice(codes)
+                                     for n in range(count)))
+
+
+def generate_records(count):
+    records = record_columns.ColumnarRecords()
+    records.present = bytearray(b'\x01' * count)
+    records.count = count
+    columns = records.columns
+
+    _fill_coded(columns['company_name'], count,
+                ['company-%d' % n for n in range(500)])
+    _fill_coded(columns['module'], count, ['module-%d' % n
+                                           for n in range(1000)])
+    _fill_coded(columns['user_id'], count, ['user-%d' % n
+                                            for n in range(30000)])
+    columns['author_name'].codes = columns['user_id'].codes
+    columns['author_name'].values = columns['user_id'].values
+    _fill_coded(columns['record_type'], count, ['mark'])
+    _fill_coded(columns['release'], count, ['liberty'])
+    _fill_coded(columns['status'], count, [None])
+    _fill_coded(columns['disagreement'], count, [False] * 9 + [True])
+
+    marks = [random.choice(MARK_TYPES) for n in range(count)]
+    columns['type'].encode('Code-Review')
+    columns['type'].encode('Workflow')
+    columns['type'].codes = array.array(
+        'i', (columns['type'].value_codes[t] for t, v in marks))
+    columns['value'].data = array.array('i', (v for t, v in marks))
+    columns['loc'].data = array.array('i', (random.randrange(1000)
+                                            for n in range(count)))
+    columns['date'].data = array.array('q', range(count))
+    columns['week'].data = array.array('i', [2370]) * count
+    columns['primary_key'].data = [None] * count
+    columns['blueprint_id'].data = [None] * count
+    return records
+
+
+def aggregate(records, record_ids, metric_filter):
+    result = {}
+    for record_id in record_ids:
+        record = records[record_id]
+        key = record.company_name
+        if key not in result:
+            result[key] = {'metric': 0, 'id': key}
+        if metric_filter:
+            metric_filter(result, record, 'company_name', {})
+        else:
+            result[key]['metric'] += 1
+        result[key]['name'] = record.company_name
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+
+    print('Generating %d records' % count)
+    records = generate_records(count)
+    record_ids = bitmap_index.RecordIdSet(bits=int('01' * (count // 2), 2))
+
+    print('%-8s %12s %12s %8s' % ('metric', 'python, s', 'numpy, s', 'x'))
+    for name, metric_filter, func, args in [
+            ('commits', None, vectorized.count_by, ()),
+            ('loc', decorators.loc_filter, vectorized.sum_by, ('loc',)),
+            ('marks', decorators.mark_filter, vectorized.marks_by, ())]:
+        start = time.time()
+        expected = aggregate(records, record_ids, metric_filter)
+        python_time = time.time() - start
+
+        start = time.time()
+        actual = func(records, record_ids, *(args + ('company_name',
+                                                     'company_name')))
+        numpy_time = time.time() - start
+
+        assert expected == actual
+        print('%-8s %12.3f %12.3f %8.1f' % (name, python_time, numpy_time,
+                                            python_time / numpy_time))
+
+
+if __name__ == '__main__':
+    main()
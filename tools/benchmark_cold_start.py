@@ -0,0 +1,120 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare cold start of a dashboard worker with and without a snapshot.
+
+Synthetic records are written into runtime storage, then a new reader
+loads them the way a freshly started worker does: first by polling the
+update log from scratch, then from a local snapshot that is followed by
+catching up the updates made after the snapshot.
+
+Usage: benchmark_cold_start.py [record count] [runtime storage uri]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from stackalytics.dashboard import memory_storage
+from stackalytics.dashboard import snapshot
+from stackalytics.dashboard import vault
+from stackalytics.processor import runtime_storage
+
+
+MEMORY_STORAGE_TYPES = [
+    ('cached', memory_storage.MEMORY_STORAGE_CACHED),
+    ('columnar', memory_storage.MEMORY_STORAGE_COLUMNAR),
+]
+
+
+def generate_records(count, offset=0):
+    for n in range(offset, offset + count):
+        yield {
+            'primary_key': 'pk-%d' % n, 'record_type': 'mark',
+            'company_name': 'company-%d' % (n % 500),
+            'module': 'module-%d' % (n % 1000),
+            'user_id': 'user-%d' % (n % 30000),
+            'author_name': 'User %d' % (n % 30000), 'release': 'liberty',
+            'date': 1387860458 + n * 60, 'week': 2294 + n // 10000,
+            'type': 'Code-Review', 'value': n % 5 - 2,
+            'disagreement': n % 10 == 0, 'review_id': 'r-%d' % (n // 10),
+        }
+
+
+def cold_start(runtime_storage_inst, memory_storage_type, pid):
+    memory_storage_inst = memory_storage.get_memory_storage(
+        memory_storage_type)
+    memory_storage_inst.update(vault.compact_records(
+        runtime_storage_inst.get_update(pid)))
+    return memory_storage_inst
+
+
+def snapshot_start(runtime_storage_inst, memory_storage_type, pid, path):
+    memory_storage_inst, update_position = snapshot.load_memory_storage(
+        path, memory_storage_type, vault.CompactRecord)
+    assert runtime_storage_inst.resume_update(pid, update_position)
+    memory_storage_inst.update(vault.compact_records(
+        runtime_storage_inst.get_update(pid)))
+    return memory_storage_inst
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    tmp_dir = tempfile.mkdtemp()
+    uri = (sys.argv[2] if len(sys.argv) > 2 else
+           'sqlite://%s' % os.path.join(tmp_dir, 'runtime.sqlite'))
+    path = os.path.join(tmp_dir, 'snapshot')
+
+    try:
+        runtime_storage_inst = runtime_storage.get_runtime_storage(uri)
+        print('Writing %d records into %s' % (count, uri))
+        runtime_storage_inst.set_records(generate_records(count))
+        runtime_storage_inst.publish_epoch()
+
+        print('%-10s %12s %12s %12s' % ('storage', 'full load, s',
+                                        'snapshot, s', 'x'))
+        pid = 0
+        for name, memory_storage_type in MEMORY_STORAGE_TYPES:
+            pid += 1
+            start = time.time()
+            loaded = cold_start(runtime_storage_inst, memory_storage_type,
+                                pid)
+            full_time = time.time() - start
+
+            snapshot.write_snapshot(
+                loaded, path, runtime_storage_inst.get_update_position(pid))
+            # a trickle of updates made after the snapshot
+            runtime_storage_inst.set_records(
+                generate_records(count // 100, count))
+            runtime_storage_inst.publish_epoch()
+
+            pid += 1
+            start = time.time()
+            resumed = snapshot_start(runtime_storage_inst,
+                                     memory_storage_type, pid, path)
+            snapshot_time = time.time() - start
+
+            assert len(resumed.records) == len(loaded.records) + count // 100
+            count += count // 100
+            print('%-10s %12.2f %12.2f %12.1f' % (
+                name, full_time, snapshot_time, full_time / snapshot_time))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
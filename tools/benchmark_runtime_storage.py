@@ -0,0 +1,138 @@
+# Copyright (c) 2015 Mirantis Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare record codecs of runtime storage.
+
+For every codec the script reports the average number of bytes per record
+as it is sent to memcached and the number of records per second that
+get_all_records is able to decode. If memcached uri is given, records are
+also written to memcached under a scratch key prefix and read back.
+
+Usage: benchmark_runtime_storage.py [record count] [memcached uri]
+"""
+
+import pickle
+import sys
+import time
+import uuid
+import zlib
+
+import memcache
+
+from stackalytics.processor import runtime_storage
+
+
+CODECS = [
+    ('pickle-0', 0, 0, False),
+    ('pickle-2', 2, 0, False),
+    ('pickle-2 + compress', 2, 256, False),
+    ('compact', 2, 0, True),
+    ('compact + compress', 2, 256, True),
+]
+
+
+def generate_records(count):
+    for n in range(count):
+        record = {
+            'record_id': n, 'primary_key': str(uuid.uuid4()),
+            'record_type': 'mark', 'company_name': '*independent',
+            'module': 'nova', 'user_id': 'john_doe', 'release': 'liberty',
+            'date': 1387860458 + n, 'week': 2294, 'author_name': 'John Doe',
+            'author_email': 'john_doe@gmail.com', 'launchpad_id': 'john_doe',
+            'type': 'Code-Review', 'value': n % 5 - 2, 'patch': n % 10,
+            'disagreement': False, 'branch': 'master',
+            'review_id': str(uuid.uuid4()), 'description': 'Code Review',
+        }
+        if n % 3 == 0:
+            record.update({
+                'record_type': 'review', 'status': 'MERGED',
+                'subject': 'Fix race in compute manager %d' % n,
+                'url': 'https://review.openstack.org/%d' % n,
+                'project': 'openstack/nova', 'topic': 'bug/%d' % n,
+                'open': False, 'lastUpdated': 1387865203 + n,
+            })
+        yield record
+
+
+def measure(client, records, protocol, min_compress_len, compact):
+    client.pickleProtocol = protocol
+    stored = []
+    total = 0
+    for record in records:
+        value = record
+        if compact:
+            value = runtime_storage.encode_record(record)
+        flags, length, data = client._val_to_store_info(
+            value, min_compress_len)
+        total += length
+        stored.append((flags, data))
+
+    start = time.time()
+    for flags, data in stored:
+        if flags & memcache.Client._FLAG_COMPRESSED:
+            data = zlib.decompress(data)
+        runtime_storage.decode_record(pickle.loads(data))
+    elapsed = time.time() - start
+
+    return total / float(len(records)), len(records) / elapsed
+
+
+def measure_memcached(uri, records, protocol, min_compress_len, compact):
+    storage = runtime_storage.MemcachedStorage(
+        uri, min_compress_len=min_compress_len, compact_records=compact)
+    storage.memcached.pickleProtocol = protocol
+    prefix = 'benchmark:%s:' % uuid.uuid4().hex[:8]
+    step = runtime_storage.BULK_READ_SIZE
+    for n in range(0, len(records), step):
+        bucket = dict((record['record_id'],
+                       runtime_storage.encode_record(record)
+                       if compact else record)
+                      for record in records[n:n + step])
+        storage.set_multi_by_keys(bucket, prefix)
+
+    start = time.time()
+    count = 0
+    for n in range(0, len(records), step):
+        chunk = storage.memcached.get_multi(range(n, n + step), prefix)
+        for value in chunk.values():
+            runtime_storage.decode_record(value)
+            count += 1
+    elapsed = time.time() - start
+
+    storage.memcached.delete_multi(range(len(records)), key_prefix=prefix)
+    return count / elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    uri = sys.argv[2] if len(sys.argv) > 2 else None
+
+    records = list(generate_records(count))
+    client = memcache.Client([])
+
+    print('%-22s %14s %16s %16s' % ('codec', 'bytes/record', 'decode rec/s',
+                                    'memcached rec/s'))
+    for name, protocol, min_compress_len, compact in CODECS:
+        size, rate = measure(client, records, protocol, min_compress_len,
+                             compact)
+        memcached_rate = '-'
+        if uri:
+            memcached_rate = '%d' % measure_memcached(
+                uri, records, protocol, min_compress_len, compact)
+        print('%-22s %14.1f %16d %16s' % (name, size, rate, memcached_rate))
+
+
+if __name__ == '__main__':
+    main()